@@ -0,0 +1,167 @@
+"""
+Diff artifact images (minus, diff, thresh, marked_l, marked_r) rendered on demand.
+
+With lazy artifacts workon_images only saves the compact outputs of the computation - the SSIM diff map, the
+changed region boxes and the shift - to an .npz next to the uploads, plus a small <artifact>.pending file per
+artifact. render_pending turns one of them into the image file the first time its URL is requested; after that the
+file is served from disk like any other upload.
+"""
+import json
+import logging
+import os
+import uuid
+
+import cv2
+import numpy as np
+
+import decoded_cache
+import utils
+from regions import draw_regions, threshold
+
+logger = logging.getLogger(__name__)
+
+ROLES = ("minus", "diff", "thresh", "marked_l", "marked_r")
+
+# format -> file extension, opencv quality/compression flag
+FORMATS = {
+    "png": (".png", cv2.IMWRITE_PNG_COMPRESSION),
+    "webp": (".webp", cv2.IMWRITE_WEBP_QUALITY),
+    "jpeg": (".jpg", cv2.IMWRITE_JPEG_QUALITY),
+}
+
+PENDING_SUFFIX = ".pending"
+
+
+def parse_formats(specs):
+    """
+    :param specs: list of "<role>=<format>[:<level>]" e.g. ["diff=webp:80", "marked_l=jpeg:90", "thresh=png:1"],
+                  the level is the png compression (0-9) or the webp/jpeg quality (0-100)
+    :return: {role: [format, level or None]} for the roles given
+    :raise ValueError: on an unknown role or format
+    """
+    formats = {}
+    for spec in specs or []:
+        role, _, value = spec.partition("=")
+        fmt, _, level = value.partition(":")
+        if role not in ROLES:
+            raise ValueError("unknown artifact {}, one of {}".format(role, ", ".join(ROLES)))
+        if fmt not in FORMATS:
+            raise ValueError("unknown artifact format {}, one of {}".format(fmt, ", ".join(sorted(FORMATS))))
+        formats[role] = [fmt, int(level) if level else None]
+    return formats
+
+
+def extension(role, formats):
+    fmt = (formats or {}).get(role, ["png", None])[0]
+    return FORMATS[fmt][0]
+
+
+def write(path, image, role, formats):
+    """
+    Encode image to path in the format configured for role. The file appears complete or not at all.
+    """
+    fmt, level = (formats or {}).get(role, ["png", None])
+    params = [] if level is None else [FORMATS[fmt][1], level]
+
+    tmp_path = os.path.join(os.path.dirname(path), ".artifact-{}{}".format(uuid.uuid4().hex, FORMATS[fmt][0]))
+    try:
+        if not cv2.imwrite(tmp_path, image, params):
+            raise OSError("opencv could not write {}".format(path))
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def save_outputs(path, diff, regions, shift):
+    """
+    The compact outputs of a diff computation - everything render needs besides the source images
+    """
+    tmp_path = os.path.join(os.path.dirname(path), ".outputs-{}.npz".format(uuid.uuid4().hex))
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, diff=diff, regions=np.array(regions, dtype=np.int32).reshape(-1, 4), shift=np.array(shift))
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _source_stat(path):
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def write_pending(artifact_path, role, outputs, left, right, formats):
+    """
+    Record how to render artifact_path once it is requested
+    """
+    pending = {
+        "role": role,
+        "outputs": outputs,
+        "left": left,
+        "right": right,
+        "sources": [_source_stat(left), _source_stat(right)],
+        "format": (formats or {}).get(role, ["png", None]),
+    }
+    with open(artifact_path + PENDING_SUFFIX, 'w') as f:
+        json.dump(pending, f)
+
+    # a file rendered for an earlier computation of the pair is out of date
+    if os.path.exists(artifact_path):
+        os.remove(artifact_path)
+
+
+def is_pending(artifact_path):
+    return os.path.isfile(artifact_path + PENDING_SUFFIX)
+
+
+def render(role, outputs, l, r):
+    """
+    The artifact image of role from the outputs of save_outputs and the (uncropped) source images
+    """
+    sr, er, sc, ec = [int(v) for v in outputs["shift"]]
+    r = utils.capture_remove_shift(r, sr, er, sc, ec)
+    l = utils.golden_remove_shift(l, sr, er, sc, ec)
+
+    if role == "minus":
+        return cv2.absdiff(l, r)
+    if role == "diff":
+        return outputs["diff"]
+    if role == "thresh":
+        return threshold(outputs["diff"])
+
+    return draw_regions([np.copy(l if role == "marked_l" else r)], outputs["regions"])[0]
+
+
+def render_pending(artifact_path):
+    """
+    Runs in a worker: render and write the pending artifact_path, the source images come through the worker's
+    decoded image cache
+    :return: True if it was rendered, False if there was nothing to render (already rendered)
+    :raise ValueError: when the source images changed since the diff was computed
+    """
+    pending_path = artifact_path + PENDING_SUFFIX
+    try:
+        with open(pending_path, 'r') as f:
+            pending = json.load(f)
+    except FileNotFoundError:
+        return False
+
+    if [_source_stat(pending["left"]), _source_stat(pending["right"])] != pending["sources"]:
+        raise ValueError("the images were replaced since the diff was computed")
+
+    l = decoded_cache.load(pending["left"])
+    r = decoded_cache.load(pending["right"])
+    if l is None or r is None:
+        raise ValueError("Images could not be loaded into opencv")
+
+    with np.load(pending["outputs"]) as outputs:
+        image = render(pending["role"], outputs, l.image, r.image)
+
+    write(artifact_path, image, pending["role"], {pending["role"]: pending["format"]})
+    try:
+        os.remove(pending_path)
+    except FileNotFoundError:
+        pass
+    return True
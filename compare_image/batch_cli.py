@@ -0,0 +1,258 @@
+"""
+Headless batch comparison of golden/capture pairs - no web server, no bokeh.
+
+    python batch_cli.py --golden-dir goldens/ --capture-dir captures/ --out results.jsonl
+    python batch_cli.py --manifest pairs.csv --out results.csv --artifacts artifacts/
+
+Pairs are matched by file name (same name without extension in both directories) or listed in a manifest CSV with
+"golden" and "capture" columns. The summary is JSONL or CSV depending on the --out extension. Runs are resumable:
+pairs that already have a successful line in the output are skipped.
+"""
+import argparse
+import collections
+import concurrent.futures
+import csv
+import json
+import logging
+import os
+import sys
+import time
+
+import artifacts
+import image_ops
+import prechecks
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ["golden", "capture", "code", "ssim_score", "shift", "seconds", "error", "regions", "settled_by", "metrics"]
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+
+
+def pairs_by_name(golden_dir, capture_dir):
+    """
+    :return: list of (golden path, capture path) for the captures that have a golden image with the same name
+    """
+    goldens = {}
+    for entry in os.scandir(golden_dir):
+        stem, ext = os.path.splitext(entry.name)
+        if entry.is_file() and ext.lower() in IMAGE_EXTENSIONS:
+            goldens[stem] = entry.path
+
+    pairs = []
+    for entry in sorted(os.scandir(capture_dir), key=lambda e: e.name):
+        stem, ext = os.path.splitext(entry.name)
+        if not entry.is_file() or ext.lower() not in IMAGE_EXTENSIONS:
+            continue
+        if stem in goldens:
+            pairs.append((goldens[stem], entry.path))
+        else:
+            logger.warning("No golden image for {}".format(entry.path))
+    return pairs
+
+
+def pairs_from_manifest(manifest):
+    """
+    :param manifest: CSV with "golden" and "capture" columns, relative paths are relative to the manifest
+    :return: list of (golden path, capture path)
+    """
+    base = os.path.dirname(os.path.abspath(manifest))
+    with open(manifest, newline='') as f:
+        return [(os.path.join(base, row["golden"]), os.path.join(base, row["capture"])) for row in csv.DictReader(f)]
+
+
+def _is_csv(path):
+    return os.path.splitext(path)[1].lower() == ".csv"
+
+
+def completed_pairs(out):
+    """
+    Pairs with a successful line in an existing output file
+    """
+    done = set()
+    if not os.path.isfile(out):
+        return done
+
+    with open(out, newline='') as f:
+        rows = csv.DictReader(f) if _is_csv(out) else (json.loads(line) for line in f if line.strip())
+        for row in rows:
+            if str(row.get("code")) == "0":
+                done.add((row["golden"], row["capture"]))
+    return done
+
+
+def compare_pair(golden, capture, artifact_dir, shift_method, shift_precheck, ssim_tile_size, artifact_formats=None,
+                 region_min_area=0, region_merge_distance=0, precheck=True, near_identical=0.0, metrics=None,
+                 near_identical_max=prechecks.NOISE_LEVEL):
+    """
+    Runs in a worker process
+    :return: output record of the pair
+    """
+    t0 = time.time()
+    record = {"golden": golden, "capture": capture}
+    try:
+        code, result = image_ops.workon_images(golden, capture, artifact_dir,
+                                               shift_method=shift_method, shift_precheck=shift_precheck,
+                                               ssim_tile_size=ssim_tile_size, artifact_formats=artifact_formats,
+                                               region_min_area=region_min_area,
+                                               region_merge_distance=region_merge_distance,
+                                               precheck=precheck, near_identical=near_identical,
+                                               near_identical_max=near_identical_max, metrics=metrics,
+                                               write_artifacts=artifact_dir is not None, plots=False)
+    except Exception as x:
+        code, result = 1, "{}: {}".format(type(x).__name__, x)
+
+    record["code"] = code
+    if code == 0:
+        if "ssim_score" not in result:
+            record["code"] = 1
+            record["error"] = "Images have different dimensions"
+        else:
+            record["ssim_score"] = float(result["ssim_score"])
+            record["shift"] = result["shift"]
+            if "regions" in result:
+                record["regions"] = result["regions"]
+            record["settled_by"] = result.get("settled_by")
+            if "metrics" in result:
+                record["metrics"] = result["metrics"]
+    else:
+        record["error"] = result
+    record["seconds"] = time.time() - t0
+    return record
+
+
+class Output:
+    """
+    Appends records to a JSONL or CSV file, flushed after every record so an interrupted run can be resumed
+    """
+
+    def __init__(self, path):
+        self.is_csv = _is_csv(path)
+        new_file = not os.path.isfile(path) or os.path.getsize(path) == 0
+        self.f = open(path, 'a', newline='')
+        self.writer = None
+        if self.is_csv:
+            self.writer = csv.DictWriter(self.f, fieldnames=FIELDS)
+            if new_file:
+                self.writer.writeheader()
+
+    def write(self, record):
+        if self.is_csv:
+            row = dict(record)
+            if "shift" in row:
+                row["shift"] = " ".join(str(v) for v in row["shift"])
+            if "regions" in row:
+                row["regions"] = json.dumps(row["regions"])
+            if "metrics" in row:
+                row["metrics"] = json.dumps(row["metrics"])
+            self.writer.writerow(row)
+        else:
+            self.f.write(json.dumps(record) + "\n")
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def run(pairs, out, artifact_dir, workers, shift_method, shift_precheck, ssim_tile_size=None, artifact_formats=None,
+        region_min_area=0, region_merge_distance=0, precheck=True, near_identical=0.0, metrics=None, report_every=100,
+        near_identical_max=prechecks.NOISE_LEVEL):
+    """
+    Compare all pairs in parallel and append a record per pair to out
+    :return: number of pairs compared, number of failures
+    """
+    done = completed_pairs(out)
+    todo = [(g, c) for g, c in pairs if (g, c) not in done]
+    logger.info("{} pairs, {} already done, {} to compare".format(len(pairs), len(pairs) - len(todo), len(todo)))
+
+    if artifact_dir is not None and not os.path.exists(artifact_dir):
+        os.makedirs(artifact_dir)
+
+    output = Output(out)
+    compared = 0
+    failed = 0
+    settled_by = collections.Counter()
+    t0 = time.time()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        # keep a bounded number of pairs in flight so thousands of pairs do not all sit in the executor queue
+        pending = set()
+        todo = iter(todo)
+        while True:
+            for golden, capture in todo:
+                pending.add(executor.submit(compare_pair, golden, capture, artifact_dir, shift_method, shift_precheck, ssim_tile_size,
+                                            artifact_formats, region_min_area, region_merge_distance, precheck,
+                                            near_identical, metrics, near_identical_max))
+                if len(pending) >= workers * 4:
+                    break
+
+            if not pending:
+                break
+
+            finished, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                record = future.result()
+                output.write(record)
+                compared += 1
+                settled_by[record.get("settled_by")] += 1
+                if record["code"] != 0:
+                    failed += 1
+                    logger.warning("{} vs {}: {}".format(record["golden"], record["capture"], record["error"]))
+
+                if compared % report_every == 0:
+                    elapsed = time.time() - t0
+                    logger.info("{} pairs in {:.1f}s: {:.2f} pairs/s".format(compared, elapsed, compared / elapsed))
+
+    output.close()
+
+    elapsed = time.time() - t0
+    logger.info("Compared {} pairs ({} failed) in {:.1f}s: {:.2f} pairs/s".format(
+        compared, failed, elapsed, compared / elapsed if elapsed > 0 else 0.0))
+    logger.info("Settled by: {}".format(", ".join("{} {}".format(tier, settled_by[tier]) for tier in prechecks.TIERS)))
+    return compared, failed
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="KVM Test Station - batch image compare")
+
+    parser.add_argument('--golden-dir',   action='store', dest="golden_dir", help="directory of golden images", type=str)
+    parser.add_argument('--capture-dir',  action='store', dest="capture_dir", help="directory of captured images", type=str)
+    parser.add_argument('--manifest',     action='store', dest="manifest", help="CSV with golden,capture columns - instead of the directories", type=str)
+    parser.add_argument('--out', '-o',    action='store', dest="out", required=True, help="summary file, .jsonl or .csv", type=str)
+    parser.add_argument('--artifacts',    action='store', dest="artifact_dir", default=None, help="write diff/thresh/marked images to this directory", type=str)
+    parser.add_argument('--workers',      action='store', dest="workers", default=os.cpu_count(), help="Number of worker processes", type=int)
+    parser.add_argument('--shift-method', action='store', dest="shift_method", default="full", choices=["full", "pyramid"], help="Shift detection method", type=str)
+    parser.add_argument('--ssim-tile',    action='store', dest="ssim_tile_size", default=0, help="Compute the SSIM in tiles of this size to bound memory, 0 for one pass", type=int)
+    parser.add_argument('--artifact-format', action='store', dest="artifact_formats", default=[], nargs='*', help="Artifact image formats, <minus|diff|thresh|marked_l|marked_r>=<png|webp|jpeg>[:<level>]", type=str)
+    parser.add_argument('--region-min-area', action='store', dest="region_min_area", default=0, help="Ignore changed regions whose box is smaller than this many pixels", type=int)
+    parser.add_argument('--region-merge', action='store', dest="region_merge_distance", default=0, help="Merge changed regions at most this many pixels apart into one box", type=int)
+    parser.add_argument('--near-identical', action='store', dest="near_identical", default=0.0, help="Settle pairs whose mean absolute difference (0-255) is at most this without the full comparison", type=float)
+    parser.add_argument('--near-identical-max', action='store', dest="near_identical_max", default=prechecks.NOISE_LEVEL, help="Largest difference of a pixel (0-255) in a pair settled by --near-identical", type=int)
+    parser.add_argument('--metrics',      action='store', dest="metrics", default=[], nargs='*', choices=list(REGISTRY), help="Comparison metrics to add to every record", type=str)
+    parser.add_argument('--no-precheck',  action='store_false', dest="precheck", help="Run the full comparison even for identical pairs")
+    parser.add_argument('--no-shift-precheck', action='store_false', dest="shift_precheck", help="Always run shift detection even if the images have no black bars")
+
+    pargs = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    try:
+        artifact_formats = artifacts.parse_formats(pargs.artifact_formats)
+    except ValueError as x:
+        parser.error(str(x))
+
+    if pargs.manifest:
+        pairs = pairs_from_manifest(pargs.manifest)
+    elif pargs.golden_dir and pargs.capture_dir:
+        pairs = pairs_by_name(pargs.golden_dir, pargs.capture_dir)
+    else:
+        parser.error("either --manifest or both --golden-dir and --capture-dir are required")
+
+    compared, failed = run(pairs, pargs.out, pargs.artifact_dir, pargs.workers, pargs.shift_method, pargs.shift_precheck, pargs.ssim_tile_size or None,
+                           artifact_formats, pargs.region_min_area, pargs.region_merge_distance,
+                           pargs.precheck, pargs.near_identical, pargs.metrics,
+                           near_identical_max=pargs.near_identical_max)
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,364 @@
+"""
+Benchmarks for the image comparison stages.
+
+    python bench.py                                  # run all benchmarks
+    python bench.py shift --sizes 1080p 4k
+    python bench.py --out run.json                   # also write the results as JSON
+    python bench.py --out new.json --baseline run.json   # and compare them with an earlier run
+
+Every benchmark runs on a synthetic pair with a known ground truth (see synthetic_case): a shift with black bars,
+Gaussian noise, rectangular defects and color changes at known places. Each measurement records whether the stage
+got it right - the shift it detected, the defects its regions cover - so a faster stage that broke is caught, and
+the run exits 1 when a check failed. Color changes are reported but not checked: the Otsu threshold of the diff is
+global, next to a solid defect a subtle color cast can fall below it (the smaller sizes show it).
+
+With --baseline the times are compared per benchmark and size: slower than the baseline by more than --tolerance
+is reported as a regression (exit 2).
+
+Peak memory is measured with tracemalloc which sees numpy allocations but not memory allocated inside opencv.
+"""
+import argparse
+import collections
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+import image_ops
+import utils
+
+SIZES = {
+    "720p": (720, 1280),
+    "1080p": (1080, 1920),
+    "4k": (2160, 3840),
+    "8k": (4320, 7680),
+}
+
+# the pair every benchmark works on, per size
+SHIFT = (-12, 7)
+NOISE = 2.0
+DEFECTS = 3
+COLOR_CHANGES = 2
+SEED = 0
+
+# the color cast of a color change (b, g, r) - about 9 gray levels, a subtle change next to the solid defects
+TINT = np.array([-48, 0, 48], dtype=np.int16)
+
+# the measurements of this run, see report
+RESULTS = []
+
+Case = collections.namedtuple("Case", "golden capture truth")
+
+
+def synthetic_case(rows, cols, shift_row=0, shift_col=0, noise=0.0, defects=0, color_changes=0, seed=0):
+    """
+    A smooth random golden image and a capture of it with known differences. The same arguments always give the same
+    pair.
+    :param shift_row: the capture is shifted down (up when negative) by this many rows, black bars fill the border
+    :param shift_col: the capture is shifted right (left when negative) by this many cols
+    :param noise: standard deviation of the Gaussian noise added to the capture
+    :param defects: number of rectangles of the capture filled with a solid color
+    :param color_changes: number of rectangles of the capture with a color cast: red up and blue down by TINT
+    :return: Case - golden, capture and the ground truth
+        {"shift": [start_row, end_row, start_col, end_col] the shift detection should crop away - also the width of
+                  the black bars detect_shift finds,
+         "defects": [[x, y, w, h], ...] the defects and color changes in the coordinates of the cropped images,
+         "kinds": ["defect" or "color", ...] of each box,
+         "noise": noise}
+    """
+    rng = np.random.RandomState(seed)
+    golden = cv2.GaussianBlur(rng.randint(0, 256, (rows, cols, 3)).astype(np.uint8), (15, 15), 0)
+
+    capture = np.zeros_like(golden)
+    src = golden[max(0, -shift_row):rows - max(0, shift_row), max(0, -shift_col):cols - max(0, shift_col)]
+    capture[max(0, shift_row):max(0, shift_row) + src.shape[0], max(0, shift_col):max(0, shift_col) + src.shape[1]] = src
+
+    shift = [max(0, shift_row), max(0, -shift_row), max(0, shift_col), max(0, -shift_col)]
+
+    # defects are placed inside the part of the capture the golden image covers, apart from each other
+    boxes = []
+    kinds = ["defect"] * defects + ["color"] * color_changes
+    for kind in kinds:
+        for _ in range(100):
+            w = rng.randint(cols // 40, cols // 10)
+            h = rng.randint(rows // 40, rows // 10)
+            x = rng.randint(shift[2] + 16, cols - shift[3] - w - 16)
+            y = rng.randint(shift[0] + 16, rows - shift[1] - h - 16)
+            if all(x > bx + bw + 32 or bx > x + w + 32 or y > by + bh + 32 or by > y + h + 32
+                   for bx, by, bw, bh in boxes):
+                break
+        boxes.append([x, y, w, h])
+
+        patch = capture[y:y + h, x:x + w]
+        if kind == "defect":
+            patch[:] = rng.randint(0, 256, 3)
+        else:
+            patch[:] = np.clip(patch.astype(np.int16) + TINT, 0, 255)
+
+    if noise > 0:
+        noisy = capture.astype(np.float32) + rng.normal(0, noise, capture.shape).astype(np.float32)
+        capture = np.clip(noisy, 0, 255).astype(np.uint8)
+
+    truth = {
+        "shift": shift,
+        "defects": [[x - shift[2], y - shift[0], w, h] for x, y, w, h in boxes],
+        "kinds": kinds,
+        "noise": noise,
+    }
+    return Case(golden, capture, truth)
+
+
+def synthetic_pair(rows, cols, shift_row=0, shift_col=0, seed=0):
+    """
+    A smooth random golden image and a capture of it shifted down/right by shift_row/shift_col with black bars
+    filling the uncovered border.
+    """
+    case = synthetic_case(rows, cols, shift_row=shift_row, shift_col=shift_col, seed=seed)
+    return case.golden, case.capture
+
+
+def bench_case(size):
+    rows, cols = SIZES[size]
+    return synthetic_case(rows, cols, shift_row=SHIFT[0], shift_col=SHIFT[1], noise=NOISE, defects=DEFECTS,
+                          color_changes=COLOR_CHANGES, seed=SEED)
+
+
+def cropped(case):
+    # the pair with the ground truth shift removed, as the pipeline compares it
+    shift = case.truth["shift"]
+    return utils.golden_remove_shift(case.golden, *shift), utils.capture_remove_shift(case.capture, *shift)
+
+
+def region_check(regions, truth):
+    """
+    How well regions found the defects of a case
+    :return: {"recall": fraction of the defects a region overlaps, "missed": kinds of the defects no region overlaps,
+              "false_regions": regions that overlap no defect, "solid": all the solid defects were found}
+    """
+    def overlap(a, b):
+        return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+    defects = truth["defects"]
+    found = [any(overlap(box, region) for region in regions) for box in defects]
+    return {
+        "recall": sum(found) / len(defects) if defects else 1.0,
+        "missed": [kind for kind, hit in zip(truth["kinds"], found) if not hit],
+        "false_regions": sum(1 for region in regions if not any(overlap(box, region) for box in defects)),
+        "solid": all(hit for kind, hit in zip(truth["kinds"], found) if kind == "defect"),
+    }
+
+
+def measure(fn, *args, repeat=3, **kwargs):
+    """
+    :return: result of fn, best wall time in seconds, peak traced memory in bytes
+    """
+    best = None
+    peak = 0
+    result = None
+    for _ in range(repeat):
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        result = fn(*args, **kwargs)
+        elapsed = time.perf_counter() - t0
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best, peak
+
+
+def report(name, size, seconds, peak, extra="", ok=None, **detail):
+    """
+    Print a measurement and keep it for --out
+    :param ok: whether the stage matched the ground truth, None when there is nothing to check
+    :param detail: more fields of the JSON record
+    """
+    check = "" if ok is None else ("ok  " if ok else "FAIL")
+    print("{:<40} {:>6} {:>10.1f} ms {:>10.1f} MB {:>4}  {}".format(name, size, seconds * 1000, peak / (1024 * 1024),
+                                                                      check, extra))
+    RESULTS.append(dict(detail, name=name, size=size, seconds=seconds, peak_bytes=peak,
+                        ok=None if ok is None else bool(ok)))
+
+
+def bench_shift(sizes):
+    for size in sizes:
+        case = bench_case(size)
+        for method in ("full", "pyramid"):
+            result, seconds, peak = measure(utils.detect_shift_using_correlation, case.golden, case.capture,
+                                            method=method)
+            report("detect_shift_using_correlation " + method, size, seconds, peak, result,
+                   ok=list(result) == case.truth["shift"], shift=list(result))
+
+
+def bench_border_scan(sizes):
+    for size in sizes:
+        case = bench_case(size)
+        result, seconds, peak = measure(utils.detect_shift, case.capture)
+        report("detect_shift", size, seconds, peak, result, ok=list(result) == case.truth["shift"], shift=list(result))
+        result, seconds, peak = measure(utils.has_black_bars, case.golden)
+        report("has_black_bars", size, seconds, peak, result, ok=not result)
+
+
+def _legacy_histogram_data(image):
+    # the np.histogram based implementation histogram_data replaced - kept as the baseline
+    h, e = np.histogram(image, bins=[x for x in range(257)])
+    h_b, e = np.histogram(image[:, :, 0], bins=[x for x in range(257)])
+    h_g, e = np.histogram(image[:, :, 1], bins=[x for x in range(257)])
+    h_r, e = np.histogram(image[:, :, 2], bins=[x for x in range(257)])
+    return {"h": h, "h_b": h_b, "h_g": h_g, "h_r": h_r, "bins": e[:-1]}
+
+
+def bench_histogram(sizes):
+    for size in sizes:
+        case = bench_case(size)
+        legacy, legacy_seconds, peak = measure(_legacy_histogram_data, case.golden, repeat=1)
+        report("histogram_data legacy", size, legacy_seconds, peak)
+        fused, seconds, peak = measure(image_ops.histogram_data, case.golden)
+        same = all(np.array_equal(legacy[k], fused[k]) for k in ("h", "h_b", "h_g", "h_r"))
+        report("histogram_data", size, seconds, peak, "x{:.1f}".format(legacy_seconds / seconds), ok=same)
+
+
+def bench_ssim(sizes):
+    for size in sizes:
+        golden, capture = cropped(bench_case(size))
+        (score, _), seconds, peak = measure(utils.compute_SSIM, golden, capture, repeat=1)
+        report("compute_SSIM", size, seconds, peak, "score {:.6f}".format(score), ok=score < 1.0, score=score)
+        (tiled, _), seconds, peak = measure(utils.compute_SSIM, golden, capture, tile_size=utils.SSIM_TILE_SIZE)
+        delta = abs(score - tiled)
+        report("compute_SSIM tiled", size, seconds, peak, "score {:.6f} delta {:.1e}".format(tiled, delta),
+               ok=delta < 1e-4, score=tiled)
+
+
+def bench_compare(sizes):
+    for size in sizes:
+        case = bench_case(size)
+        golden, capture = cropped(case)
+
+        def run():
+            # compare draws the regions into its images
+            return image_ops.compare(np.copy(golden), np.copy(capture))
+
+        result, seconds, peak = measure(run, repeat=1)
+        check = region_check(result[5], case.truth)
+        report("compare", size, seconds, peak, "recall {recall:.2f} missed {missed} false {false_regions}".format(**check),
+               ok=check["solid"], score=float(result[0]), **check)
+
+
+def bench_workon(sizes):
+    for size in sizes:
+        case = bench_case(size)
+        work_dir = tempfile.mkdtemp(prefix="bench-")
+        try:
+            left = os.path.join(work_dir, "golden.png")
+            right = os.path.join(work_dir, "capture.png")
+            cv2.imwrite(left, case.golden)
+            cv2.imwrite(right, case.capture)
+
+            for lazy in (False, True):
+                (code, result), seconds, peak = measure(image_ops.workon_images, left, right, work_dir, plots=False,
+                                                        histograms=True, lazy_artifacts=lazy, repeat=1)
+                name = "workon_images " + ("lazy" if lazy else "eager")
+                if code != 0:
+                    report(name, size, seconds, peak, result, ok=False)
+                    continue
+                check = region_check(result["regions"], case.truth)
+                timings = " ".join("{} {:.0f}".format(stage, t * 1000) for stage, t in result["timings"].items())
+                report(name, size, seconds, peak, timings,
+                       ok=result["shift"] == case.truth["shift"] and check["solid"],
+                       shift=result["shift"], score=float(result["ssim_score"]), timings=result["timings"], **check)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+BENCHMARKS = {
+    "shift": bench_shift,
+    "border": bench_border_scan,
+    "histogram": bench_histogram,
+    "ssim": bench_ssim,
+    "compare": bench_compare,
+    "workon": bench_workon,
+}
+
+
+def environment():
+    return {
+        "time": time.time(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "algorithm_version": image_ops.ALGORITHM_VERSION,
+    }
+
+
+def write_results(path, benchmarks, sizes):
+    with open(path, 'w') as f:
+        # (numpy scalars as python numbers)
+        json.dump({"environment": environment(), "benchmarks": benchmarks, "sizes": sizes, "results": RESULTS}, f,
+                  indent=1, default=lambda o: o.item())
+
+
+def compare_with_baseline(path, tolerance):
+    """
+    Print the time of every measurement of this run against the same benchmark and size of a baseline run
+    :return: number of measurements slower than the baseline by more than tolerance (a fraction)
+    """
+    with open(path) as f:
+        baseline = {(r["name"], r["size"]): r for r in json.load(f)["results"]}
+
+    regressions = 0
+    print("\n{:<40} {:>6} {:>13} {:>13} {:>7}".format("vs " + os.path.basename(path), "", "baseline", "now", "ratio"))
+    for result in RESULTS:
+        base = baseline.get((result["name"], result["size"]))
+        if base is None or not base["seconds"]:
+            continue
+        ratio = result["seconds"] / base["seconds"]
+        slower = ratio > 1.0 + tolerance
+        regressions += slower
+        print("{:<40} {:>6} {:>10.1f} ms {:>10.1f} ms {:>6.2f}x {}".format(
+            result["name"], result["size"], base["seconds"] * 1000, result["seconds"] * 1000, ratio,
+            "SLOWER" if slower else ""))
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Image compare benchmarks")
+
+    parser.add_argument('benchmarks', nargs='*', default=[], help="benchmarks to run, all by default: {}".format(", ".join(sorted(BENCHMARKS))))
+    parser.add_argument('--sizes', nargs='+', default=["1080p", "4k"], choices=sorted(SIZES), help="image sizes")
+    parser.add_argument('--out', action='store', dest="out", default=None, help="write the results to this JSON file", type=str)
+    parser.add_argument('--baseline', action='store', dest="baseline", default=None, help="JSON results of an earlier run to compare with", type=str)
+    parser.add_argument('--tolerance', action='store', dest="tolerance", default=0.1, help="fraction a benchmark may be slower than the baseline", type=float)
+
+    pargs = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARNING)
+
+    # (not argparse choices: the default of a nargs='*' positional is checked against them as a whole and fails)
+    unknown = [name for name in pargs.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error("unknown benchmarks {}, choose from {}".format(", ".join(unknown), ", ".join(sorted(BENCHMARKS))))
+
+    benchmarks = pargs.benchmarks or sorted(BENCHMARKS)
+    for name in benchmarks:
+        BENCHMARKS[name](pargs.sizes)
+
+    if pargs.out:
+        write_results(pargs.out, benchmarks, pargs.sizes)
+
+    failed = [r for r in RESULTS if r["ok"] is False]
+    regressions = compare_with_baseline(pargs.baseline, pargs.tolerance) if pargs.baseline else 0
+
+    if failed:
+        print("\n{} measurements do not match the ground truth".format(len(failed)))
+        sys.exit(1)
+    sys.exit(2 if regressions else 0)
@@ -0,0 +1,164 @@
+import collections
+import logging
+import os
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _nbytes(value, seen):
+    """
+    Bytes of the arrays in value - an array, or dicts, lists and tuples of them (a tile pyramid is a list). The memory
+    of an array is counted once however many views of it there are: level 0 of a pyramid is the image itself.
+    :param seen: ids of the arrays already counted
+    """
+    if isinstance(value, np.ndarray):
+        while isinstance(value.base, np.ndarray):
+            value = value.base
+        if id(value) in seen:
+            return 0
+        seen.add(id(value))
+        return value.nbytes
+    if isinstance(value, dict):
+        value = value.values()
+    elif not isinstance(value, (list, tuple)):
+        return 0
+    return sum(_nbytes(v, seen) for v in value)
+
+
+class DecodedImage:
+    """
+    A decoded image plus what the diff pipeline derives from the whole frame, each computed on first use.
+    The arrays are shared between jobs and must not be modified.
+    """
+
+    def __init__(self, image):
+        self.image = image
+        self._derived = {}
+
+    def get(self, name, fn):
+        """
+        Derived value name, fn(image) computes it when it is not known yet
+        """
+        if name not in self._derived:
+            self._derived[name] = fn(self.image)
+        return self._derived[name]
+
+    @property
+    def gray(self):
+        return self.get("gray", lambda image: cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
+
+    @property
+    def nbytes(self):
+        seen = set()
+        return _nbytes(self.image, seen) + _nbytes(self._derived, seen)
+
+
+class DecodedImageCache:
+    """
+    LRU of decoded images, bounded by the bytes held (images and their derived data).
+
+    An entry is keyed by path + mtime + size so an image that is uploaded again under the same name is decoded again.
+    One cache lives in each worker process (see configure); the server sends the jobs of a session to the same worker
+    so repeated computations on a pair find it decoded.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path):
+        """
+        :return: DecodedImage or None if opencv can not load the image
+        """
+        st = os.stat(path)
+        key = (path, st.st_mtime_ns, st.st_size)
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        image = cv2.imread(path)
+        if image is None:
+            return None
+
+        # an older version of the same file is dead weight
+        for old in [k for k in self._entries if k[0] == path]:
+            del self._entries[old]
+
+        # shared by every job that hits the entry
+        image.flags.writeable = False
+        entry = DecodedImage(image)
+        self._entries[key] = entry
+        self.trim()
+        return entry
+
+    def trim(self):
+        """
+        Evict the least recently used entries until the cache fits max_bytes again. Derived data grows entries after
+        they were added, so this is also called when a job is done with them.
+        """
+        total = self.nbytes()
+        while total > self.max_bytes and len(self._entries) > 1:
+            _, entry = self._entries.popitem(last=False)
+            total -= entry.nbytes
+            self.evictions += 1
+
+    def nbytes(self):
+        return sum(entry.nbytes for entry in self._entries.values())
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "pid": os.getpid(),
+            "entries": len(self._entries),
+            "bytes": self.nbytes(),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+# the cache of this worker process, None until configure is called
+_cache = None
+
+
+def configure(max_bytes):
+    """
+    Called in each worker process when the pool starts, 0 disables the cache
+    """
+    global _cache
+    _cache = DecodedImageCache(max_bytes) if max_bytes > 0 else None
+    return os.getpid()
+
+
+def load(path):
+    """
+    Decode an image through the worker cache, or straight from the file when there is none
+    :return: DecodedImage or None if opencv can not load the image
+    """
+    if _cache is None:
+        image = cv2.imread(path)
+        return DecodedImage(image) if image is not None else None
+    return _cache.get(path)
+
+
+def done():
+    # a job finished with its images - their derived data may have pushed the cache over its limit
+    if _cache is not None:
+        _cache.trim()
+
+
+def stats():
+    return _cache.stats() if _cache is not None else {"pid": os.getpid(), "enabled": False}
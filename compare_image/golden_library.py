@@ -0,0 +1,235 @@
+"""
+Library of golden images with perceptual hashes, to find the golden image a capture shows.
+
+Every golden image gets three 64 bit perceptual hashes when it is added (see image_hashes); the distance of two
+images is the sum of the Hamming distances of their hashes, 0 (same picture) to 192. The index is one JSON line per
+golden image in <library_dir>/index.jsonl - appended, so adding is cheap and an interrupted write loses at most its
+own line - and the images are kept as <library_dir>/images/<id><ext>.
+
+In memory the hashes of all golden images are one (3, n) uint64 array, a row per hash. A lookup XORs the capture's hashes against
+all of them and counts the bits (see popcount): a few milliseconds for 100000 golden images, however far the best
+match is (a BK-tree is only fast when there is a close match).
+"""
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+import cv2
+import numpy as np
+
+import decoded_cache
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = "index.jsonl"
+IMAGES_DIR = "images"
+
+HASHES = ("ahash", "dhash", "phash")
+
+
+def popcount(x):
+    """
+    Number of set bits of every element of a uint64 array, computed in place (x is overwritten) - the parallel bit
+    count, a handful of vectorized integer operations instead of a table lookup per byte
+    """
+    y = x >> np.uint64(1)
+    y &= np.uint64(0x5555555555555555)
+    x -= y
+    y = x >> np.uint64(2)
+    y &= np.uint64(0x3333333333333333)
+    x &= np.uint64(0x3333333333333333)
+    x += y
+    x += x >> np.uint64(4)
+    x &= np.uint64(0x0f0f0f0f0f0f0f0f)
+    x *= np.uint64(0x0101010101010101)
+    x >>= np.uint64(56)
+    return x
+
+
+def _hex(bits):
+    # 64 booleans -> 16 hex digits, first bit most significant
+    return np.packbits(bits.ravel()).tobytes().hex()
+
+
+def ahash(gray):
+    """
+    Average hash: which pixels of the 8x8 thumbnail are brighter than its mean
+    """
+    small = cv2.resize(gray, (8, 8), interpolation=cv2.INTER_AREA)
+    return _hex(small > small.mean())
+
+
+def dhash(gray):
+    """
+    Difference hash: which pixels of the 9x8 thumbnail are brighter than their left neighbour
+    """
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    return _hex(small[:, 1:] > small[:, :-1])
+
+
+def phash(gray):
+    """
+    DCT hash: which of the 8x8 lowest frequencies of the 32x32 thumbnail are above their median (the DC term left out)
+    """
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8]
+    return _hex(low > np.median(low.ravel()[1:]))
+
+
+def image_hashes(gray):
+    """
+    :return: {"ahash", "dhash", "phash"} of a grayscale image, 16 hex digits each
+    """
+    return {"ahash": ahash(gray), "dhash": dhash(gray), "phash": phash(gray)}
+
+
+def file_hashes(path, cached=False):
+    """
+    Runs in a worker: the perceptual hashes of the image at path
+    :param cached: decode through the worker's decoded image cache - for an upload the diff will use, not for golden
+                   images that are only hashed
+    :raise ValueError: when the image can not be loaded
+    """
+    if cached:
+        decoded = decoded_cache.load(path)
+        if decoded is None:
+            raise ValueError("Image could not be loaded into opencv")
+        return decoded.get("perceptual_hashes", lambda image: image_hashes(decoded.gray))
+
+    image = cv2.imread(path)
+    if image is None:
+        raise ValueError("Image could not be loaded into opencv")
+    return image_hashes(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
+
+
+def _as_row(hashes):
+    return [int(hashes[name], 16) for name in HASHES]
+
+
+class GoldenLibrary:
+    """
+    The golden images and their hash index. add does file IO and is meant to be called from a thread executor;
+    match is fast enough for the event loop.
+    """
+
+    def __init__(self, library_dir):
+        self.library_dir = library_dir
+        self.images_dir = os.path.join(library_dir, IMAGES_DIR)
+        self.index_path = os.path.join(library_dir, INDEX_FILE)
+
+        self.lookups = 0
+        self.lookup_time = 0.0
+
+        self._lock = threading.Lock()
+        self._goldens = []          # records in index order, column i of _hashes is _goldens[i]
+        self._by_id = {}
+        self._by_sha256 = {}
+        self._hashes = np.zeros((len(HASHES), 0), dtype=np.uint64)
+
+        if not os.path.exists(self.images_dir):
+            os.makedirs(self.images_dir)
+
+        self._load_index()
+
+    def _load_index(self):
+        records = []
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, 'r') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # the line of an interrupted add
+                        logger.warning("Golden library {}: skipping a broken index line".format(self.index_path))
+
+        for record in records:
+            if os.path.isfile(os.path.join(self.images_dir, record["filename"])):
+                self._append(record)
+
+        logger.info("Golden library {} images: {}".format(self.library_dir, len(self._goldens)))
+
+    def _append(self, record):
+        n = len(self._goldens)
+        if n == self._hashes.shape[1]:
+            # grow by doubling so adding many images stays linear
+            grown = np.zeros((len(HASHES), max(1024, 2 * n)), dtype=np.uint64)
+            grown[:, :n] = self._hashes
+            self._hashes = grown
+        self._hashes[:, n] = _as_row(record["hashes"])
+        self._goldens.append(record)
+        self._by_id[record["id"]] = record
+        if record["info"].get("sha256"):
+            self._by_sha256[record["info"]["sha256"]] = record
+
+    def add(self, path, name, info, hashes):
+        """
+        Move the uploaded image at path into the library - an image that is already in it (same sha256) is not
+        added again
+        :param name: file name of the golden image
+        :param info: uploads.save_part result of the image
+        :param hashes: image_hashes of the image
+        :return: the record of the golden image {"id", "name", "filename", "hashes", "info", "added"}
+        """
+        with self._lock:
+            existing = self._by_sha256.get(info.get("sha256"))
+            if existing is not None:
+                os.remove(path)
+                return existing
+
+            golden_id = uuid.uuid4().hex
+            filename = golden_id + os.path.splitext(name)[1].lower()
+            os.replace(path, os.path.join(self.images_dir, filename))
+
+            record = {"id": golden_id, "name": name, "filename": filename, "hashes": hashes, "info": info,
+                      "added": time.time()}
+            with open(self.index_path, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+            self._append(record)
+            return record
+
+    def __len__(self):
+        return len(self._goldens)
+
+    def get(self, golden_id):
+        return self._by_id.get(golden_id)
+
+    def image_path(self, record):
+        return os.path.join(self.images_dir, record["filename"])
+
+    def match(self, hashes, k=5):
+        """
+        The golden images nearest to an image
+        :param hashes: image_hashes of the image
+        :return: up to k [{"id", "name", "distance", "distances": {hash name: distance}}], nearest first
+        """
+        t0 = time.time()
+        with self._lock:
+            n = len(self._goldens)
+            table = self._hashes[:, :n]
+            goldens = self._goldens[:n]
+        if n == 0 or k <= 0:
+            return []
+
+        query = np.array(_as_row(hashes), dtype=np.uint64)
+        distances = popcount(np.bitwise_xor(table, query[:, None]))
+        total = distances.sum(axis=0)
+
+        k = min(k, n)
+        nearest = np.argpartition(total, k - 1)[:k]
+        nearest = nearest[np.argsort(total[nearest], kind="mergesort")]
+
+        self.lookups += 1
+        self.lookup_time += time.time() - t0
+        return [{"id": goldens[i]["id"], "name": goldens[i]["name"], "distance": int(total[i]),
+                 "distances": {name: int(d) for name, d in zip(HASHES, distances[:, i])}} for i in nearest]
+
+    def stats(self):
+        return {
+            "goldens": len(self._goldens),
+            "index_bytes": os.path.getsize(self.index_path) if os.path.isfile(self.index_path) else 0,
+            "lookups": self.lookups,
+            "lookup_time_avg": self.lookup_time / self.lookups if self.lookups else 0.0,
+        }
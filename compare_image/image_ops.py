@@ -6,8 +6,17 @@ import numpy as np
 
 logger = logging.getLogger(__name__)
 
+# bump whenever a change to the pipeline alters its results so cached results are not reused
+ALGORITHM_VERSION = 6
+
+import artifacts
+import decoded_cache
+import prechecks
+from metrics import compute_metrics, identical_metrics
+import shared_images
+import telemetry
 import utils
-import imutils
+from regions import draw_regions, find_regions, threshold
 
 from bokeh.models import (FactorRange, LinearAxis, Grid,
                           Range1d)
@@ -73,22 +82,48 @@ def plot_histogram(data):
     return script, div
 
 
+# a histogram pass works on blocks of about this many values so the temporaries stay small
+HISTOGRAM_BLOCK_SIZE = 1 << 20
+
+
 def histogram_data(image):
-    h = None
-    h_b = None
-    h_g = None
-    h_r = None
+    """
+    256 bin histograms of an image: "h" over all the values and "h_b", "h_g", "h_r" per channel.
+    For a uint8 image everything comes out of a single bincount pass: each value is offset by 256 * its channel
+    index so the per channel histograms land side by side in one array, and "h" is their sum.
+    :param image: uint8 image, (rows, cols, 3) or (rows, cols)
+    :return: {"h", "h_b", "h_g", "h_r", "bins"} - the channel histograms are None for a single channel image
+    """
+    bins = np.arange(256)
+
+    if image.dtype != np.uint8:
+        h, e = np.histogram(image, bins=np.arange(257))
+        h_b, h_g, h_r = None, None, None
+        if image.ndim == 3 and image.shape[2] == 3:
+            h_b, h_g, h_r = [np.histogram(image[:, :, c], bins=np.arange(257))[0] for c in range(3)]
+        return {"h": h, "h_b": h_b, "h_g": h_g, "h_r": h_r, "bins": bins}
+
+    channels = image.shape[2] if image.ndim == 3 else 1
+    row_size = image.shape[1] * channels
+    block_rows = max(1, HISTOGRAM_BLOCK_SIZE // max(1, row_size))
 
+    # value + 256 * channel for a block of rows laid out (row, col, channel)
+    offsets = np.tile(np.arange(0, 256 * channels, 256, dtype=np.uint16), block_rows * image.shape[1])
 
-    h, e = np.histogram(image, bins=[x for x in range(257)])
+    counts = np.zeros(256 * channels, dtype=np.int64)
+    for r in range(0, image.shape[0], block_rows):
+        # reshape only copies when the image is a cropped view, and then just this block
+        block = image[r:r + block_rows].reshape(-1)
+        counts += np.bincount(block + offsets[:block.size], minlength=256 * channels)
 
+    counts = counts.reshape(channels, 256)
+    h = counts.sum(axis=0)
 
-    if image.shape[2] == 3:
-        h_b, e = np.histogram(image[:, :, 0], bins=[x for x in range(257)])
-        h_g, e = np.histogram(image[:, :, 1], bins=[x for x in range(257)])
-        h_r, e = np.histogram(image[:, :, 2], bins=[x for x in range(257)])
+    h_b, h_g, h_r = None, None, None
+    if channels == 3:
+        h_b, h_g, h_r = counts[0], counts[1], counts[2]
 
-    return {"h":h, "h_b":h_b, "h_g":h_g, "h_r":h_r, "bins": e[:-1]}
+    return {"h": h, "h_b": h_b, "h_g": h_g, "h_r": h_r, "bins": bins}
 
 
 def make_histogram_plot(data):
@@ -162,49 +197,114 @@ def make_histogram_diff_plot(ldata, rdata):
     p.title.text = "left - right"
     return p
 
-def compare(img1, img2):
+def changed_regions(img1, img2, gray1=None, gray2=None, ssim_tile_size=None, rois=None, region_min_area=0,
+                    region_merge_distance=0, stages=None):
     """
-
-    :param img1:
-    :param img2:
-    :return: ssim score, marked up image1, marked up image2, diff image and threshold image
+    SSIM of two images of the same shape and the regions where they differ: the SSIM map thresholded with Otsu,
+    its connected components as boxes
+    :param ssim_tile_size: see utils.compute_SSIM
+    :param rois: see utils.compute_SSIM
+    :param gray1: grayscale of img1 if it is already known
+    :param gray2: grayscale of img2 if it is already known
+    :param region_min_area: see regions.find_regions
+    :param region_merge_distance: see regions.find_regions
+    :param stages: telemetry.Stages timing the "ssim" and "regions" stages
+    :return: ssim score, diff image (uint8 SSIM map), threshold image, the changed regions [(x, y, w, h)]
     """
+    stages = stages or telemetry.Stages()
 
-    ssim, diff = utils.compute_SSIM(img1, img2)
+    with stages("ssim"):
+        ssim, diff = utils.compute_SSIM(img1, img2, gray1=gray1, gray2=gray2, tile_size=ssim_tile_size, rois=rois)
 
+    with stages("regions"):
+        diff = (diff * 255).astype("uint8")
+        thresh = threshold(diff)
+        regions = find_regions(thresh, min_area=region_min_area, merge_distance=region_merge_distance)
 
-    diff = (diff * 255).astype("uint8")
+    return ssim, diff, thresh, regions
 
-    thresh = cv2.threshold(diff, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
 
-    cnts = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+def compare(img1, img2, ssim_tile_size=None, rois=None, gray1=None, gray2=None, region_min_area=0,
+            region_merge_distance=0, stages=None):
+    """
+    changed_regions, with the regions drawn on both images
+    :param stages: telemetry.Stages timing the "ssim", "regions" and "draw" stages
+    :return: ssim score, marked up image1, marked up image2, diff image, threshold image and the changed regions
+    """
+    stages = stages or telemetry.Stages()
 
-    cnts = cnts[0] if imutils.is_cv2() else cnts[1]
+    ssim, diff, thresh, regions = changed_regions(img1, img2, gray1, gray2, ssim_tile_size, rois, region_min_area,
+                                                  region_merge_distance, stages)
 
-    for c in cnts:
-        (x, y, w, h) = cv2.boundingRect(c)
-        cv2.rectangle(img1, (x, y), (x + w, y + h), (0, 0, 255), 2)
-        cv2.rectangle(img2, (x, y), (x + w, y + h), (0, 0, 255), 2)
+    with stages("draw"):
+        draw_regions([img1, img2], regions)
 
-    return ssim, img1, img2, diff, thresh
+    return ssim, img1, img2, diff, thresh, regions
 
 def _fname(p):
     return os.path.splitext(os.path.basename(p))[0]
 
-def workon_images(left, right, upload_dir):
+def artifact_names(left, right, upload_dir, formats=None):
+    """
+    Full paths of the artifacts workon_images writes for a left/right pair
+    :param formats: see artifacts.parse_formats, the extensions follow the formats
+    :return: {"minus", "diff", "thresh", "marked_l", "marked_r", "outputs"} -> path
+    """
+    def ext(role):
+        return artifacts.extension(role, formats)
+
+    return {
+        "minus":    os.path.join(upload_dir, "{}_minus_{}{}".format(_fname(left), _fname(right), ext("minus"))),
+        "diff":     os.path.join(upload_dir, "{}_diff_{}{}".format(_fname(left), _fname(right), ext("diff"))),
+        "thresh":   os.path.join(upload_dir, "{}_thresh_{}{}".format(_fname(left), _fname(right), ext("thresh"))),
+        "marked_l": os.path.join(upload_dir, "{}_lmarked{}".format(_fname(left), ext("marked_l"))),
+        "marked_r": os.path.join(upload_dir, "{}_rmarked{}".format(_fname(right), ext("marked_r"))),
+        "outputs":  os.path.join(upload_dir, "{}_outputs_{}.npz".format(_fname(left), _fname(right))),
+    }
+
+def workon_images(left, right, upload_dir, shift_method="full", shift_precheck=True, write_artifacts=True, plots=True,
+                  ssim_tile_size=None, rois=None, lazy_artifacts=False, artifact_formats=None, histograms=False,
+                  region_min_area=0, region_merge_distance=0, precheck=True, near_identical=0.0, digests=None,
+                  metrics=None, near_identical_max=prechecks.NOISE_LEVEL):
     """
 
     :param left:
     :param right:
     :param upload_dir:
+    :param shift_method: shift detection method passed to utils.detect_shift_using_correlation ("full" or "pyramid")
+    :param shift_precheck: skip shift detection when neither image has a black bar along its edges
+    :param write_artifacts: write the minus/diff/thresh/marked images into upload_dir
+    :param plots: build the bokeh histogram plots
+    :param histograms: return the histogram counts (see histogram_counts) - what the page draws its charts from
+    :param ssim_tile_size: compute the SSIM tile by tile (bounded memory for very large images), None for one pass
+    :param rois: only compare these regions of the (shift corrected) images, list of (x, y, w, h)
+    :param lazy_artifacts: do not encode the artifact images, save what they are rendered from; each one is
+                           rendered when it is first requested (see artifacts.render_pending)
+    :param artifact_formats: file format per artifact, see artifacts.parse_formats - png by default
+    :param region_min_area: ignore changed regions whose box is smaller than this many pixels
+    :param region_merge_distance: merge changed regions at most this many pixels apart into one box
+    :param precheck: settle identical pairs early, before the expensive stages (see prechecks) - such a pair has
+                     no artifacts
+    :param near_identical: mean absolute difference (0-255) up to which a pair is settled as near identical
+    :param near_identical_max: largest difference of a pixel (0-255) in a pair settled as near identical
+    :param digests: (left sha256, right sha256) of the files if known, otherwise the precheck compares the files
+    :param metrics: names of the metrics (see metrics.REGISTRY) to compute on the (shift corrected) images
     :return:
         { "ssim_score":
+            "shift":   [start_row, end_row, start_col, end_col] removed from the images before comparing them
+            "regions": [[x, y, w, h], ...] boxes around the changed regions, with write_artifacts
+            "outputs": <name of what the artifacts are rendered from> with lazy_artifacts
             "diff":    <diff image name> optional
             "thresh"   <thresh image name> optional
             "marked_l" <marked left image name> optional
             "marked_r"  <marked right iamge name> optional
             "histogram" <dual histogram plot {"div","script"} for left image and right image>
             "diff_histogram" {"div","script"} <single histogram plot
+            "histograms" <histogram counts of the left and right image> with histograms
+            "settled_by": <prechecks tier that settled the pair: "hash", "pixels", "near_identical" or "full">
+            "mean_abs_diff": <mean absolute difference of the images> when a precheck settled the pair
+            "metrics": {<name>: <value>} of the metrics asked for
+            "timings": {<stage>: <seconds>} where the computation spent its time (see telemetry)
         }
 
     """
@@ -212,13 +312,98 @@ def workon_images(left, right, upload_dir):
     if not os.path.isfile(left) or not os.path.isfile(right):
         return 1, "Files were not found"
 
-    l = cv2.imread(left)
-    r = cv2.imread(right)
+    stages = telemetry.Stages()
+
+    with stages("precheck"):
+        identical_files = precheck and prechecks.same_file(left, right, digests)
+
+    # decoded through the worker's decoded image cache - a pair computed again is not decoded again
+    with stages("decode"):
+        l = decoded_cache.load(left)
+        r = l if identical_files else decoded_cache.load(right)
 
 
     if l is None or r is None:
         return 1, "Images could not be loaded into opencv"
 
+    try:
+        return _workon(l, r, left, right, upload_dir, shift_method=shift_method, shift_precheck=shift_precheck,
+                       write_artifacts=write_artifacts, plots=plots, histograms=histograms, ssim_tile_size=ssim_tile_size,
+                       rois=rois, lazy_artifacts=lazy_artifacts, artifact_formats=artifact_formats,
+                       region_min_area=region_min_area, region_merge_distance=region_merge_distance,
+                       precheck=precheck, near_identical=near_identical, near_identical_max=near_identical_max,
+                       identical_files=identical_files, metrics=metrics, stages=stages)
+    finally:
+        decoded_cache.done()
+
+
+def workon_shared_images(left_handle, right_handle, left, right, upload_dir, shift_method="full", shift_precheck=True,
+                         write_artifacts=True, ssim_tile_size=None, rois=None, lazy_artifacts=False,
+                         artifact_formats=None, region_min_area=0, region_merge_distance=0, precheck=True,
+                         near_identical=0.0, digests=None, metrics=None, near_identical_max=prechecks.NOISE_LEVEL):
+    """
+    workon_images on images the server already decoded into shared segments (see shared_images.SegmentStore).
+    left and right are still the file paths, they name the artifacts.
+    Instead of the bokeh plots the result holds the histogram counts, "histograms" (see histogram_counts).
+    """
+    stages = telemetry.Stages()
+
+    with stages("precheck"):
+        identical_files = precheck and prechecks.same_file(left, right, digests)
+
+    with stages("decode"):
+        l = decoded_cache.DecodedImage(shared_images.attach(left_handle))
+        r = l if identical_files else decoded_cache.DecodedImage(shared_images.attach(right_handle))
+
+    return _workon(l, r, left, right, upload_dir, shift_method=shift_method, shift_precheck=shift_precheck,
+                   write_artifacts=write_artifacts, plots=False, histograms=True, ssim_tile_size=ssim_tile_size,
+                   rois=rois, lazy_artifacts=lazy_artifacts, artifact_formats=artifact_formats,
+                   region_min_area=region_min_area, region_merge_distance=region_merge_distance,
+                   precheck=precheck, near_identical=near_identical, near_identical_max=near_identical_max,
+                   identical_files=identical_files, metrics=metrics, stages=stages)
+
+
+def histogram_plots(l_histogram, r_histogram):
+    """
+    :return: the "histogram" and "diff_histogram" plots of workon_images, {"script", "div"} each
+    """
+    histogram = {}
+    diff_histogram = {}
+    histogram["script"], histogram["div"] = components(make_side_by_side_histogram_plot(l_histogram, r_histogram))
+    diff_histogram["script"], diff_histogram["div"] = components(make_histogram_diff_plot(l_histogram, r_histogram))
+    return histogram, diff_histogram
+
+
+def histogram_counts(l_histogram, r_histogram):
+    """
+    The left and right histograms (see histogram_data) as plain lists, a few KB of JSON:
+    {"left": {"h", "b", "g", "r"}, "right": {"h", "b", "g", "r"}} - 256 counts each, the per channel counts are
+    left out for a single channel image
+    """
+    def counts(data):
+        c = {"h": data["h"].tolist()}
+        for channel in ("b", "g", "r"):
+            if data["h_" + channel] is not None:
+                c[channel] = data["h_" + channel].tolist()
+        return c
+
+    return {"left": counts(l_histogram), "right": counts(r_histogram)}
+
+
+def _workon(left_image, right_image, left, right, upload_dir, shift_method="full", shift_precheck=True,
+            write_artifacts=True, plots=True, histograms=False, ssim_tile_size=None, rois=None, lazy_artifacts=False,
+            artifact_formats=None, region_min_area=0, region_merge_distance=0, precheck=True, near_identical=0.0,
+            identical_files=False, metrics=None, stages=None, near_identical_max=prechecks.NOISE_LEVEL):
+    # the pipeline of workon_images on decoded_cache.DecodedImage's - whole frame data (grayscale, black bars,
+    # histograms) comes from them so a cached image only computes it once
+    stages = stages or telemetry.Stages()
+
+    l = left_image.image
+    r = right_image.image
+    with stages("gray"):
+        l_gray = left_image.gray
+        r_gray = right_image.gray
+
     minus_filename = None
 
     # get thes sizes of the image
@@ -228,62 +413,305 @@ def workon_images(left, right, upload_dir):
     # rstat["rows"] = r.shape[0]
     # rstat["cols"] = r.shape[1]
 
-    result = {}
+    result = {"timings": stages.seconds}
 
     logger.debug("left image w: {} h: {}  right image w:{} h: {}".format(l.shape[1], l.shape[0], r.shape[1], r.shape[0]))
 
     # if the images are the same size then we can do certain compare operations
     if l.shape[0] == r.shape[0] and l.shape[1] == r.shape[1]:
-        # detect shift
-        sr, er, sc, ec = utils.detect_shift_using_correlation(l, r)
-
-        if sr != 0 or er != 0 or sc != 0 or ec != 0:
+        if precheck:
+            with stages("precheck"):
+                if identical_files:
+                    settled_by, mad = prechecks.HASH, 0.0
+                elif l.shape == r.shape:
+                    settled_by, mad = prechecks.compare_pixels(left_image, right_image, near_identical,
+                                                               near_identical_max)
+                else:
+                    settled_by, mad = None, None
+            if settled_by is not None:
+                logger.info("Settled by the {} precheck, mean absolute difference {}".format(settled_by, mad))
+                return 0, _settled(left_image, right_image, settled_by, mad, plots, histograms, metrics, stages)
+
+        result["settled_by"] = prechecks.FULL
+
+        # detect shift - a shifted image has black bars, no black bars means there is nothing to correlate
+        sr, er, sc, ec = 0, 0, 0, 0
+        with stages("shift"):
+            if not shift_precheck or left_image.get("has_black_bars", utils.has_black_bars) \
+                    or right_image.get("has_black_bars", utils.has_black_bars):
+                sr, er, sc, ec = utils.detect_shift_using_correlation(l, r, method=shift_method)
+            else:
+                logger.debug("No black bars - skipping shift detection")
+
+        shifted = sr != 0 or er != 0 or sc != 0 or ec != 0
+        if shifted:
             # shift detection using black bars  -- since we know the input pattern otherwise need to use fft method
 
             logger.debug("Shift detected sr: {} er: {} sc: {} ec: {}".format(sr, er, sc, ec))
 
             r = utils.capture_remove_shift(r, sr, er, sc, ec)
             l = utils.golden_remove_shift(l, sr, er, sc, ec)
+            r_gray = utils.capture_remove_shift(r_gray, sr, er, sc, ec)
+            l_gray = utils.golden_remove_shift(l_gray, sr, er, sc, ec)
+
+        result["shift"] = [sr, er, sc, ec]
+
+        if write_artifacts and lazy_artifacts:
+            names = artifact_names(left, right, upload_dir, artifact_formats)
+
+            # only what the artifacts are rendered from is saved - encoding them is left to their first request
+            ssim, diff, _, regions = changed_regions(l, r, l_gray, r_gray, ssim_tile_size, rois, region_min_area,
+                                                     region_merge_distance, stages)
+
+            with stages("artifacts"):
+                artifacts.save_outputs(names["outputs"], diff, regions, result["shift"])
+                for role in artifacts.ROLES:
+                    artifacts.write_pending(names[role], role, names["outputs"], left, right, artifact_formats)
+
+            result["ssim_score"] = ssim
+            result["regions"] = [list(box) for box in regions]
+            result["outputs"] = os.path.basename(names["outputs"])
+            result["minus"] = names["minus"]
+            for role in ("diff", "thresh", "marked_l", "marked_r"):
+                result[role] = os.path.basename(names[role])
+        elif write_artifacts:
+            names = artifact_names(left, right, upload_dir, artifact_formats)
+
+            # straight forward image subtraction
+            #save the diff image in the upload_dir using <left_filename>_minus_<right_filename>
+            minus_filename = names["minus"]
+            with stages("artifacts"):
+                artifacts.write(minus_filename, cv2.absdiff(l, r), "minus", artifact_formats)
+            result["minus"] = minus_filename
+
+            # compute diff using SSIM
+            marked_l = np.copy(l)
+            marked_r = np.copy(r)
+
+            ssim, marked_l, marked_r, diff, thresh, regions = compare(marked_l, marked_r, ssim_tile_size=ssim_tile_size,
+                                                                      rois=rois, gray1=l_gray, gray2=r_gray,
+                                                                      region_min_area=region_min_area,
+                                                                      region_merge_distance=region_merge_distance,
+                                                                      stages=stages)
+
+            diff_filename = names["diff"]
+            thresh_filename = names["thresh"]
+            marked_l_filename = names["marked_l"]
+            marked_r_filename = names["marked_r"]
+            with stages("artifacts"):
+                artifacts.write(diff_filename, diff, "diff", artifact_formats)
+                artifacts.write(thresh_filename, thresh, "thresh", artifact_formats)
+                artifacts.write(marked_l_filename, marked_l, "marked_l", artifact_formats)
+                artifacts.write(marked_r_filename, marked_r, "marked_r", artifact_formats)
+
+            result["ssim_score"] = ssim
+            result["regions"] = [list(box) for box in regions]
+            result["diff"]   = os.path.basename(diff_filename)
+            result["thresh"] = os.path.basename(thresh_filename)
+            result["marked_l"] = os.path.basename(marked_l_filename)
+            result["marked_r"] = os.path.basename(marked_r_filename)
+        else:
+            with stages("ssim"):
+                ssim, diff = utils.compute_SSIM(l, r, gray1=l_gray, gray2=r_gray, tile_size=ssim_tile_size, rois=rois)
+            result["ssim_score"] = ssim
+
+        logger.info(f"Computed SSIM {ssim}")
 
+        if metrics:
+            with stages("metrics"):
+                result["metrics"] = compute_metrics(metrics, l, r, l_gray, r_gray)
 
-        # straight forward image subtraction
-        #save the diff image in the upload_dir using <left_filename>_minus_<right_filename>
-        minus_filename = os.path.join(upload_dir, "{}_minus_{}.png".format(_fname(left), _fname(right)))
-        cv2.imwrite(minus_filename, l - r)
-        result["minus"] = minus_filename
+    if not plots and not histograms:
+        return 0, result
 
-        # compute diff using SSIM
-        marked_l = np.copy(l)
-        marked_r = np.copy(r)
+    # histograms of the left and right images - computed once, used by both plots
+    with stages("histograms"):
+        if l.shape == left_image.image.shape and r.shape == right_image.image.shape:
+            l_histogram = left_image.get("histogram", histogram_data)
+            r_histogram = right_image.get("histogram", histogram_data)
+        else:
+            l_histogram = histogram_data(l)
+            r_histogram = histogram_data(r)
 
-        ssim, marked_l, marked_r, diff, thresh = compare(marked_l, marked_r)
+        if histograms:
+            result["histograms"] = histogram_counts(l_histogram, r_histogram)
 
-        diff_filename = os.path.join(upload_dir, "{}_diff_{}.png".format(_fname(left), _fname(right)))
-        thresh_filename = os.path.join(upload_dir, "{}_thresh_{}.png".format(_fname(left), _fname(right)))
-        marked_l_filename = os.path.join(upload_dir, "{}_lmarked.png".format(_fname(left)))
-        marked_r_filename = os.path.join(upload_dir, "{}_rmarked.png".format(_fname(right)))
-        cv2.imwrite(diff_filename, diff)
-        cv2.imwrite(thresh_filename, thresh)
-        cv2.imwrite(marked_l_filename, marked_l)
-        cv2.imwrite(marked_r_filename, marked_r)
+    if plots:
+        with stages("plots"):
+            result["histogram"], result["diff_histogram"] = histogram_plots(l_histogram, r_histogram)
 
-        result["ssim_score"] = ssim
-        result["diff"]   = os.path.basename(diff_filename)
-        result["thresh"] = os.path.basename(thresh_filename)
-        result["marked_l"] = os.path.basename(marked_l_filename)
-        result["marked_r"] = os.path.basename(marked_r_filename)
+    return 0, result
 
-        logger.info(f"Computed SSIM {ssim}")
 
+def _settled(left_image, right_image, settled_by, mad, plots, histograms, metrics=None, stages=None):
+    # the result of a pair a precheck settled: nothing to shift, no changed regions, no artifacts - the SSIM of a
+    # near identical pair is estimated on the downscaled images
+    stages = stages or telemetry.Stages()
+    result = {"ssim_score": 1.0, "shift": [0, 0, 0, 0], "regions": [], "settled_by": settled_by, "mean_abs_diff": mad,
+              "timings": stages.seconds}
+    if settled_by == prechecks.NEAR_IDENTICAL:
+        with stages("ssim"):
+            result["ssim_score"] = float(utils.compute_SSIM(left_image.get("small", prechecks.small),
+                                                            right_image.get("small", prechecks.small))[0])
 
-    # histograms of the left and right images
-    histogram = {}
-    diff_histogram = {}
-    histogram["script"], histogram["div"] = components(make_side_by_side_histogram_plot(histogram_data(l),histogram_data(r)))
-    diff_histogram["script"], diff_histogram["div"] = components(make_histogram_diff_plot(histogram_data(l), histogram_data(r)))
+    if metrics:
+        with stages("metrics"):
+            if mad == 0:
+                result["metrics"] = identical_metrics(metrics, left_image.image)
+            else:
+                result["metrics"] = compute_metrics(metrics, left_image.image, right_image.image, left_image.gray,
+                                                    right_image.gray)
 
+    if not plots and not histograms:
+        return result
 
-    result["histogram"] = histogram
-    result["diff_histogram"] = diff_histogram
+    with stages("histograms"):
+        l_histogram = left_image.get("histogram", histogram_data)
+        r_histogram = l_histogram if mad == 0 else right_image.get("histogram", histogram_data)
 
-    return 0, result
+        if histograms:
+            result["histograms"] = histogram_counts(l_histogram, r_histogram)
+
+    if plots:
+        with stages("plots"):
+            result["histogram"], result["diff_histogram"] = histogram_plots(l_histogram, r_histogram)
+
+    return result
+
+
+# ######################################################################################################################
+# one golden image against many captures
+# ######################################################################################################################
+
+# per worker process: the golden image last used by compare_to_golden (one at a time to bound memory)
+_golden_cache = {}
+
+
+def prepare_golden(golden, prepared_dir):
+    """
+    Decode the golden image once and save what every capture comparison needs (decoded image, grayscale, histograms)
+    as raw .npy files in prepared_dir. Workers memory map them instead of decoding the golden image again.
+    :return: 0, {"width", "height"} or 1, error message
+    """
+    g = cv2.imread(golden)
+    if g is None:
+        return 1, "Golden image could not be loaded into opencv"
+
+    if not os.path.exists(prepared_dir):
+        os.makedirs(prepared_dir)
+
+    h = histogram_data(g)
+    np.save(os.path.join(prepared_dir, "image.npy"), g)
+    np.save(os.path.join(prepared_dir, "gray.npy"), cv2.cvtColor(g, cv2.COLOR_BGR2GRAY))
+    np.save(os.path.join(prepared_dir, "histogram.npy"), np.stack([h["h"], h["h_b"], h["h_g"], h["h_r"]]))
+
+    return 0, {"width": g.shape[1], "height": g.shape[0]}
+
+
+def _load_golden(prepared_dir, shift_method):
+    key = (prepared_dir, os.stat(os.path.join(prepared_dir, "image.npy")).st_mtime, shift_method)
+    if key not in _golden_cache:
+        _golden_cache.clear()
+
+        golden = {
+            "image": np.load(os.path.join(prepared_dir, "image.npy"), mmap_mode='r'),
+            "gray": np.load(os.path.join(prepared_dir, "gray.npy"), mmap_mode='r'),
+            "histogram": np.load(os.path.join(prepared_dir, "histogram.npy")),
+            "spectrum": None,
+        }
+        golden["has_black_bars"] = utils.has_black_bars(golden["image"])
+        if shift_method == "full":
+            golden["spectrum"] = utils.correlation_spectrum(golden["image"])
+        _golden_cache[key] = golden
+
+    return _golden_cache[key]
+
+
+def compare_to_golden(prepared_dir, capture, shift_method="full", shift_precheck=True, ssim_tile_size=None,
+                      region_min_area=0, region_merge_distance=0):
+    """
+    Compare a capture with a golden image prepared by prepare_golden. Nothing is written to disk.
+    capture: path of the capture image, or the decoded capture (a video frame)
+    region_min_area and region_merge_distance: see workon_images
+    :return: 0, {"ssim_score", "shift": [sr, er, sc, ec], "regions": [[x, y, w, h], ...], "histogram_distance",
+                 "timings"} or 1, error message
+    histogram_distance is the fraction of values (0..1) that fall in a different bin in the capture than in the golden
+    image
+    """
+    stages = telemetry.Stages()
+
+    with stages("decode"):
+        golden = _load_golden(prepared_dir, shift_method)
+        l = golden["image"]
+
+        r = cv2.imread(capture) if isinstance(capture, str) else capture
+    if r is None:
+        return 1, "Image could not be loaded into opencv"
+
+    if l.shape != r.shape:
+        return 1, "Capture is {}x{}, golden image is {}x{}".format(r.shape[1], r.shape[0], l.shape[1], l.shape[0])
+
+    sr, er, sc, ec = 0, 0, 0, 0
+    with stages("shift"):
+        if not shift_precheck or golden["has_black_bars"] or utils.has_black_bars(r):
+            if golden["spectrum"] is not None:
+                sr, er, sc, ec = utils.detect_shift_from_spectrum(golden["spectrum"], r)
+            else:
+                sr, er, sc, ec = utils.detect_shift_using_correlation(l, r, method=shift_method)
+
+    with stages("histograms"):
+        r_histogram = histogram_data(r)
+
+    l_gray = golden["gray"]
+    if sr != 0 or er != 0 or sc != 0 or ec != 0:
+        r = utils.capture_remove_shift(r, sr, er, sc, ec)
+        l = utils.golden_remove_shift(l, sr, er, sc, ec)
+        l_gray = utils.golden_remove_shift(l_gray, sr, er, sc, ec)
+
+    ssim, _, _, regions = changed_regions(l, r, gray1=np.ascontiguousarray(l_gray), ssim_tile_size=ssim_tile_size,
+                                          region_min_area=region_min_area,
+                                          region_merge_distance=region_merge_distance, stages=stages)
+
+    h = golden["histogram"][0]
+    histogram_distance = np.abs(h - r_histogram["h"]).sum() / (2.0 * max(1, h.sum()))
+
+    return 0, {
+        "ssim_score": float(ssim),
+        "shift": [sr, er, sc, ec],
+        "regions": [list(box) for box in regions],
+        "histogram_distance": float(histogram_distance),
+        "timings": stages.seconds,
+    }
+
+
+def compare_frames(l, r, shift_method="full", shift_precheck=True, ssim_tile_size=None, region_min_area=0,
+                   region_merge_distance=0):
+    """
+    Compare two decoded images, e.g. the frames of a golden and a captured video. Nothing is written to disk.
+    See compare_to_golden for the parameters.
+    :return: 0, {"ssim_score", "shift": [sr, er, sc, ec], "regions": [[x, y, w, h], ...], "timings"}
+             or 1, error message
+    """
+    stages = telemetry.Stages()
+
+    if l.shape != r.shape:
+        return 1, "Capture is {}x{}, golden image is {}x{}".format(r.shape[1], r.shape[0], l.shape[1], l.shape[0])
+
+    sr, er, sc, ec = 0, 0, 0, 0
+    with stages("shift"):
+        if not shift_precheck or utils.has_black_bars(l) or utils.has_black_bars(r):
+            sr, er, sc, ec = utils.detect_shift_using_correlation(l, r, method=shift_method)
+
+    if sr != 0 or er != 0 or sc != 0 or ec != 0:
+        r = utils.capture_remove_shift(r, sr, er, sc, ec)
+        l = utils.golden_remove_shift(l, sr, er, sc, ec)
+
+    ssim, _, _, regions = changed_regions(l, r, ssim_tile_size=ssim_tile_size, region_min_area=region_min_area,
+                                          region_merge_distance=region_merge_distance, stages=stages)
+
+    return 0, {
+        "ssim_score": float(ssim),
+        "shift": [sr, er, sc, ec],
+        "regions": [list(box) for box in regions],
+        "timings": stages.seconds,
+    }
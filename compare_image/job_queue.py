@@ -0,0 +1,274 @@
+"""
+A durable job queue in a SQLite file, shared by the web front ends and the queue_worker processes of one box.
+
+The in-process worker pool ties the diffs of a front end to its own processes: one container can be saturated while
+another sits idle. With a queue every front end puts its diffs in the same file and any worker process takes the
+next one, so front ends and workers scale independently.
+
+A job is a row. claim() takes the oldest visible job in one write transaction and leases it to the worker for
+visibility_timeout seconds; the worker extends the lease while it computes. A worker that dies stops extending it, the
+job becomes visible again and another worker retries it - at most max_attempts times. A job that raised is retried
+after a delay growing with its attempts. The front end polls the row until it is finished and deletes it. A job
+deleted before its worker starts it is skipped; the computation of a job deleted while it runs can not be interrupted,
+it runs to its end and its result is dropped. Both are counted (stats).
+
+The file is in WAL mode: the polling readers never block the writers. WAL needs shared memory between the processes,
+so the file must be on a local filesystem of the box - a volume shared by the containers, not a network share.
+"""
+import asyncio
+import contextlib
+import functools
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+DEFAULT_VISIBILITY_TIMEOUT = 60
+DEFAULT_MAX_ATTEMPTS = 3
+
+# seconds before a job that raised is retried, times its attempts
+RETRY_DELAY = 5
+
+# seconds between the polls of a waiting front end, doubling from the first to the last
+POLL_INTERVALS = (0.01, 0.25)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    fn TEXT NOT NULL,
+    args TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    visible_at REAL NOT NULL,
+    worker TEXT,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_visible ON jobs (state, visible_at);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+def _log_failed_delete(job_id, future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning("Could not delete job {}, it is purged once finished: {}".format(job_id, future.exception()))
+
+
+class JobFailed(Exception):
+    pass
+
+
+class SqliteQueue:
+    """
+    The queue in the SQLite file path. Every thread gets its own connection, an instance can be shared by threads.
+    """
+
+    def __init__(self, path, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """
+        :param visibility_timeout: seconds a claimed job stays invisible to the other workers without a lease extension
+        :param max_attempts: times a job is run before it fails
+        """
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+
+        db = self._db()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(SCHEMA)
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            # autocommit, the write transactions are explicit; waits up to 30s for another writer
+            db = self._local.db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    @contextlib.contextmanager
+    def _write(self):
+        # the write lock is taken at BEGIN, two workers never claim the same job
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def put(self, fn, *args, **kwargs):
+        """
+        Queue the job fn(*args, **kwargs), arguments and result must be JSON serializable
+        :param fn: name of the function, see queue_worker.TASKS
+        :return: job id
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._db().execute("INSERT INTO jobs (id, fn, args, state, max_attempts, visible_at, created) "
+                           "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (job_id, fn, json.dumps({"args": args, "kwargs": kwargs}), QUEUED, self.max_attempts,
+                            now, now))
+        return job_id
+
+    def claim(self, worker):
+        """
+        Lease the oldest visible job to worker
+        :return: (job id, fn, args, kwargs, attempt) or None when no job is visible
+        """
+        now = time.time()
+        with self._write() as db:
+            # jobs of workers that died on their last attempt
+            db.execute("UPDATE jobs SET state = ?, finished = ?, error = ? "
+                       "WHERE state = ? AND visible_at <= ? AND attempts >= max_attempts",
+                       (FAILED, now, "worker lost", RUNNING, now))
+            row = db.execute("SELECT id, fn, args, attempts FROM jobs WHERE state IN (?, ?) AND visible_at <= ? "
+                             "ORDER BY visible_at LIMIT 1", (QUEUED, RUNNING, now)).fetchone()
+            if row is None:
+                return None
+            job_id, fn, args, attempts = row
+            db.execute("UPDATE jobs SET state = ?, attempts = ?, visible_at = ?, worker = ?, started = ? WHERE id = ?",
+                       (RUNNING, attempts + 1, now + self.visibility_timeout, worker, now, job_id))
+
+        args = json.loads(args)
+        return job_id, fn, args["args"], args["kwargs"], attempts + 1
+
+    def _count(self, db, name):
+        # within a write transaction
+        db.execute("INSERT OR IGNORE INTO counters (name, value) VALUES (?, 0)", (name,))
+        db.execute("UPDATE counters SET value = value + 1 WHERE name = ?", (name,))
+
+    def start(self, job_id, worker):
+        """
+        Right before the computation: renew the lease of worker on a job
+        :return: False if the job is no longer leased to worker (its front end gave up since the claim), it is skipped
+        """
+        with self._write() as db:
+            cursor = db.execute("UPDATE jobs SET visible_at = ? WHERE id = ? AND worker = ? AND state = ?",
+                                (time.time() + self.visibility_timeout, job_id, worker, RUNNING))
+            if cursor.rowcount == 0:
+                self._count(db, "skipped")
+        return cursor.rowcount > 0
+
+    def extend(self, job_id, worker):
+        """
+        Extend the lease of worker on a job by visibility_timeout
+        :return: False if the job is no longer leased to worker (deleted, or given to another worker)
+        """
+        cursor = self._db().execute("UPDATE jobs SET visible_at = ? WHERE id = ? AND worker = ? AND state = ?",
+                                    (time.time() + self.visibility_timeout, job_id, worker, RUNNING))
+        return cursor.rowcount > 0
+
+    def complete(self, job_id, worker, result):
+        """
+        :return: False if the job is no longer leased to worker, the result is dropped
+        """
+        result = json.dumps(result)
+        with self._write() as db:
+            cursor = db.execute("UPDATE jobs SET state = ?, finished = ?, result = ? "
+                                "WHERE id = ? AND worker = ? AND state = ?",
+                                (DONE, time.time(), result, job_id, worker, RUNNING))
+            if cursor.rowcount == 0:
+                self._count(db, "dropped")
+        return cursor.rowcount > 0
+
+    def fail(self, job_id, worker, error, retry=True):
+        """
+        A job raised: queue it again after a delay, or fail it when it has no attempts left (or retry is False)
+        """
+        now = time.time()
+        with self._write() as db:
+            row = db.execute("SELECT attempts, max_attempts FROM jobs WHERE id = ? AND worker = ? AND state = ?",
+                             (job_id, worker, RUNNING)).fetchone()
+            if row is None:
+                return
+            attempts, max_attempts = row
+            if retry and attempts < max_attempts:
+                db.execute("UPDATE jobs SET state = ?, visible_at = ?, worker = NULL, error = ? WHERE id = ?",
+                           (QUEUED, now + RETRY_DELAY * attempts, error, job_id))
+            else:
+                db.execute("UPDATE jobs SET state = ?, finished = ?, error = ? WHERE id = ?",
+                           (FAILED, now, error, job_id))
+
+    def status(self, job_id):
+        """
+        :return: (state, result, error) or None for an unknown job
+        """
+        row = self._db().execute("SELECT state, result, error FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        state, result, error = row
+        return state, json.loads(result) if result is not None else None, error
+
+    def delete(self, job_id):
+        self._db().execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def purge(self, older_than):
+        """
+        Delete the finished jobs no front end collected (it went away) within older_than seconds
+        :return: number of jobs deleted
+        """
+        cursor = self._db().execute("DELETE FROM jobs WHERE state IN (?, ?) AND finished < ?",
+                                    (DONE, FAILED, time.time() - older_than))
+        return cursor.rowcount
+
+    async def run(self, loop, fn, *args, **kwargs):
+        """
+        Queue fn(*args, **kwargs) and wait for a worker to compute it. Cancelling the wait deletes the job.
+        :return: the result of fn
+        :raise JobFailed: when the job failed on its last attempt or was deleted
+        """
+        job_id = await loop.run_in_executor(None, functools.partial(self.put, fn, *args, **kwargs))
+        interval = POLL_INTERVALS[0]
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                interval = min(interval * 2, POLL_INTERVALS[1])
+
+                status = await loop.run_in_executor(None, self.status, job_id)
+                if status is None:
+                    raise JobFailed("job {} was deleted".format(job_id))
+                state, result, error = status
+                if state == DONE:
+                    return result
+                if state == FAILED:
+                    raise JobFailed(error)
+        finally:
+            # not awaited, a cancelled wait returns at once
+            deleted = loop.run_in_executor(None, self.delete, job_id)
+            deleted.add_done_callback(functools.partial(_log_failed_delete, job_id))
+
+    def stats(self):
+        db = self._db()
+        counts = dict(db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+        oldest = db.execute("SELECT MIN(created) FROM jobs WHERE state = ?", (QUEUED,)).fetchone()[0]
+        counters = dict(db.execute("SELECT name, value FROM counters").fetchall())
+        return {
+            "path": self.path,
+            "queued": counts.get(QUEUED, 0),
+            "running": counts.get(RUNNING, 0),
+            "done": counts.get(DONE, 0),
+            "failed": counts.get(FAILED, 0),
+            "oldest_queued_age": time.time() - oldest if oldest is not None else 0.0,
+            # deleted by their front end before they were started, or while they ran
+            "skipped": counters.get("skipped", 0),
+            "dropped": counters.get("dropped", 0),
+            "visibility_timeout": self.visibility_timeout,
+            "max_attempts": self.max_attempts,
+        }
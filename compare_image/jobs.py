@@ -0,0 +1,226 @@
+import asyncio
+import collections
+import logging
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+TIMEOUT = "timeout"
+
+FINISHED_STATES = (DONE, FAILED, CANCELLED, TIMEOUT)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    """
+    A unit of work for the JobManager. run is a coroutine function called without arguments once a worker picks the
+    job up; its return value becomes the job result.
+    """
+
+    def __init__(self, run, timeout):
+        self.id = uuid.uuid4().hex
+        self.run = run
+        self.timeout = timeout
+        self.state = QUEUED
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.done = asyncio.Event()
+        self._task = None
+        self._cancel_requested = False
+
+    def to_dict(self):
+        d = {
+            "job_id": self.id,
+            "state": self.state,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+        if self.started is not None:
+            d["wait_time"] = self.started - self.created
+        if self.finished is not None and self.started is not None:
+            d["run_time"] = self.finished - self.started
+        if self.error is not None:
+            d["error"] = self.error
+        return d
+
+
+class JobManager:
+    """
+    Bounded job queue served by a fixed number of worker tasks.
+
+    submit() never waits: when max_queue jobs are already waiting it raises QueueFull so the caller can push back on
+    the client. A job cancelled while it waits frees its place at once, though it stays in the queue until a worker
+    task skips it. Each worker task runs one job at a time, so at most `workers` jobs are handed to the process pool
+    concurrently. The timeout only bounds how long a client waits: a job that runs longer is abandoned (state
+    "timeout") and its worker task takes the next job, but the process pool can not interrupt the computation itself.
+    It runs to its end, its result is discarded, and the pool counts its worker as busy until then.
+    """
+
+    def __init__(self, workers, max_queue, timeout, max_finished=1000):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.max_finished = max_finished
+
+        self._queue = None
+        # jobs waiting for a worker task, without the cancelled ones still in the queue
+        self._waiting = 0
+        self._tasks = []
+        self._jobs = {}
+        self._finished = collections.deque()
+
+        self.submitted = 0
+        self.rejected = 0
+        self.started = 0
+        self.running = 0
+        self.counts = collections.Counter()
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.run_time_total = 0.0
+
+    def start(self):
+        # must be called with the event loop running (app startup)
+        # unbounded, cancelled jobs stay in it until they are dequeued - submit() bounds the waiting ones
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+
+    def submit(self, run, timeout=None):
+        """
+        Queue a job
+        :param run: coroutine function producing the job result
+        :param timeout: seconds the job may run, defaults to the manager timeout
+        :return: the Job
+        :raise QueueFull: when max_queue jobs are already waiting
+        """
+        if self._waiting >= self.max_queue:
+            self.rejected += 1
+            raise QueueFull("{} jobs are waiting".format(self._waiting))
+
+        job = Job(run, timeout if timeout is not None else self.timeout)
+        self._queue.put_nowait(job)
+        self._waiting += 1
+        self._jobs[job.id] = job
+        self.submitted += 1
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """
+        Cancel a queued or running job
+        :return: False if the job is unknown or already finished
+        """
+        job = self._jobs.get(job_id)
+        if job is None or job.state in FINISHED_STATES:
+            return False
+
+        if job.state == QUEUED:
+            # the worker that dequeues it will skip it
+            self._waiting -= 1
+            self._finish(job, CANCELLED)
+        elif job._task is not None:
+            job._cancel_requested = True
+            job._task.cancel()
+        return True
+
+    async def wait(self, job, timeout=None):
+        """
+        Wait until job finishes or timeout seconds have passed
+        :return: True if the job is finished
+        """
+        waiter = asyncio.ensure_future(job.done.wait())
+        try:
+            await asyncio.wait([waiter], timeout=timeout)
+        finally:
+            # nothing is left waiting on the job after a timeout
+            waiter.cancel()
+        return job.done.is_set()
+
+    def _finish(self, job, state, result=None, error=None):
+        job.state = state
+        job.result = result
+        job.error = error
+        job.finished = time.time()
+        job.run = None
+        job.done.set()
+        self.counts[state] += 1
+
+        # keep a bounded number of finished jobs around for the status api
+        self._finished.append(job.id)
+        while len(self._finished) > self.max_finished:
+            self._jobs.pop(self._finished.popleft(), None)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            if job.state != QUEUED:
+                continue
+
+            self._waiting -= 1
+            job.state = RUNNING
+            job.started = time.time()
+            wait_time = job.started - job.created
+            self.started += 1
+            self.wait_time_total += wait_time
+            self.wait_time_max = max(self.wait_time_max, wait_time)
+            self.running += 1
+
+            job._task = asyncio.ensure_future(asyncio.wait_for(job.run(), job.timeout))
+            try:
+                result = await asyncio.shield(job._task)
+                self._finish(job, DONE, result=result)
+            except asyncio.TimeoutError:
+                logger.warning("Job {} timed out after {}s".format(job.id, job.timeout))
+                self._finish(job, TIMEOUT, error="timed out after {}s".format(job.timeout))
+            except asyncio.CancelledError:
+                if not job._cancel_requested:
+                    # the worker itself is being cancelled
+                    job._task.cancel()
+                    self._finish(job, CANCELLED)
+                    raise
+                self._finish(job, CANCELLED)
+            except Exception as x:
+                logger.exception("Job {} failed".format(job.id))
+                self._finish(job, FAILED, error=str(x))
+            finally:
+                self.running -= 1
+                self.run_time_total += time.time() - job.started
+                job._task = None
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "queue_depth": self._waiting,
+            "max_queue": self.max_queue,
+            "running": self.running,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "finished": dict(self.counts),
+            "wait_time_avg": self.wait_time_total / self.started if self.started else 0.0,
+            "wait_time_max": self.wait_time_max,
+            "run_time_total": self.run_time_total,
+        }
@@ -1,9 +1,9 @@
 import asyncio
 import logging
-import time
 import os
 import sys
 import argparse
+import collections
 import concurrent.futures
 
 import aiohttp
@@ -13,49 +13,78 @@ import jinja2
 import uvloop
 from aiohttp import web
 
+import artifacts
+from golden_library import GoldenLibrary
+from job_queue import SqliteQueue
+from jobs import JobManager
+from metrics import REGISTRY
+from prechecks import NOISE_LEVEL
+from result_cache import ResultCache
+from retention import Janitor
+from sessions import SessionStore
 from routes import setup_routes
+from shared_images import SegmentStore, DEFAULT_DIR as DEFAULT_SEGMENT_DIR
+from telemetry import Registry
+from views import telemetry_middleware
+from worker_pool import AffinityPool
 
 
 #logger = logging.getLogger('aiohttp.access')
 #logger.setLevel(logging.DEBUG)
 
 async def worker(app):
-    try:
-        upload_dir = app["upload_dir"]
-
-        while True:
-
-            timenow = time.time()
-
-            for filename in os.listdir(upload_dir):
-                info = os.stat(os.path.join(upload_dir, filename))
-                delta_time = timenow - info.st_atime
-                print(f"{filename} delta: {delta_time}")
+    # upload dir and session retention - the scan, the deletes and the session writes run in a thread
+    janitor = app["janitor"]
 
-            await asyncio.sleep(60)
+    while True:
+        try:
+            await app.loop.run_in_executor(None, janitor.run_once)
+            await app.loop.run_in_executor(None, app["sessions"].flush)
+        except asyncio.CancelledError:
+            raise
+        except Exception as x:
+            logging.exception(f"Janitor got exception {x}")
 
-    except Exception as x:
-        print(f"Worker got exception {x}")
+        await asyncio.sleep(janitor.interval)
 
 
 async def start_background_tasks(app):
     task = app.loop.create_task(worker(app))
     app['worker'] = task
+    app["job_manager"].start()
+    if app["segments"] is not None:
+        app["segments"].open()
 
 
 async def clean_background_tasks(app):
+    await app["job_manager"].stop()
+    if app["segments"] is not None:
+        app["segments"].close()
+    app["worker_pool"].shutdown(wait=False)
     app['worker'].cancel()
-    await app['worker']
+    app["sessions"].flush()
+    try:
+        await app['worker']
+    except asyncio.CancelledError:
+        pass
 
 
-def main(host_ip, port, upload_dir):
+def main(config):
+    """
+    Run the server
+    :param config: the parsed command line (see the options below), with artifact_formats parsed by
+                   artifacts.parse_formats
+    """
 
     print(aiohttp.__version__)
 
     # make uvloop the default loop in asyncio
     asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
-    app = web.Application()
+    app = web.Application(middlewares=[telemetry_middleware])
+
+    # request, diff and stage timings served on /metrics
+    app["telemetry"] = Registry()
 
     app.on_startup.append(start_background_tasks)
     app.on_cleanup.append(clean_background_tasks)
@@ -68,27 +97,73 @@ def main(host_ip, port, upload_dir):
     aiohttp_jinja2.setup(app, loader=jinja2.FileSystemLoader(os.path.join(root_path,'templates')))
 
     # create if needed an upload dir
-    if not os.path.exists(upload_dir):
-        os.makedirs(upload_dir)
-    app["upload_dir"] = upload_dir
-
-    process_pool_executor = concurrent.futures.ProcessPoolExecutor(
-        max_workers=3,
-    )
-    app["process_pool_executor"] = process_pool_executor
-
+    if not os.path.exists(config.upload_dir):
+        os.makedirs(config.upload_dir)
+    app["upload_dir"] = config.upload_dir
+
+    # the sessions stay in the server, the cookie only carries their id
+    app["sessions"] = SessionStore(config.session_ttl * 3600, config.session_file or None)
+
+    # evicts idle session directories and keeps the upload dir under its quota
+    app["janitor"] = Janitor(config.upload_dir, config.session_ttl * 3600, config.upload_quota * 1024 * 1024,
+                             config.janitor_interval, app["sessions"])
+
+    # uploads are written to disk by these threads so the event loop is never blocked on file io
+    app["upload_executor"] = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+    app["max_upload_size"] = config.max_upload_size * 1024 * 1024
+
+    # one process per worker, a session's jobs go to the same worker which keeps its images decoded
+    app["worker_pool"] = AffinityPool(config.workers, config.decode_cache_size * 1024 * 1024, app["telemetry"])
+
+    # diff computations are queued - at most `workers` are handed to the pool at a time
+    app["job_manager"] = JobManager(config.workers, config.max_queue, config.job_timeout)
+    # diffs computed by the queue_worker processes of the box instead of the worker pool, shared by all front ends
+    app["job_queue"] = SqliteQueue(config.job_queue) if config.job_queue else None
+
+    # a video comparison is one job for the whole clip
+    app["video_timeout"] = config.video_timeout
+
+    # images are decoded once and shared with the workers through files on tmpfs - off by default, the workers'
+    # decoded image caches already decode an image once per worker
+    app["segments"] = None
+    if config.segment_dir:
+        if config.decode_cache_size > 0 or config.job_queue:
+            logging.warning("--segment-dir is only used with --decode-cache 0 and without --job-queue, ignored")
+        else:
+            app["segments"] = SegmentStore(config.segment_dir)
+
+    # parameters passed to image_ops.workon_images - they are also part of the result cache key
+    app["diff_params"] = {"shift_method": config.shift_method, "shift_precheck": config.shift_precheck,
+                          "ssim_tile_size": config.ssim_tile_size or None,
+                          "lazy_artifacts": config.lazy_artifacts, "artifact_formats": config.artifact_formats,
+                          "region_min_area": config.region_min_area,
+                          "region_merge_distance": config.region_merge_distance,
+                          "precheck": config.precheck, "near_identical": config.near_identical,
+                          "near_identical_max": config.near_identical_max, "metrics": config.metrics}
+
+    # number of diffs served from the result cache or settled by each prechecks tier
+    app["settled_by"] = collections.Counter()
+
+    # golden images with perceptual hashes, a right image upload lists the ones it most likely shows
+    app["golden_library"] = GoldenLibrary(config.golden_library_dir) if config.golden_library_dir else None
+    app["golden_candidates"] = config.golden_candidates
+
+    # lazy artifacts being rendered, path -> future
+    app["artifact_renders"] = {}
+
+    # a cache size of 0 disables the result cache
+    app["result_cache"] = None
+    if config.cache_size > 0:
+        app["result_cache"] = ResultCache(config.cache_dir, config.cache_size * 1024 * 1024)
 
     static_dir = os.path.join(root_path, 'static')
 
-    setup_routes(app, upload_dir, static_dir)
+    setup_routes(app, config.upload_dir, static_dir)
 
-    # secret_key must be 32 url-safe base64-encoded bytes
-    # fernet_key = fernet.Fernet.generate_key()
-    # secret_key = base64.urlsafe_b64decode(fernet_key)
-    # aiohttp_session.setup(app, EncryptedCookieStorage(secret_key))
-    aiohttp_session.setup(app, aiohttp_session.SimpleCookieStorage())
+    # the cookie is an opaque random id, there is nothing in it to encrypt
+    aiohttp_session.setup(app, app["sessions"])
 
-    web.run_app(app, host=host_ip, port=port)
+    web.run_app(app, host=config.host_ip, port=config.port)
 
 
 if __name__ == "__main__":
@@ -98,14 +173,41 @@ if __name__ == "__main__":
     parser.add_argument('--host',   '-i', action='store', dest="host_ip",  default="0.0.0.0", help="ip to listen to",   type=str)
     parser.add_argument('--port',   '-p', action='store', dest="port",     default=80,        help="port to listen on", type=int)
     parser.add_argument('--upload', '-u', action='store', dest="upload_dir", default='/tmp/uploads', help="Location of the upload directory", type=str)
+    parser.add_argument('--session-ttl',  action='store', dest="session_ttl", default=24, help="Hours after which an idle session and its uploads are deleted", type=float)
+    parser.add_argument('--session-file', action='store', dest="session_file", default='', help="SQLite file the sessions are kept in across restarts, empty to keep them in memory only", type=str)
+    parser.add_argument('--upload-quota', action='store', dest="upload_quota", default=10240, help="Maximum size of the upload directory in MB", type=int)
+    parser.add_argument('--janitor-interval', action='store', dest="janitor_interval", default=60, help="Seconds between upload dir retention passes", type=float)
+    parser.add_argument('--workers',      action='store', dest="workers", default=os.cpu_count(), help="Number of diff worker processes", type=int)
+    parser.add_argument('--max-queue',    action='store', dest="max_queue", default=32, help="Maximum number of queued diff jobs", type=int)
+    parser.add_argument('--job-timeout',  action='store', dest="job_timeout", default=300, help="Seconds a client waits for a diff job, the computation itself is not interrupted", type=float)
+    parser.add_argument('--video-timeout', action='store', dest="video_timeout", default=3600, help="Seconds a video comparison job may run", type=float)
+    parser.add_argument('--job-queue',    action='store', dest="job_queue", default='', help="SQLite job queue served by queue_worker.py, empty to compute the diffs in this server's worker pool", type=str)
+    parser.add_argument('--max-upload',   action='store', dest="max_upload_size", default=100, help="Maximum size of an uploaded image in MB", type=int)
+    parser.add_argument('--cache',        action='store', dest="cache_dir", default='/tmp/compare_image_cache', help="Location of the result cache", type=str)
+    parser.add_argument('--cache-size',   action='store', dest="cache_size", default=1024, help="Result cache size in MB, 0 disables the cache", type=int)
+    parser.add_argument('--golden-library', action='store', dest="golden_library_dir", default='/tmp/golden_library', help="Location of the golden image library, empty to disable it", type=str)
+    parser.add_argument('--golden-candidates', action='store', dest="golden_candidates", default=5, help="Number of matching golden images listed for a right image", type=int)
+    parser.add_argument('--shift-method', action='store', dest="shift_method", default="full", choices=["full", "pyramid"], help="Shift detection method", type=str)
+    parser.add_argument('--ssim-tile',    action='store', dest="ssim_tile_size", default=0, help="Compute the SSIM in tiles of this size to bound memory, 0 for one pass", type=int)
+    parser.add_argument('--decode-cache', action='store', dest="decode_cache_size", default=512, help="Decoded image cache size in MB per worker, 0 disables it", type=int)
+    parser.add_argument('--segment-dir',  action='store', dest="segment_dir", default='', help="Directory (tmpfs, e.g. {}) for decoded images shared with the workers, only with --decode-cache 0; empty to let the workers decode".format(DEFAULT_SEGMENT_DIR), type=str)
+    parser.add_argument('--artifact-format', action='store', dest="artifact_formats", default=[], nargs='*', help="Artifact image formats, <minus|diff|thresh|marked_l|marked_r>=<png|webp|jpeg>[:<level>] e.g. diff=webp:80 marked_l=jpeg:90", type=str)
+    parser.add_argument('--region-min-area', action='store', dest="region_min_area", default=0, help="Ignore changed regions whose box is smaller than this many pixels", type=int)
+    parser.add_argument('--region-merge', action='store', dest="region_merge_distance", default=0, help="Merge changed regions at most this many pixels apart into one box", type=int)
+    parser.add_argument('--eager-artifacts', action='store_false', dest="lazy_artifacts", help="Encode every artifact image when the diff is computed instead of when it is first requested")
+    parser.add_argument('--near-identical', action='store', dest="near_identical", default=0.0, help="Settle pairs whose mean absolute difference (0-255) is at most this without the full comparison", type=float)
+    parser.add_argument('--near-identical-max', action='store', dest="near_identical_max", default=NOISE_LEVEL, help="Largest difference of a pixel (0-255) in a pair settled by --near-identical", type=int)
+    parser.add_argument('--metrics',      action='store', dest="metrics", default=[], nargs='*', choices=list(REGISTRY), help="Comparison metrics added to every diff result", type=str)
+    parser.add_argument('--no-precheck',  action='store_false', dest="precheck", help="Run the full comparison even for identical pairs")
+    parser.add_argument('--no-shift-precheck', action='store_false', dest="shift_precheck", help="Always run shift detection even if the images have no black bars")
 
     pargs = parser.parse_args()
 
-    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.DEBUG)
-
-    sys.exit(main(pargs.host_ip, pargs.port, pargs.upload_dir))
-
-
-
+    try:
+        pargs.artifact_formats = artifacts.parse_formats(pargs.artifact_formats)
+    except ValueError as x:
+        parser.error(str(x))
 
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.DEBUG)
 
+    sys.exit(main(pargs))
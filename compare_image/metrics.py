@@ -0,0 +1,220 @@
+"""
+Comparison metrics, picked per request: workon_images(metrics=["mse", "psnr", ...]) adds {name: value} to its result.
+
+A metric is a function of a Pair. The Pair computes what metrics have in common - grayscale and float32 images, the
+Gaussian filtered moments of an SSIM - the first time a metric asks for it and keeps it for the others of the same
+comparison: psnr reuses the mse, ssim is the first scale of ms_ssim. A metric that is not asked for computes nothing.
+
+The SSIMs here are the ones of the SSIM paper (Gaussian window, sigma 1.5) - compare_ssim(gaussian_weights=True,
+sigma=1.5, use_sample_covariance=False) - and not the uniform window ssim_score of the diff.
+"""
+import collections
+import math
+
+import cv2
+import numpy as np
+
+DATA_RANGE = 255.0
+
+GAUSSIAN_SIZE = 11
+GAUSSIAN_SIGMA = 1.5
+
+# weights of the 5 scales of MS-SSIM (Wang, Simoncelli, Bovik 2003)
+MS_SSIM_WEIGHTS = (0.0448, 0.2856, 0.3001, 0.2363, 0.1333)
+
+Metric = collections.namedtuple("Metric", "fn identical")
+
+REGISTRY = collections.OrderedDict()
+
+
+def metric(name, identical):
+    """
+    Register fn(pair) as metric name
+    :param identical: its value for two identical images, or fn(image) computing it
+    """
+    def register(fn):
+        REGISTRY[name] = Metric(fn, identical)
+        return fn
+    return register
+
+
+def _gray(image):
+    return image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+
+def _channel_names(image):
+    return ("gray",) if image.ndim == 2 else ("b", "g", "r", "a")[:image.shape[2]]
+
+
+def _mean(a):
+    # like compare_ssim the mean leaves out the half window border
+    pad = (GAUSSIAN_SIZE - 1) // 2
+    if min(a.shape[:2]) > 2 * pad:
+        a = a[pad:-pad, pad:-pad]
+    return float(np.mean(a))
+
+
+def _ssim_terms(x, y):
+    # luminance and contrast-structure maps of the SSIM of two float32 images
+    def blur(a):
+        return cv2.GaussianBlur(a, (GAUSSIAN_SIZE, GAUSSIAN_SIZE), GAUSSIAN_SIGMA, borderType=cv2.BORDER_REFLECT)
+
+    ux = blur(x)
+    uy = blur(y)
+    uxx = ux * ux
+    uyy = uy * uy
+    uxy = ux * uy
+    vx = blur(x * x) - uxx
+    vy = blur(y * y) - uyy
+    vxy = blur(x * y) - uxy
+
+    c1 = (0.01 * DATA_RANGE) ** 2
+    c2 = (0.03 * DATA_RANGE) ** 2
+
+    return (2 * uxy + c1) / (uxx + uyy + c1), (2 * vxy + c2) / (vx + vy + c2)
+
+
+class Pair:
+    """
+    The two images of a comparison and the intermediates their metrics share, each computed on first use
+    """
+
+    def __init__(self, a, b, gray_a=None, gray_b=None):
+        self.a = a
+        self.b = b
+        self._shared = {}
+        if gray_a is not None and gray_b is not None:
+            self._shared["gray"] = (gray_a, gray_b)
+
+    def get(self, name, fn):
+        """
+        Shared value name, fn() computes it when it is not known yet
+        """
+        if name not in self._shared:
+            self._shared[name] = fn()
+        return self._shared[name]
+
+    @property
+    def gray(self):
+        return self.get("gray", lambda: (_gray(self.a), _gray(self.b)))
+
+    @property
+    def gray32(self):
+        return self.get("gray32", lambda: tuple(g.astype(np.float32) for g in self.gray))
+
+    @property
+    def channels32(self):
+        # float32 planes of every channel
+        return self.get("channels32", lambda: tuple([c.astype(np.float32) for c in cv2.split(image)]
+                                                    for image in (self.a, self.b)))
+
+    @property
+    def mse(self):
+        # sum of the squared differences in one pass, no temporaries
+        return self.get("mse", lambda: cv2.norm(self.a, self.b, cv2.NORM_L2SQR) / self.a.size)
+
+    def ssim_terms(self, key, x, y):
+        """
+        Luminance and contrast-structure maps of the SSIM of the float32 images x and y, shared under key
+        """
+        return self.get(("ssim", key), lambda: _ssim_terms(x, y))
+
+
+@metric("mse", identical=0.0)
+def mse(pair):
+    """
+    Mean squared error over all pixels and channels
+    """
+    return float(pair.mse)
+
+
+@metric("psnr", identical=None)
+def psnr(pair):
+    """
+    Peak signal to noise ratio in dB, None for identical images (infinite)
+    """
+    if pair.mse == 0:
+        return None
+    return float(10 * math.log10(DATA_RANGE ** 2 / pair.mse))
+
+
+@metric("ssim", identical=1.0)
+def ssim(pair):
+    """
+    SSIM of the grayscale images
+    """
+    luminance, cs = pair.ssim_terms("gray0", *pair.gray32)
+    return _mean(luminance * cs)
+
+
+@metric("ssim_channels", identical=lambda image: {name: 1.0 for name in _channel_names(image)})
+def ssim_channels(pair):
+    """
+    SSIM of every channel, {"b", "g", "r"} (or {"gray"})
+    """
+    a, b = pair.channels32
+    values = {}
+    for name, x, y in zip(_channel_names(pair.a), a, b):
+        luminance, cs = pair.ssim_terms(name, x, y)
+        values[name] = _mean(luminance * cs)
+    return values
+
+
+@metric("ms_ssim", identical=1.0)
+def ms_ssim(pair):
+    """
+    Multi-scale SSIM of the grayscale images: contrast-structure at every scale, luminance at the coarsest one. Scales
+    smaller than the window are left out and the weights of the others renormalised.
+    """
+    x, y = pair.gray32
+    scales = []
+    for scale in range(len(MS_SSIM_WEIGHTS)):
+        if min(x.shape[:2]) < GAUSSIAN_SIZE:
+            break
+        scales.append(pair.ssim_terms("gray{}".format(scale), x, y))
+        x = cv2.resize(x, (x.shape[1] // 2, x.shape[0] // 2), interpolation=cv2.INTER_AREA)
+        y = cv2.resize(y, (y.shape[1] // 2, y.shape[0] // 2), interpolation=cv2.INTER_AREA)
+
+    if not scales:
+        return ssim(pair)
+
+    weights = np.array(MS_SSIM_WEIGHTS[:len(scales)])
+    weights /= weights.sum()
+    values = [max(0.0, _mean(cs)) for _, cs in scales[:-1]]
+    luminance, cs = scales[-1]
+    values.append(max(0.0, _mean(luminance * cs)))
+    return float(np.prod(np.power(values, weights)))
+
+
+def check_metrics(names):
+    """
+    :raise ValueError: on an unknown metric name
+    """
+    for name in names or []:
+        if name not in REGISTRY:
+            raise ValueError("unknown metric {}, one of {}".format(name, ", ".join(REGISTRY)))
+
+
+def compute_metrics(names, a, b, gray_a=None, gray_b=None):
+    """
+    The metrics names of two images of the same shape
+    :param gray_a: grayscale of a if it is already known
+    :param gray_b: grayscale of b if it is already known
+    :return: {name: value}
+    :raise ValueError: on an unknown metric name
+    """
+    check_metrics(names)
+    pair = Pair(a, b, gray_a, gray_b)
+    return {name: REGISTRY[name].fn(pair) for name in names}
+
+
+def identical_metrics(names, image):
+    """
+    The metrics names of image compared with itself, without computing anything
+    """
+    check_metrics(names)
+    values = {}
+    for name in names:
+        identical = REGISTRY[name].identical
+        values[name] = identical(image) if callable(identical) else identical
+    return values
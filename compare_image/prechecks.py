@@ -0,0 +1,82 @@
+"""
+Early exit for identical and near identical pairs, before the expensive stages of the diff (shift detection, SSIM,
+regions, artifacts).
+
+The tiers, cheapest first - the first one that settles a pair ends the computation:
+    hash            the files are byte identical (sha256 from the upload, or compared on disk)
+    pixels          the decoded images are identical
+    near_identical  the mean absolute difference of the decoded images is at most the configured threshold and no
+                    pixel differs by more than the configured maximum (NOISE_LEVEL by default)
+A pair none of them settles is compared in full ("full").
+"""
+import filecmp
+
+import cv2
+import numpy as np
+
+HASH = "hash"
+PIXELS = "pixels"
+NEAR_IDENTICAL = "near_identical"
+FULL = "full"
+
+TIERS = (HASH, PIXELS, NEAR_IDENTICAL, FULL)
+
+# long side of the downscaled images compared before the full resolution ones
+SMALL_SIZE = 256
+
+# default largest difference of a pixel that is still noise. A mean absolute difference threshold alone can not tell
+# noise from a small real change: a missing glyph (a few hundred pixels off by 200) moves the mean of a 1080p capture
+# by less than 0.05, below any useful threshold, but its pixels are far above the encoder and scaler noise of a
+# capture (a few levels)
+NOISE_LEVEL = 16
+
+
+def same_file(left, right, digests=None):
+    """
+    Tier 1: are the files byte identical
+    :param digests: (left sha256, right sha256) when they are known, otherwise the files are compared - a size
+                    mismatch or the first differing block ends that early
+    """
+    if digests is not None and None not in digests:
+        return digests[0] == digests[1]
+    return filecmp.cmp(left, right, shallow=False)
+
+
+def small(image):
+    """
+    The image shrunk (area averaging) so its long side is at most SMALL_SIZE
+    """
+    h, w = image.shape[:2]
+    scale = SMALL_SIZE / max(h, w)
+    if scale >= 1:
+        return image
+    return cv2.resize(image, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+
+
+def mean_abs_diff(a, b):
+    return float(np.mean(cv2.absdiff(a, b)))
+
+
+def compare_pixels(left_image, right_image, near_identical=0.0, max_diff=NOISE_LEVEL):
+    """
+    Tier 2: compare decoded_cache.DecodedImage's of the same shape.
+    The downscaled images are compared first: an area average moves the mean absolute difference by at most one
+    (rounding), so a pair that is clearly different there goes on to the full comparison without touching the full
+    resolution images.
+    :param near_identical: mean absolute difference (0-255) up to which a pair counts as near identical
+    :param max_diff: largest difference of a pixel (0-255) in a near identical pair
+    :return: PIXELS or NEAR_IDENTICAL and the mean absolute difference, or None, mean absolute difference of the
+             downscaled images when the pair needs the full comparison
+    """
+    mad = mean_abs_diff(left_image.get("small", small), right_image.get("small", small))
+    if mad > near_identical + 1:
+        return None, mad
+
+    diff = cv2.absdiff(left_image.image, right_image.image)
+    if not diff.any():
+        return PIXELS, 0.0
+
+    mad = float(np.mean(diff))
+    if mad <= near_identical and diff.max() <= max_diff:
+        return NEAR_IDENTICAL, mad
+    return None, mad
@@ -0,0 +1,171 @@
+"""
+Diff worker processes serving a job_queue.SqliteQueue, next to the web front ends of the box:
+
+    python main.py --job-queue /shared/jobs.db ...        (any number of front ends)
+    python queue_worker.py --queue /shared/jobs.db --workers 4
+
+The front ends put their diffs in the queue instead of computing them in their own process pool; every worker process
+takes the next job whichever front end queued it, so a busy front end borrows the capacity of the idle ones. Each
+process keeps its own decoded image cache, extends the lease of its job while it computes and finishes the job it is
+on when it is asked to stop (SIGTERM or Ctrl-C).
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+import decoded_cache
+import image_ops
+from job_queue import SqliteQueue, DEFAULT_VISIBILITY_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# the functions a queued job can name
+TASKS = {
+    "workon_images": image_ops.workon_images,
+}
+
+# seconds after which a finished job no front end collected is deleted, and between two such purges
+RESULT_TTL = 3600
+PURGE_INTERVAL = 60
+
+
+def _guarded(what, fn, *args, **kwargs):
+    # a failing queue call (e.g. the database stayed locked longer than the busy timeout) must not end the worker:
+    # the job it was about stays leased until its lease expires, then it is retried
+    try:
+        return fn(*args, **kwargs)
+    except Exception:
+        logger.warning("Could not {}:\n{}".format(what, traceback.format_exc()))
+        return None
+
+
+def _keep_leased(queue, job_id, name, finished):
+    # extends the lease while the job runs, well before it would expire - a failed extension is tried again next time
+    while not finished.wait(queue.visibility_timeout / 3):
+        if _guarded("extend the lease of job {}".format(job_id), queue.extend, job_id, name) is False:
+            logger.info("Job {} is no longer ours, its result will be dropped".format(job_id))
+            return
+
+
+def run_job(queue, job, name):
+    job_id, fn, args, kwargs, attempt = job
+
+    task = TASKS.get(fn)
+    if task is None:
+        _guarded("fail job {}".format(job_id), queue.fail, job_id, name, "unknown job function {}".format(fn),
+                 retry=False)
+        return
+
+    # the front end may have given up on the job since it was claimed
+    if _guarded("start job {}".format(job_id), queue.start, job_id, name) is False:
+        logger.info("Job {} was deleted, skipped".format(job_id))
+        return
+
+    finished = threading.Event()
+    lease = threading.Thread(target=_keep_leased, args=(queue, job_id, name, finished), daemon=True)
+    lease.start()
+    t0 = time.time()
+    try:
+        result = task(*args, **kwargs)
+    except Exception as x:
+        logger.exception("Job {} failed on attempt {}".format(job_id, attempt))
+        _guarded("fail job {}".format(job_id), queue.fail, job_id, name, "{}: {}".format(type(x).__name__, x))
+        return
+    finally:
+        finished.set()
+        lease.join()
+
+    try:
+        queue.complete(job_id, name, result)
+    except (TypeError, ValueError) as x:
+        # the result can not be stored, computing it again would not help
+        _guarded("fail job {}".format(job_id), queue.fail, job_id, name,
+                 "result can not be stored: {}".format(x), retry=False)
+        return
+    except Exception:
+        logger.warning("Could not store the result of job {}:\n{}".format(job_id, traceback.format_exc()))
+        return
+    logger.debug("Job {} {} done in {:.3f}s".format(job_id, fn, time.time() - t0))
+
+
+def work(queue_path, visibility_timeout, poll_interval, decode_cache_bytes, stop):
+    """
+    One worker process: claim, compute, repeat until stop is set
+    """
+    # the parent decides when to stop, a job in progress is finished
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    decoded_cache.configure(decode_cache_bytes)
+    queue = SqliteQueue(queue_path, visibility_timeout)
+    name = "{}-{}".format(socket.gethostname(), os.getpid())
+    logger.info("Worker {} serving {}".format(name, queue_path))
+
+    last_purge = 0.0
+    while not stop.is_set():
+        if time.time() - last_purge > PURGE_INTERVAL:
+            purged = _guarded("purge the uncollected jobs", queue.purge, RESULT_TTL)
+            if purged:
+                logger.info("Purged {} uncollected jobs".format(purged))
+            last_purge = time.time()
+
+        job = _guarded("claim a job", queue.claim, name)
+        if job is None:
+            stop.wait(poll_interval)
+            continue
+        run_job(queue, job, name)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="KVM Test Station - queue worker")
+
+    parser.add_argument('--queue', '-q',  action='store', dest="queue", required=True, help="SQLite job queue shared with the front ends (--job-queue)", type=str)
+    parser.add_argument('--workers',      action='store', dest="workers", default=os.cpu_count(), help="Number of worker processes", type=int)
+    parser.add_argument('--visibility-timeout', action='store', dest="visibility_timeout", default=DEFAULT_VISIBILITY_TIMEOUT, help="Seconds before the job of a worker that stopped extending its lease is retried", type=float)
+    parser.add_argument('--poll-interval', action='store', dest="poll_interval", default=0.1, help="Seconds an idle worker waits before looking for a job again", type=float)
+    parser.add_argument('--decode-cache', action='store', dest="decode_cache_size", default=512, help="Decoded image cache size in MB per worker, 0 disables it", type=int)
+
+    pargs = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(process)d - %(levelname)s - %(message)s', level=logging.INFO)
+
+    # creates the file and switches it to WAL before the workers start
+    SqliteQueue(pargs.queue, pargs.visibility_timeout)
+
+    stop = multiprocessing.Event()
+
+    def start_worker():
+        process = multiprocessing.Process(target=work, args=(pargs.queue, pargs.visibility_timeout, pargs.poll_interval,
+                                                             pargs.decode_cache_size * 1024 * 1024, stop))
+        process.start()
+        return process
+
+    processes = [start_worker() for _ in range(pargs.workers)]
+
+    def shutdown(signum, frame):
+        logger.info("Stopping, the workers finish their jobs")
+        stop.set()
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    # a worker that died (e.g. opencv crashed) is replaced, its job is retried once its lease expires
+    while not stop.is_set():
+        for i, process in enumerate(processes):
+            if not process.is_alive():
+                logger.warning("Worker {} exited with {}, starting a new one".format(process.pid, process.exitcode))
+                processes[i] = start_worker()
+        stop.wait(1)
+
+    for process in processes:
+        process.join()
+
+    sys.exit(0)
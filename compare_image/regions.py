@@ -0,0 +1,101 @@
+"""
+Changed regions of a diff: bounding boxes from the threshold image and the overlay marking them.
+
+Everything works on all the boxes at once - there is no python loop over boxes, so a noisy capture with thousands of
+tiny regions costs about the same as a clean one.
+"""
+import cv2
+import numpy as np
+
+
+def box_mask(shape, x0, y0, x1, y1):
+    """
+    Mask of the union of the boxes [x0, x1) x [y0, y1) (arrays, clipped to the image) in one pass for any number of
+    boxes: +1/-1 at the corners of every box (one bincount), then the integral image of the corners
+    """
+    rows, cols = shape[:2]
+    x0, x1 = np.clip(x0, 0, cols), np.clip(x1, 0, cols)
+    y0, y1 = np.clip(y0, 0, rows), np.clip(y1, 0, rows)
+    keep = (x1 > x0) & (y1 > y0)
+    x0, y0, x1, y1 = x0[keep], y0[keep], x1[keep], y1[keep]
+
+    stride = cols + 1
+    index = np.concatenate([y0 * stride + x0, y0 * stride + x1, y1 * stride + x0, y1 * stride + x1])
+    weights = np.repeat(np.array([1.0, -1.0, -1.0, 1.0]), len(x0))
+    corners = np.bincount(index, weights, minlength=(rows + 1) * stride).reshape(rows + 1, stride)
+    return cv2.integral(corners, sdepth=cv2.CV_64F)[1:rows + 1, 1:cols + 1] > 0
+
+
+def merge_boxes(boxes, shape, distance=0):
+    """
+    Merge the boxes that overlap, touch or are at most distance pixels apart (horizontally and vertically) -
+    repeated until no two merged boxes do. Each round paints all the boxes, grown right and down by distance pixels,
+    into one mask; the boxes of its connected components are the merged boxes (grown by distance).
+    :param boxes: (n, 4) array of x, y, w, h inside an image of shape
+    :return: (m, 4) array of x, y, w, h
+    """
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+    x0, y0 = boxes[:, 0], boxes[:, 1]
+    x1, y1 = x0 + boxes[:, 2], y0 + boxes[:, 3]
+
+    rows, cols = shape[:2]
+    while len(x0) > 1:
+        mask = box_mask((rows + distance, cols + distance), x0, y0, x1 + distance, y1 + distance)
+        _, _, stats, _ = cv2.connectedComponentsWithStats(mask.view(np.uint8), connectivity=8)
+        merged = stats[1:, :4].astype(np.int64)
+        if len(merged) == len(x0):
+            # nothing merged
+            break
+
+        x0, y0 = merged[:, 0], merged[:, 1]
+        x1, y1 = x0 + merged[:, 2] - distance, y0 + merged[:, 3] - distance
+
+    return np.stack([x0, y0, x1 - x0, y1 - y0], axis=1)
+
+
+def threshold(diff):
+    """
+    The changed pixels of a uint8 SSIM map (low is changed), white: an Otsu threshold of the map
+    """
+    return cv2.threshold(diff, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
+
+
+def find_regions(thresh, min_area=0, merge_distance=0):
+    """
+    Bounding boxes of the changed regions in a threshold image: the connected components (one
+    connectedComponentsWithStats call), without those whose box is smaller than min_area pixels, merged with
+    merge_boxes
+    :return: list of [x, y, w, h]
+    """
+    _, _, stats, _ = cv2.connectedComponentsWithStats(thresh, connectivity=8)
+    boxes = stats[1:, :4]
+    boxes = boxes[boxes[:, 2] * boxes[:, 3] >= max(1, min_area)]
+    if len(boxes) > 1:
+        boxes = merge_boxes(boxes, thresh.shape, merge_distance)
+    return boxes.tolist()
+
+
+def draw_regions(images, regions, color=(0, 0, 255), thickness=2):
+    """
+    Outline the regions on images of the same size, in place, with a single mask assignment per image: the frame of
+    every box is four strips, all of them go into one mask
+    :return: images
+    """
+    if len(regions) == 0:
+        return images
+
+    boxes = np.asarray(regions, dtype=np.int64).reshape(-1, 4)
+    x0, y0 = boxes[:, 0], boxes[:, 1]
+    x1, y1 = x0 + boxes[:, 2], y0 + boxes[:, 3]
+
+    # lines through the box corners like cv2.rectangle, thickness pixels wide
+    a = thickness // 2
+    b = thickness - a
+    mask = box_mask(images[0].shape,
+                    np.concatenate([x0 - a, x0 - a, x0 - a, x1 - a]),
+                    np.concatenate([y0 - a, y1 - a, y0 - a, y0 - a]),
+                    np.concatenate([x1 + b, x1 + b, x0 + b, x1 + b]),
+                    np.concatenate([y0 + b, y1 + b, y1 + b, y1 + b]))
+    for image in images:
+        image[mask] = color
+    return images
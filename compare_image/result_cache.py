@@ -0,0 +1,223 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+
+import artifacts
+import image_ops
+
+logger = logging.getLogger(__name__)
+
+ENTRY_FILE = "entry.json"
+
+# what lazy artifacts are rendered from (see artifacts.save_outputs)
+OUTPUTS_FILE = "outputs.npz"
+
+# result keys that hold artifact file names (written by workon_images into the upload dir)
+ARTIFACT_KEYS = ("minus", "diff", "thresh", "marked_l", "marked_r")
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """
+    sha256 of the content of a file, read in chunks
+    :param path:
+    :return: hex digest
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def make_key(left_digest, right_digest, params=None):
+    """
+    Cache key of a diff computation: content of the left and right images plus the algorithm parameters.
+    Order matters - left and right are not interchangeable.
+    """
+    key_data = {
+        "left": left_digest,
+        "right": right_digest,
+        "params": params or {},
+        "version": image_ops.ALGORITHM_VERSION,
+    }
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def make_key_for_files(left, right, params=None):
+    return make_key(file_digest(left), file_digest(right), params)
+
+
+def _dir_size(path):
+    total = 0
+    for entry in os.scandir(path):
+        if entry.is_file(follow_symlinks=False):
+            total += entry.stat(follow_symlinks=False).st_size
+    return total
+
+
+class ResultCache:
+    """
+    Persistent, content addressed cache of workon_images results.
+
+    Each entry is a directory <cache_dir>/<key> holding entry.json (the result dict) and a copy of every artifact
+    image. The total size on disk is bounded by max_bytes; the least recently used entries are evicted first.
+    Recency survives restarts through the mtime of entry.json which is touched on every hit.
+
+    lookup and store do file IO and are meant to be called from a thread executor.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()   # key -> bytes on disk, least recently used first
+        self._total_bytes = 0
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        self._load_index()
+
+    def _load_index(self):
+        found = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_dir():
+                continue
+            entry_file = os.path.join(entry.path, ENTRY_FILE)
+            if not os.path.isfile(entry_file):
+                # left over from an interrupted store
+                shutil.rmtree(entry.path, ignore_errors=True)
+                continue
+            found.append((os.stat(entry_file).st_mtime, entry.name, _dir_size(entry.path)))
+
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._total_bytes += size
+
+        logger.info("Result cache {} entries: {} bytes: {}".format(self.cache_dir, len(self._entries), self._total_bytes))
+        self._evict()
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+            self._total_bytes -= size
+            self.evictions += 1
+            logger.debug("Result cache evicted {} ({} bytes)".format(key, size))
+
+    def lookup(self, key, left, right, upload_dir):
+        """
+        Return the cached result for key or None. On a hit the cached artifacts are copied into upload_dir under the
+        names workon_images would have used for left and right, so the result can be used as is. Lazy artifacts that
+        were not rendered yet come back pending.
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+
+        entry_dir = os.path.join(self.cache_dir, key)
+        entry_file = os.path.join(entry_dir, ENTRY_FILE)
+        try:
+            with open(entry_file, 'r') as f:
+                result = json.load(f)
+
+            names = image_ops.artifact_names(left, right, upload_dir)
+            if "outputs" in result:
+                shutil.copyfile(os.path.join(entry_dir, OUTPUTS_FILE), names["outputs"])
+                result["outputs"] = os.path.basename(names["outputs"])
+
+            for k in ARTIFACT_KEYS:
+                if k in result:
+                    # same format as the cached artifact
+                    ext = os.path.splitext(result[k])[1]
+                    name = os.path.splitext(names[k])[0] + ext
+                    if os.path.isfile(os.path.join(entry_dir, k + ext)):
+                        shutil.copyfile(os.path.join(entry_dir, k + ext), name)
+                    else:
+                        # cached before it was rendered - render it from the cached outputs when it is requested
+                        with open(os.path.join(entry_dir, k + artifacts.PENDING_SUFFIX), 'r') as f:
+                            pending = json.load(f)
+                        artifacts.write_pending(name, k, names["outputs"], left, right, {k: pending["format"]})
+                    result[k] = name if k == "minus" else os.path.basename(name)
+
+            os.utime(entry_file)
+        except (OSError, ValueError) as x:
+            logger.warning("Result cache entry {} is unusable: {}".format(key, x))
+            with self._lock:
+                size = self._entries.pop(key, None)
+                if size is not None:
+                    self._total_bytes -= size
+                self.misses += 1
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return result
+
+    def store(self, key, result, upload_dir):
+        """
+        Add a workon_images result (and a copy of its artifacts found in upload_dir) to the cache
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        tmp_dir = os.path.join(self.cache_dir, ".{}.{}".format(key, threading.get_ident()))
+        try:
+            os.makedirs(tmp_dir)
+            if "outputs" in result:
+                shutil.copyfile(os.path.join(upload_dir, result["outputs"]), os.path.join(tmp_dir, OUTPUTS_FILE))
+
+            for k in ARTIFACT_KEYS:
+                if k in result:
+                    artifact = os.path.join(upload_dir, os.path.basename(result[k]))
+                    if artifacts.is_pending(artifact):
+                        shutil.copyfile(artifact + artifacts.PENDING_SUFFIX, os.path.join(tmp_dir, k + artifacts.PENDING_SUFFIX))
+                    else:
+                        shutil.copyfile(artifact, os.path.join(tmp_dir, k + os.path.splitext(artifact)[1]))
+
+            # entry.json is written last - its presence marks a complete entry
+            with open(os.path.join(tmp_dir, ENTRY_FILE), 'w') as f:
+                json.dump(result, f)
+
+            size = _dir_size(tmp_dir)
+            if size > self.max_bytes:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return
+
+            with self._lock:
+                if key in self._entries:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                    return
+                os.rename(tmp_dir, entry_dir)
+                self._entries[key] = size
+                self._total_bytes += size
+                self._evict()
+        except OSError as x:
+            logger.warning("Result cache could not store {}: {}".format(key, x))
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+            }
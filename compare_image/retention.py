@@ -0,0 +1,169 @@
+import logging
+import os
+import shutil
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def _tree_size(path):
+    total = 0
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            total += _tree_size(entry.path)
+        else:
+            total += entry.stat(follow_symlinks=False).st_size
+    return total
+
+
+class Janitor:
+    """
+    Retention of the per session directories in the upload dir.
+
+    A session directory is evicted when it has been idle for longer than ttl seconds, and the oldest idle sessions
+    are evicted first while the upload dir holds more than max_bytes.
+
+    With a sessions.SessionStore the uploads of an expired session are evicted with it, and the session owning
+    evicted uploads is deleted so its pages never refer to images that are gone.
+
+    The janitor keeps an index of session directory sizes. The views update it as files are uploaded (record_upload)
+    and sessions are used (touch); run_once, meant to run in a thread, rescans only the directories whose mtime
+    changed since the last pass.
+    """
+
+    def __init__(self, upload_dir, ttl, max_bytes, interval=60, sessions=None):
+        self.upload_dir = upload_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.sessions = sessions
+
+        self._lock = threading.Lock()
+        # uid -> {"bytes", "mtime" (of the directory when last sized), "last_access"}
+        self._index = {}
+
+        self.passes = 0
+        self.evicted = 0
+        self.bytes_reclaimed = 0
+        self.last_scan_duration = 0.0
+        self.last_scanned = 0
+
+    def record_upload(self, uid, size):
+        with self._lock:
+            entry = self._index.setdefault(uid, {"bytes": 0, "mtime": None, "last_access": 0.0})
+            entry["bytes"] += size
+            entry["last_access"] = time.time()
+
+    def touch(self, uid):
+        with self._lock:
+            entry = self._index.setdefault(uid, {"bytes": 0, "mtime": None, "last_access": 0.0})
+            entry["last_access"] = time.time()
+
+    def total_bytes(self):
+        with self._lock:
+            return sum(entry["bytes"] for entry in self._index.values())
+
+    def _scan(self):
+        scanned = 0
+        seen = set()
+        for dir_entry in os.scandir(self.upload_dir):
+            if not dir_entry.is_dir(follow_symlinks=False):
+                continue
+            uid = dir_entry.name
+            seen.add(uid)
+            mtime = dir_entry.stat(follow_symlinks=False).st_mtime
+
+            with self._lock:
+                entry = self._index.get(uid)
+                if entry is not None and entry["mtime"] == mtime:
+                    continue
+
+            try:
+                size = _tree_size(dir_entry.path)
+            except FileNotFoundError:
+                # removed while we looked at it
+                continue
+            scanned += 1
+
+            with self._lock:
+                entry = self._index.setdefault(uid, {"bytes": 0, "mtime": None, "last_access": 0.0})
+                entry["bytes"] = size
+                entry["mtime"] = mtime
+                entry["last_access"] = max(entry["last_access"], mtime)
+
+        with self._lock:
+            for uid in list(self._index):
+                if uid not in seen:
+                    del self._index[uid]
+
+        return scanned
+
+    def _evict(self, uid):
+        with self._lock:
+            entry = self._index.pop(uid, None)
+        if entry is None:
+            return 0
+        shutil.rmtree(os.path.join(self.upload_dir, uid), ignore_errors=True)
+        if self.sessions is not None:
+            self.sessions.forget_uploads(uid)
+        logger.info("Evicted session {} ({} bytes, idle {:.0f}s)".format(uid, entry["bytes"], time.time() - entry["last_access"]))
+        return entry["bytes"]
+
+    def run_once(self):
+        """
+        One retention pass: rescan changed session directories, evict idle ones, then enforce the quota
+        :return: {"scanned", "evicted", "bytes_reclaimed", "scan_duration"}
+        """
+        t0 = time.time()
+        scanned = self._scan()
+        scan_duration = time.time() - t0
+
+        evicted = 0
+        reclaimed = 0
+        if self.sessions is not None:
+            # nobody can reach the uploads of an expired session
+            for uid in self.sessions.expire():
+                reclaimed += self._evict(uid)
+                evicted += 1
+
+        now = time.time()
+        with self._lock:
+            by_age = sorted(self._index.items(), key=lambda item: item[1]["last_access"])
+            total = sum(entry["bytes"] for _, entry in by_age)
+
+        for uid, entry in by_age:
+            if now - entry["last_access"] <= self.ttl and total <= self.max_bytes:
+                break
+            size = self._evict(uid)
+            total -= size
+            reclaimed += size
+            evicted += 1
+
+        self.passes += 1
+        self.evicted += evicted
+        self.bytes_reclaimed += reclaimed
+        self.last_scan_duration = scan_duration
+        self.last_scanned = scanned
+
+        if evicted:
+            logger.info("Retention pass: scanned {} dirs in {:.3f}s, evicted {} sessions, reclaimed {} bytes".format(
+                scanned, scan_duration, evicted, reclaimed))
+
+        return {"scanned": scanned, "evicted": evicted, "bytes_reclaimed": reclaimed, "scan_duration": scan_duration}
+
+    def stats(self):
+        with self._lock:
+            sessions = len(self._index)
+            total = sum(entry["bytes"] for entry in self._index.values())
+        return {
+            "sessions": sessions,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "passes": self.passes,
+            "evicted": self.evicted,
+            "bytes_reclaimed": self.bytes_reclaimed,
+            "last_scan_duration": self.last_scan_duration,
+            "last_scanned": self.last_scanned,
+        }
@@ -1,17 +1,51 @@
 import os
 import sys
 
-from views import index, image_diff, upload_image_handler, do_diff_computation
+from views import index, image_diff, upload_image_handler, do_diff_computation, cache_stats, \
+    submit_job, job_status, job_histograms, cancel_job, job_stats, batch_diff, \
+    janitor_stats, segment_stats, worker_stats, upload_file, image_tile, add_goldens, match_golden, use_golden, \
+    golden_stats, prometheus_metrics, video_diff, session_stats, queue_stats
 
 
 def setup_routes(app, uploads_dir, static_dir):
 
     # static path '/' will serve static files from the root path but will interfere with index
     app.router.add_static('/static/', path=static_dir, name='static')
+    # files directly in a session's upload dir go through upload_file first - it renders pending diff artifacts
+    app.router.add_get('/uploads/{uid}/{filename}', upload_file)
     app.router.add_static('/uploads/', path=uploads_dir, name='uploads')
 
+    # deep zoom tiles of the images in a session's upload dir
+    app.router.add_get(r'/tiles/{uid}/{filename}/{z:\d+}/{x:\d+}/{y:\d+}.png', image_tile)
+
     app.router.add_get('/', index)
     app.router.add_get('/diff', image_diff)
     app.router.add_get('/do_diff_computation',do_diff_computation)
+    app.router.add_get('/cache/stats', cache_stats)
+    app.router.add_get('/janitor/stats', janitor_stats)
+    app.router.add_get('/sessions/stats', session_stats)
+    app.router.add_get('/segments/stats', segment_stats)
+    app.router.add_get('/workers/stats', worker_stats)
+    app.router.add_get('/metrics', prometheus_metrics)
 
     app.router.add_post('/upload/image',upload_image_handler)
+
+    # diff jobs
+    app.router.add_post('/jobs', submit_job)
+    app.router.add_get('/jobs/stats', job_stats)
+    app.router.add_get('/queue/stats', queue_stats)
+    app.router.add_get('/jobs/{job_id}', job_status)
+    app.router.add_get('/jobs/{job_id}/histograms', job_histograms)
+    app.router.add_delete('/jobs/{job_id}', cancel_job)
+
+    # one golden image against many captures
+    app.router.add_post('/batch', batch_diff)
+
+    # a captured video against a golden video or image
+    app.router.add_post('/video', video_diff)
+
+    # golden image library - which golden image does a capture show
+    app.router.add_post('/goldens', add_goldens)
+    app.router.add_post('/goldens/match', match_golden)
+    app.router.add_get('/goldens/stats', golden_stats)
+    app.router.add_post('/goldens/{golden_id}/use', use_golden)
@@ -0,0 +1,206 @@
+"""
+Server side sessions: the cookie only carries an opaque random id, the session data stays in the server process.
+
+SimpleCookieStorage sent the whole session as JSON in the cookie, parsed it on every request and set it again on
+every response, and the cookie grew with every upload. Here a request looks its session up in a dict and the response
+sets the cookie only when the session is new.
+
+Sessions idle for longer than ttl seconds are evicted. The store also knows which session owns which upload dir (the
+"uid" of the session), so retention can evict the uploads of an expired session and drop the session of evicted
+uploads - a page never refers to images that are gone.
+
+With a path the sessions are also kept in a SQLite file and survive a restart. Writes are batched: a changed session
+is only marked dirty and flush, run in a thread with the retention pass, writes all of them in one transaction. A
+crash loses the changes since the last flush, not the sessions.
+"""
+import collections
+import contextlib
+import copy
+import json
+import logging
+import secrets
+import sqlite3
+import threading
+import time
+
+from aiohttp_session import AbstractStorage, Session
+
+logger = logging.getLogger(__name__)
+
+
+class SessionStore(AbstractStorage):
+    """
+    aiohttp_session storage keeping the sessions in memory, optionally persisted to a SQLite file
+    """
+
+    def __init__(self, ttl, path=None, cookie_name="IMAGE_DIFF_SESSION"):
+        """
+        :param ttl: seconds after which an idle session is evicted
+        :param path: SQLite file the sessions are persisted to, None to keep them in memory only
+        """
+        super().__init__(cookie_name=cookie_name)
+        self.ttl = ttl
+        self.path = path
+
+        self._lock = threading.Lock()
+        # id -> [last access, {"created", "session"}], least recently used first
+        self._sessions = collections.OrderedDict()
+        # upload dir uid -> session id
+        self._owners = {}
+        # ids changed (or deleted) since the last flush
+        self._dirty = set()
+
+        self.created = 0
+        self.expired = 0
+        self.flushes = 0
+        self.last_flush_duration = 0.0
+
+        if path is not None:
+            self._load()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path)
+        db.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, last_access REAL NOT NULL, data TEXT NOT NULL)")
+        return db
+
+    def _load(self):
+        with contextlib.closing(self._connect()) as db:
+            rows = db.execute("SELECT id, last_access, data FROM sessions WHERE last_access > ? ORDER BY last_access",
+                              (time.time() - self.ttl,)).fetchall()
+        for key, last_access, data in rows:
+            self._put(key, json.loads(data), last_access)
+        logger.info("Loaded {} sessions from {}".format(len(rows), self.path))
+
+    def _put(self, key, data, last_access):
+        # with the lock held
+        old = self._sessions.pop(key, None)
+        if old is not None:
+            self._owners.pop(old[1]["session"].get("uid"), None)
+        self._sessions[key] = [last_access, data]
+        uid = data["session"].get("uid")
+        if uid is not None:
+            self._owners[uid] = key
+
+    def _delete(self, key):
+        # with the lock held
+        entry = self._sessions.pop(key, None)
+        if entry is None:
+            return None
+        uid = entry[1]["session"].get("uid")
+        if self._owners.get(uid) == key:
+            del self._owners[uid]
+        self._dirty.add(key)
+        return uid
+
+    async def load_session(self, request):
+        key = self.load_cookie(request)
+        with self._lock:
+            entry = self._sessions.get(key) if key else None
+            now = time.time()
+            if entry is not None and now - entry[0] > self.ttl:
+                self._delete(key)
+                entry = None
+            if entry is not None:
+                entry[0] = now
+                self._sessions.move_to_end(key)
+            # the views change nested values in place, the stored session is only replaced by save_session
+            data = copy.deepcopy(entry[1]) if entry is not None else None
+        if data is None:
+            return Session(None, data=None, new=True, max_age=self.max_age)
+        return Session(key, data=data, new=False, max_age=self.max_age)
+
+    async def save_session(self, request, response, session):
+        key = session.identity
+        if session.empty:
+            if key is not None:
+                with self._lock:
+                    self._delete(key)
+            self.save_cookie(response, "", max_age=session.max_age)
+            return
+
+        if key is None:
+            key = secrets.token_urlsafe(32)
+            self.created += 1
+            self.save_cookie(response, key, max_age=session.max_age)
+
+        with self._lock:
+            self._put(key, {"created": session.created, "session": dict(session)}, time.time())
+            self._dirty.add(key)
+
+    def owner(self, uid):
+        """
+        :return: the id of the session whose uploads are in the upload dir uid, None if no session has it
+        """
+        with self._lock:
+            return self._owners.get(uid)
+
+    def forget_uploads(self, uid):
+        """
+        Delete the session owning the upload dir uid, its next request starts a new one
+        """
+        with self._lock:
+            key = self._owners.get(uid)
+            if key is not None:
+                self._delete(key)
+
+    def expire(self):
+        """
+        Evict the sessions idle for longer than ttl
+        :return: the upload dir uids of the evicted sessions
+        """
+        deadline = time.time() - self.ttl
+        uids = []
+        with self._lock:
+            while self._sessions:
+                key, (last_access, _) = next(iter(self._sessions.items()))
+                if last_access > deadline:
+                    break
+                uid = self._delete(key)
+                if uid is not None:
+                    uids.append(uid)
+                self.expired += 1
+        return uids
+
+    def flush(self):
+        """
+        Write the sessions changed since the last flush to the SQLite file, in one transaction
+        """
+        if self.path is None:
+            return
+
+        with self._lock:
+            dirty = self._dirty
+            self._dirty = set()
+            changed = [(key, self._sessions[key][0], json.dumps(self._sessions[key][1]))
+                       for key in dirty if key in self._sessions]
+            deleted = [(key,) for key in dirty if key not in self._sessions]
+        if not changed and not deleted:
+            return
+
+        t0 = time.time()
+        try:
+            with contextlib.closing(self._connect()) as db, db:
+                db.executemany("INSERT OR REPLACE INTO sessions (id, last_access, data) VALUES (?, ?, ?)", changed)
+                db.executemany("DELETE FROM sessions WHERE id = ?", deleted)
+        except sqlite3.Error:
+            # written with the next flush
+            with self._lock:
+                self._dirty.update(dirty)
+            raise
+        self.flushes += 1
+        self.last_flush_duration = time.time() - t0
+
+    def stats(self):
+        with self._lock:
+            sessions = len(self._sessions)
+            dirty = len(self._dirty)
+        return {
+            "sessions": sessions,
+            "ttl": self.ttl,
+            "path": self.path,
+            "created": self.created,
+            "expired": self.expired,
+            "dirty": dirty,
+            "flushes": self.flushes,
+            "last_flush_duration": self.last_flush_duration,
+        }
@@ -0,0 +1,131 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# tmpfs when there is one: segments never touch a disk
+DEFAULT_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+SEGMENT_DIR_PREFIX = "image_diff-"
+
+
+def attach(handle):
+    """
+    Called in a worker process: a read only numpy view of a segment. The pages are shared with the server process,
+    nothing is copied or decoded.
+    """
+    return np.load(handle["path"], mmap_mode='r')
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SegmentStore:
+    """
+    Decoded images handed to the process pool without pickling them.
+
+    decode() runs cv2.imread once in the server process (in a thread, opencv releases the GIL) and writes the pixels
+    as a raw .npy file into a directory on tmpfs. The worker gets a small picklable handle and maps the file with
+    attach(). Every segment must be release()d by the caller once the job finished, failed or was cancelled - a
+    worker that still has it mapped keeps its view, the memory is returned when it drops it.
+
+    The segments of a server live in <base_dir>/image_diff-<pid>; open() removes the directories of servers that
+    are no longer running so a crash does not leak tmpfs memory.
+    """
+
+    def __init__(self, base_dir=DEFAULT_DIR):
+        self.base_dir = base_dir
+        self.dir = os.path.join(base_dir, "{}{}".format(SEGMENT_DIR_PREFIX, os.getpid()))
+
+        self._lock = threading.Lock()
+        # path -> size in bytes
+        self._segments = {}
+
+        self.created = 0
+        self.released = 0
+        self.failed = 0
+        self.peak_bytes = 0
+
+    def open(self):
+        for entry in os.scandir(self.base_dir):
+            if not entry.is_dir(follow_symlinks=False) or not entry.name.startswith(SEGMENT_DIR_PREFIX):
+                continue
+            try:
+                pid = int(entry.name[len(SEGMENT_DIR_PREFIX):])
+            except ValueError:
+                continue
+            if pid != os.getpid() and not _pid_alive(pid):
+                logger.info("Removing stale image segments {}".format(entry.path))
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+
+    def close(self):
+        with self._lock:
+            self._segments.clear()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def decode(self, image_path):
+        """
+        Decode an image into a new segment
+        :return: handle {"path", "shape", "dtype"} or None if opencv can not load the image
+        :raise OSError: when the segment can not be written (e.g. tmpfs is full) - nothing is left behind
+        """
+        image = cv2.imread(image_path)
+        if image is None:
+            return None
+
+        path = os.path.join(self.dir, "{}.npy".format(uuid.uuid4().hex))
+        try:
+            # plain writes rather than a writable memmap: a full tmpfs raises ENOSPC here instead of a SIGBUS
+            with open(path, 'wb') as f:
+                np.lib.format.write_array(f, image, allow_pickle=False)
+        except OSError:
+            self.failed += 1
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+
+        with self._lock:
+            self._segments[path] = image.nbytes
+            self.created += 1
+            self.peak_bytes = max(self.peak_bytes, sum(self._segments.values()))
+
+        return {"path": path, "shape": image.shape, "dtype": str(image.dtype)}
+
+    def release(self, handle):
+        with self._lock:
+            if self._segments.pop(handle["path"], None) is None:
+                return
+            self.released += 1
+        try:
+            os.remove(handle["path"])
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "dir": self.dir,
+                "segments": len(self._segments),
+                "bytes": sum(self._segments.values()),
+                "peak_bytes": self.peak_bytes,
+                "created": self.created,
+                "released": self.released,
+                "failed": self.failed,
+            }
@@ -0,0 +1,96 @@
+// Histogram charts drawn in the browser from the counts of a diff job (GET /jobs/<id>/histograms):
+// {"left": {"h", "b", "g", "r"}, "right": {...}} with 256 counts each, the channels are missing for a gray image.
+
+var HISTOGRAM_COLORS = {b: "blue", g: "green", r: "red"};
+
+function drawHistogramPanel(ctx, x0, y0, width, height, title, series, ymin, ymax) {
+    var margin = {left: 60, right: 10, top: 20, bottom: 25};
+    var w = width - margin.left - margin.right;
+    var h = height - margin.top - margin.bottom;
+    var left = x0 + margin.left;
+    var top = y0 + margin.top;
+
+    function px(bin) { return left + (bin + 0.5) * w / 256; }
+    function py(count) { return top + h - (count - ymin) * h / (ymax - ymin || 1); }
+
+    ctx.fillStyle = "#000";
+    ctx.font = "12px sans-serif";
+    ctx.textAlign = "left";
+    ctx.fillText(title, left, y0 + 14);
+
+    // axes and the zero line
+    ctx.strokeStyle = "#666";
+    ctx.lineWidth = 1;
+    ctx.strokeRect(left, top, w, h);
+    if (ymin < 0) {
+        ctx.beginPath();
+        ctx.moveTo(left, py(0));
+        ctx.lineTo(left + w, py(0));
+        ctx.stroke();
+    }
+    ctx.textAlign = "right";
+    ctx.fillText(String(ymax), left - 4, top + 10);
+    ctx.fillText(String(ymin), left - 4, top + h);
+    ctx.textAlign = "center";
+    [0, 64, 128, 192, 255].forEach(function (bin) { ctx.fillText(String(bin), px(bin), top + h + 15); });
+
+    // all values as gray bars, the channels as lines
+    ctx.fillStyle = "rgba(128, 128, 128, 0.3)";
+    series.h.forEach(function (count, bin) {
+        var y = py(Math.max(count, ymin)), y0 = py(Math.max(0, ymin));
+        ctx.fillRect(px(bin) - 0.4 * w / 256, Math.min(y, y0), 0.8 * w / 256, Math.abs(y0 - y));
+    });
+    Object.keys(HISTOGRAM_COLORS).forEach(function (channel) {
+        if (!series[channel]) {
+            return;
+        }
+        ctx.strokeStyle = HISTOGRAM_COLORS[channel];
+        ctx.beginPath();
+        series[channel].forEach(function (count, bin) {
+            if (bin === 0) {
+                ctx.moveTo(px(bin), py(count));
+            } else {
+                ctx.lineTo(px(bin), py(count));
+            }
+        });
+        ctx.stroke();
+    });
+}
+
+function subtractSeries(a, b) {
+    var delta = {};
+    Object.keys(a).forEach(function (name) {
+        if (b[name]) {
+            delta[name] = a[name].map(function (count, bin) { return count - b[name][bin]; });
+        }
+    });
+    return delta;
+}
+
+function seriesRange(list) {
+    var values = [];
+    list.forEach(function (series) {
+        Object.keys(series).forEach(function (name) { values = values.concat(series[name]); });
+    });
+    return [Math.min(0, Math.min.apply(null, values)), Math.max.apply(null, values)];
+}
+
+function drawHistograms(url, sideBySideId, diffId) {
+    fetch(url, {credentials: "same-origin"})
+        .then(function (response) { return response.json(); })
+        .then(function (histograms) {
+            // left and right image side by side on the same scale
+            var canvas = document.getElementById(sideBySideId);
+            var ctx = canvas.getContext("2d");
+            var range = seriesRange([histograms.left, histograms.right]);
+            drawHistogramPanel(ctx, 0, 0, canvas.width / 2, canvas.height, "left image", histograms.left, range[0], range[1]);
+            drawHistogramPanel(ctx, canvas.width / 2, 0, canvas.width / 2, canvas.height, "right image", histograms.right, range[0], range[1]);
+
+            // left - right
+            canvas = document.getElementById(diffId);
+            ctx = canvas.getContext("2d");
+            var delta = subtractSeries(histograms.left, histograms.right);
+            range = seriesRange([delta]);
+            drawHistogramPanel(ctx, 0, 0, canvas.width, canvas.height, "left - right", delta, range[0], range[1]);
+        });
+}
@@ -0,0 +1,206 @@
+"""
+Where the time goes: per stage timings of the diff pipeline and request statistics of the server, served in the
+Prometheus text format on GET /metrics.
+
+The workers only measure - workon_images times its stages with a Stages and returns them with the result as
+"timings": {stage: seconds} - and everything is aggregated in the server process, in the Registry of the app. No
+locks: the families are only touched from the event loop.
+
+Histograms count observations into fixed buckets (Prometheus computes quantiles from the buckets, across servers).
+Summaries keep the last observations of each series and compute their quantiles when /metrics is scraped, so an
+observation is an append.
+"""
+import bisect
+import collections
+import contextlib
+import time
+
+# seconds, from a cache hit to a huge SSIM
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# pixels per image, VGA to 8K
+PIXEL_BUCKETS = (640 * 480, 1280 * 720, 1920 * 1080, 2560 * 1440, 3840 * 2160, 7680 * 4320)
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+# observations a summary series keeps for its quantiles
+SUMMARY_WINDOW = 1024
+
+
+class Stages:
+    """
+    Durations of the stages of one computation:
+
+        stages = Stages()
+        with stages("ssim"):
+            ...
+        stages.seconds  # {"ssim": 0.12}
+
+    A stage entered more than once adds up.
+    """
+
+    def __init__(self):
+        self.seconds = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def __call__(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - t0
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join("{}=\"{}\"".format(name, _escape(value)) for name, value in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Family:
+    """
+    A metric name and its series, one per combination of label values
+    """
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._series = collections.OrderedDict()
+
+    def _get(self, values):
+        if len(values) != len(self.labels):
+            raise ValueError("{} takes the labels {}".format(self.name, ", ".join(self.labels)))
+        series = self._series.get(values)
+        if series is None:
+            series = self._series[values] = self._new()
+        return series
+
+    def exposition(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.type)]
+        for values, series in self._series.items():
+            lines.extend(self._lines(values, series))
+        return lines
+
+
+class Counter(_Family):
+    type = "counter"
+
+    def _new(self):
+        return [0.0]
+
+    def inc(self, *values, amount=1):
+        self._get(values)[0] += amount
+
+    def _lines(self, values, series):
+        yield "{}{} {}".format(self.name, _labels(self.labels, values), _number(series[0]))
+
+
+class Histogram(_Family):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new(self):
+        # a count per bucket and one for +Inf, the sum
+        return [[0] * (len(self.buckets) + 1), 0.0]
+
+    def observe(self, value, *values):
+        series = self._get(values)
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def _lines(self, values, series):
+        counts, total = series
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            yield "{}_bucket{} {}".format(self.name, _labels(self.labels, values, ("le", _number(bound))), cumulative)
+        yield "{}_sum{} {}".format(self.name, _labels(self.labels, values), _number(total))
+        yield "{}_count{} {}".format(self.name, _labels(self.labels, values), cumulative)
+
+
+class Summary(_Family):
+    type = "summary"
+
+    def __init__(self, name, help, labels=(), quantiles=QUANTILES, window=SUMMARY_WINDOW):
+        super().__init__(name, help, labels)
+        self.quantiles = quantiles
+        self.window = window
+
+    def _new(self):
+        # the last observations, the count and the sum of all of them
+        return [collections.deque(maxlen=self.window), 0, 0.0]
+
+    def observe(self, value, *values):
+        series = self._get(values)
+        series[0].append(value)
+        series[1] += 1
+        series[2] += value
+
+    def _lines(self, values, series):
+        recent = sorted(series[0])
+        for q in self.quantiles:
+            if recent:
+                value = recent[min(len(recent) - 1, int(q * len(recent)))]
+                yield "{}{} {}".format(self.name, _labels(self.labels, values, ("quantile", q)), _number(value))
+        yield "{}_sum{} {}".format(self.name, _labels(self.labels, values), _number(series[2]))
+        yield "{}_count{} {}".format(self.name, _labels(self.labels, values), series[1])
+
+
+class Registry:
+    """
+    The metric families of a server, created on first use: registry.histogram(name, ...) returns the same Histogram
+    every time it is called with that name.
+    """
+
+    def __init__(self):
+        self._families = collections.OrderedDict()
+
+    def _family(self, cls, name, *args, **kwargs):
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = cls(name, *args, **kwargs)
+        elif not isinstance(family, cls):
+            raise ValueError("{} is a {}".format(name, family.type))
+        return family
+
+    def counter(self, name, help, labels=()):
+        return self._family(Counter, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._family(Histogram, name, help, labels, buckets)
+
+    def summary(self, name, help, labels=()):
+        return self._family(Summary, name, help, labels)
+
+    def exposition(self, samples=()):
+        """
+        The Prometheus text format of all families
+        :param samples: values only known at scrape time, [(name, "gauge" or "counter", help, [(labels dict, value)])]
+        """
+        lines = []
+        for family in self._families.values():
+            lines.extend(family.exposition())
+        for name, type, help, values in samples:
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, type))
+            for labels, value in values:
+                lines.append("{}{} {}".format(name, _labels(list(labels), list(labels.values())), _number(value)))
+        return "\n".join(lines) + "\n"
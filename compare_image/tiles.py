@@ -0,0 +1,136 @@
+"""
+Deep zoom tiles of the uploaded and artifact images for the side by side viewers.
+
+The pyramid of an image of width x height pixels has levels z = 0 .. max_zoom. At level z one tile pixel covers
+2 ** (max_zoom - z) image pixels, so the whole image fits one tile at level 0 and level max_zoom is full resolution.
+Tiles are numbered TMS style, the way bokeh's TMSTileSource asks for them with x_origin_offset = y_origin_offset = 0
+and initial_resolution = 2 ** max_zoom: x counts columns from the left edge of the image and y counts rows up from
+its bottom edge. The plot coordinates are image pixels with y pointing up from the bottom row. Tiles overhanging the
+image are transparent.
+
+Tiles are rendered on request (in a worker, the levels come from its decoded image cache) and kept on disk next to
+the image, in .tiles/<filename>-<mtime>/<z>/<x>_<y>.png.
+"""
+import math
+import os
+import shutil
+import uuid
+
+import cv2
+import numpy as np
+
+import decoded_cache
+
+TILE_SIZE = 256
+
+TILES_DIR = ".tiles"
+
+# levels rendered when an image is uploaded: what the viewers show before zooming in
+PRERENDER_LEVELS = 2
+
+
+def max_zoom(width, height):
+    return max(0, int(math.ceil(math.log2(max(width, height) / TILE_SIZE))))
+
+
+def pyramid(image):
+    """
+    The levels of image from full resolution down to one that fits a tile, each half the size of the previous one
+    """
+    levels = [image]
+    while max(levels[-1].shape[:2]) > TILE_SIZE:
+        h, w = levels[-1].shape[:2]
+        levels.append(cv2.resize(levels[-1], ((w + 1) // 2, (h + 1) // 2), interpolation=cv2.INTER_AREA))
+    return levels
+
+
+def tile_dir(path):
+    mtime = os.stat(path).st_mtime_ns
+    return os.path.join(os.path.dirname(path), TILES_DIR, "{}-{}".format(os.path.basename(path), mtime))
+
+
+def tile_path(path, z, x, y):
+    return os.path.join(tile_dir(path), str(z), "{}_{}.png".format(x, y))
+
+
+def _remove_stale(path):
+    # tiles of an earlier file with the same name
+    tiles_dir = os.path.dirname(tile_dir(path))
+    current = os.path.basename(tile_dir(path))
+    prefix = os.path.basename(path) + "-"
+    for entry in os.scandir(tiles_dir):
+        if entry.name.startswith(prefix) and entry.name != current and entry.name[len(prefix):].isdigit():
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def render_tile(path, z, x, y):
+    """
+    Runs in a worker: render tile z/x/y of the image at path and write it to tile_path
+    :raise ValueError: when the tile is outside the pyramid or the image can not be loaded
+    """
+    decoded = decoded_cache.load(path)
+    if decoded is None:
+        raise ValueError("Image could not be loaded into opencv")
+
+    height, width = decoded.image.shape[:2]
+    zoom = max_zoom(width, height)
+    if not 0 <= z <= zoom or x < 0 or y < 0:
+        raise ValueError("no tile {}/{}/{}".format(z, x, y))
+
+    level = decoded.get("pyramid", pyramid)[zoom - z]
+    lh, lw = level.shape[:2]
+
+    # y counts tiles up from the bottom row
+    r0, r1 = lh - (y + 1) * TILE_SIZE, lh - y * TILE_SIZE
+    c0, c1 = x * TILE_SIZE, (x + 1) * TILE_SIZE
+    if r1 <= 0 or c0 >= lw:
+        raise ValueError("no tile {}/{}/{}".format(z, x, y))
+
+    block = level[max(0, r0):r1, c0:min(c1, lw)]
+    if block.ndim == 2:
+        block = cv2.cvtColor(block, cv2.COLOR_GRAY2BGRA)
+    else:
+        block = cv2.cvtColor(block, cv2.COLOR_BGR2BGRA)
+
+    tile = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+    tile[max(0, r0) - r0:TILE_SIZE, 0:block.shape[1]] = block
+
+    out = tile_path(path, z, x, y)
+    if not os.path.exists(os.path.dirname(out)):
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+        _remove_stale(path)
+
+    tmp = os.path.join(os.path.dirname(out), ".tile-{}.png".format(uuid.uuid4().hex))
+    try:
+        cv2.imwrite(tmp, tile, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        os.replace(tmp, out)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return out
+
+
+def prerender(path, levels=PRERENDER_LEVELS):
+    """
+    Runs in a worker when an image is uploaded: decode it - it stays in the worker's decoded image cache for the
+    diff - and render every tile of the levels up to levels. The level 0 tile is the thumbnail of the image.
+    :return: {"width", "height", "max_zoom", "tiles": number of tiles rendered}
+    :raise ValueError: when the image can not be loaded
+    """
+    decoded = decoded_cache.load(path)
+    if decoded is None:
+        raise ValueError("Image could not be loaded into opencv")
+
+    height, width = decoded.image.shape[:2]
+    zoom = max_zoom(width, height)
+
+    rendered = 0
+    for z in range(min(levels, zoom) + 1):
+        lh, lw = decoded.get("pyramid", pyramid)[zoom - z].shape[:2]
+        for x in range(int(math.ceil(lw / TILE_SIZE))):
+            for y in range(int(math.ceil(lh / TILE_SIZE))):
+                if not os.path.isfile(tile_path(path, z, x, y)):
+                    render_tile(path, z, x, y)
+                    rendered += 1
+
+    return {"width": width, "height": height, "max_zoom": zoom, "tiles": rendered}
@@ -0,0 +1,188 @@
+import hashlib
+import logging
+import os
+import struct
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# bytes read from the multipart stream per read_chunk call
+READ_CHUNK_SIZE = 256 * 1024
+
+# reads are gathered into writes of this size which are done in the upload thread pool
+WRITE_CHUNK_SIZE = 4 * 1024 * 1024
+
+# give up looking for the image header after this many bytes (jpeg headers can follow a large exif block)
+MAX_HEADER_BYTES = 256 * 1024
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+def _png_header(data):
+    # signature, IHDR length + type, width, height, bit depth, color type
+    if len(data) < 26:
+        return None
+    width, height = struct.unpack(">II", data[16:24])
+    channels = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}.get(data[25])
+    return {"format": "png", "width": width, "height": height, "channels": channels}
+
+
+def _jpeg_header(data):
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # fill byte
+            i += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            # markers without a length
+            i += 2
+            continue
+        length = struct.unpack(">H", data[i + 2:i + 4])[0]
+        # start of frame markers (not DHT 0xC4, JPG 0xC8, DAC 0xCC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(">HH", data[i + 5:i + 9])
+            return {"format": "jpeg", "width": width, "height": height, "channels": data[i + 9]}
+        i += 2 + length
+    return None
+
+
+def _bmp_header(data):
+    if len(data) < 30:
+        return None
+    width, height = struct.unpack("<ii", data[18:26])
+    bits = struct.unpack("<H", data[28:30])[0]
+    return {"format": "bmp", "width": width, "height": abs(height), "channels": 4 if bits == 32 else (3 if bits >= 16 else 1)}
+
+
+def _tiff_header(data):
+    endian = "<" if data[:2] == b"II" else ">"
+    if len(data) < 8:
+        return None
+    offset = struct.unpack(endian + "I", data[4:8])[0]
+    if offset + 2 > len(data):
+        return None
+    count = struct.unpack(endian + "H", data[offset:offset + 2])[0]
+    tags = {}
+    for n in range(count):
+        entry = offset + 2 + 12 * n
+        if entry + 12 > len(data):
+            return None
+        tag, field_type = struct.unpack(endian + "HH", data[entry:entry + 4])
+        if field_type == 3:     # SHORT
+            value = struct.unpack(endian + "H", data[entry + 8:entry + 10])[0]
+        elif field_type == 4:   # LONG
+            value = struct.unpack(endian + "I", data[entry + 8:entry + 12])[0]
+        else:
+            continue
+        tags[tag] = value
+    if 256 not in tags or 257 not in tags:
+        return None
+    return {"format": "tiff", "width": tags[256], "height": tags[257], "channels": tags.get(277, 1)}
+
+
+def sniff_image_header(data):
+    """
+    Dimensions of an image from the first bytes of its file
+    :param data: start of the file
+    :return: {"format", "width", "height", "channels"} or None if the format is unknown or data is too short
+    """
+    try:
+        if data.startswith(b"\x89PNG\r\n\x1a\n"):
+            return _png_header(data)
+        if data.startswith(b"\xff\xd8"):
+            return _jpeg_header(data)
+        if data.startswith(b"BM"):
+            return _bmp_header(data)
+        if data[:4] in (b"II*\x00", b"MM\x00*"):
+            return _tiff_header(data)
+    except struct.error:
+        pass
+    return None
+
+
+def file_header(path):
+    """
+    sniff_image_header of a file on disk
+    :return: None if the file is missing or its format is unknown
+    """
+    try:
+        with open(path, 'rb') as f:
+            return sniff_image_header(f.read(MAX_HEADER_BYTES))
+    except OSError:
+        return None
+
+
+def _write_chunk(f, sha256, data):
+    # runs in the upload thread pool - hashlib releases the GIL for large buffers
+    sha256.update(data)
+    f.write(data)
+
+
+async def save_part(part, path, loop, executor, max_size):
+    """
+    Stream a multipart part to path. The event loop only reads from the socket; hashing and writing happen in
+    executor, overlapped with reading the next chunk. The data goes to a temporary file that is renamed to path once
+    complete, so a failed upload never leaves a partial image behind.
+    :param max_size: maximum size in bytes, UploadTooLarge is raised when the part is bigger
+    :return: {"size", "sha256", "format", "width", "height", "channels"} - the image fields are None when the
+             header could not be parsed
+    """
+    tmp_path = os.path.join(os.path.dirname(path), ".upload-{}".format(uuid.uuid4().hex))
+    sha256 = hashlib.sha256()
+    size = 0
+    header = b""
+    info = None
+    buffer = bytearray()
+    pending = None
+
+    f = await loop.run_in_executor(executor, open, tmp_path, 'wb')
+    try:
+        while True:
+            chunk = await part.read_chunk(READ_CHUNK_SIZE)
+            if chunk:
+                size += len(chunk)
+                if size > max_size:
+                    raise UploadTooLarge("upload is larger than {} bytes".format(max_size))
+
+                if info is None and len(header) < MAX_HEADER_BYTES:
+                    header += chunk[:MAX_HEADER_BYTES - len(header)]
+                    info = sniff_image_header(header)
+
+                buffer.extend(chunk)
+
+            if len(buffer) >= WRITE_CHUNK_SIZE or (not chunk and buffer):
+                # at most one write in flight: it runs while the next chunks are read
+                if pending is not None:
+                    await pending
+                pending = loop.run_in_executor(executor, _write_chunk, f, sha256, bytes(buffer))
+                buffer = bytearray()
+
+            if not chunk:
+                break
+
+        if pending is not None:
+            await pending
+            pending = None
+        await loop.run_in_executor(executor, f.close)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if pending is not None:
+            try:
+                await pending
+            except Exception:
+                pass
+        f.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    result = {"size": size, "sha256": sha256.hexdigest(), "format": None, "width": None, "height": None, "channels": None}
+    if info is not None:
+        result.update(info)
+    return result
@@ -32,7 +32,23 @@ def compute_shift_row_col_parameters(rows, cols, shift_row, shift_col):
 
     return start_row, stop_row, start_col, stop_col
 
-def detect_shift_using_correlation(im1, im2):
+def detect_shift_using_correlation(im1, im2, method="full", pyramid_levels=None):
+   """
+   Detect how much im2 is shifted relative to im1 (same dimensions)
+   :param im1: golden image
+   :param im2: captured image
+   :param method: "full" correlates the full resolution images, "pyramid" estimates the shift on a downscaled
+                  copy and refines it at full resolution in a small window (much faster, far less memory)
+   :param pyramid_levels: number of pyramid levels (halvings) for the "pyramid" method. None picks it from the size
+   :return: start_row, end_row, start_col, end_col to crop away
+   """
+   if method == "pyramid":
+      shift_row, shift_col = detect_shift_using_pyramid(im1, im2, levels=pyramid_levels)
+      start_row, stop_row, start_col, stop_col = compute_shift_row_col_parameters(im1.shape[0], im1.shape[1], shift_row, shift_col)
+      return start_row, im1.shape[0] - stop_row, start_col, im1.shape[1] - stop_col
+   elif method != "full":
+      raise ValueError("Unknown shift detection method {}".format(method))
+
    # get rid of the color channels by performing a grayscale transform
    # the type cast into 'float' is to avoid overflows
    im1_gray = np.sum(im1.astype('float'), axis=2)
@@ -55,77 +71,178 @@ def detect_shift_using_correlation(im1, im2):
    return start_row, im1.shape[0] - stop_row, start_col, im1.shape[1] - stop_col
 
 
+def correlation_spectrum(im1):
+    """
+    FFT of the golden image as used by the "full" correlation. Comparing one golden image against many captures
+    computes it once and passes it to detect_shift_from_spectrum for every capture.
+    """
+    im1_gray = np.sum(im1.astype('float'), axis=2)
+    im1_gray -= np.mean(im1_gray)
+    shape = (cv2.getOptimalDFTSize(2 * im1.shape[0] - 1), cv2.getOptimalDFTSize(2 * im1.shape[1] - 1))
+    return np.fft.rfft2(im1_gray, shape)
+
 
-def detect_shift(image, black=(20,20,20)):
+def detect_shift_from_spectrum(spectrum, im2):
+    """
+    Same as detect_shift_using_correlation(im1, im2, method="full") given spectrum = correlation_spectrum(im1)
+    :return: start_row, end_row, start_col, end_col to crop away
+    """
+    rows, cols = im2.shape[0], im2.shape[1]
+    shape = (cv2.getOptimalDFTSize(2 * rows - 1), cv2.getOptimalDFTSize(2 * cols - 1))
+
+    im2_gray = np.sum(im2.astype('float'), axis=2)
+    im2_gray -= np.mean(im2_gray)
+
+    # full linear convolution with the flipped capture, cropped to the 'same' region like fftconvolve does
+    im1xim2 = np.fft.irfft2(spectrum * np.fft.rfft2(im2_gray[::-1, ::-1], shape), shape)
+    im1xim2 = im1xim2[(rows - 1) // 2:(rows - 1) // 2 + rows, (cols - 1) // 2:(cols - 1) // 2 + cols]
+
+    center = np.unravel_index(np.argmax(im1xim2), im1xim2.shape)
+
+    shift_row = int(rows / 2.0 - center[0])
+    shift_col = int(cols / 2.0 - center[1])
+
+    start_row, stop_row, start_col, stop_col = compute_shift_row_col_parameters(rows, cols, shift_row, shift_col)
+
+    return start_row, rows - stop_row, start_col, cols - stop_col
+
+
+def _gray32(image):
+    # channel sum in float32 - same "grayscale" as the full correlation but half the memory
+    if image.ndim == 2:
+        return image.astype(np.float32)
+    return np.sum(image, axis=2, dtype=np.float32)
+
+
+def _correlation_shift(a, b):
+    """
+    Shift (rows, cols) of b relative to a using a mean subtracted cross correlation computed with real FFTs.
+    The FFT is padded to fast sizes large enough to avoid circular wrap around.
+    """
+    a = a - a.mean()
+    b = b - b.mean()
+    shape = (cv2.getOptimalDFTSize(2 * a.shape[0] - 1), cv2.getOptimalDFTSize(2 * a.shape[1] - 1))
+
+    corr = np.fft.irfft2(np.fft.rfft2(a, shape) * np.conj(np.fft.rfft2(b, shape)), shape)
+    peak = np.unravel_index(np.argmax(corr), corr.shape)
+
+    # corr peaks at -shift (modulo the padded size)
+    shift = []
+    for p, n in zip(peak, shape):
+        if p > n // 2:
+            p -= n
+        shift.append(-int(p))
+    return shift[0], shift[1]
+
+
+def detect_shift_using_pyramid(im1, im2, levels=None, max_coarse_size=512, patch_size=512):
+    """
+    Coarse to fine shift detection.
+    The shift is first estimated on im1/im2 downscaled by 2**levels, then refined at full resolution by matching a
+    central patch of im1 against im2 in a small window around the coarse estimate.
+    :return: shift_row, shift_col: how much im2 is shifted down/right relative to im1
+    """
+    rows, cols = im1.shape[0], im1.shape[1]
+
+    if levels is None:
+        levels = 0
+        while max(rows, cols) >> levels > max_coarse_size:
+            levels += 1
+    factor = 2 ** levels
+
+    if factor > 1:
+        size = (max(1, cols // factor), max(1, rows // factor))
+        coarse1 = _gray32(cv2.resize(im1, size, interpolation=cv2.INTER_AREA))
+        coarse2 = _gray32(cv2.resize(im2, size, interpolation=cv2.INTER_AREA))
+    else:
+        coarse1 = _gray32(im1)
+        coarse2 = _gray32(im2)
+
+    shift_row, shift_col = _correlation_shift(coarse1, coarse2)
+    shift_row *= factor
+    shift_col *= factor
+
+    if factor == 1:
+        return shift_row, shift_col
+
+    # refine: the true shift is within +-factor of the coarse estimate
+    radius = factor
+    patch_rows = min(patch_size, rows - 2 * (abs(shift_row) + radius))
+    patch_cols = min(patch_size, cols - 2 * (abs(shift_col) + radius))
+    if patch_rows < 16 or patch_cols < 16:
+        logger.debug("Image too small to refine the shift, using the coarse estimate")
+        return shift_row, shift_col
+
+    r0 = (rows - patch_rows) // 2
+    c0 = (cols - patch_cols) // 2
+    patch = _gray32(im1[r0:r0 + patch_rows, c0:c0 + patch_cols])
+    search = _gray32(im2[r0 + shift_row - radius:r0 + shift_row + patch_rows + radius,
+                         c0 + shift_col - radius:c0 + shift_col + patch_cols + radius])
+
+    match = cv2.matchTemplate(search, patch, cv2.TM_CCOEFF_NORMED)
+    if not np.all(np.isfinite(match)):
+        # flat patch - nothing to match against
+        return shift_row, shift_col
+
+    _, _, _, max_loc = cv2.minMaxLoc(match)
+    return shift_row - radius + max_loc[1], shift_col - radius + max_loc[0]
+
+
+def detect_shift(image, black=(20,20,20), depth=300):
     """
     When an image is shifted vertically/horizontally a "black" col/row is inserted into the image.
     given an image with the below known characteristics. This algorithm will detect the shift
     the image must guarantee that in any given row or col there is at least one pixel that is not BLACK.
     :param image: 
+    :param black: per channel (b, g, r) value at or below which a pixel is considered black
+    :param depth: how many rows/cols to scan from each edge - this is the largest shift that can be detected
     :return: a tuple: top row shift, bottom row shift, start col shift, end col shift
     """
     # when an image is shifted, one or more black row and or cols are inserted
     # assume that there are no "black" rows of pixels
 
-    def compare(srow,erow,scol,ecol, black):
-        b_slice = image[srow:erow, scol:ecol, 0]
-        if np.max(b_slice) > black[0]:
-            return True
-        g_slice = image[srow:erow, scol:ecol, 1]
-        if np.max(g_slice) > black[1]:
-            return True
-        r_slice = image[srow:erow, scol:ecol, 2]
-        if np.max(r_slice) > black[2]:
-            return True
-        return False
+    black = np.asarray(black[:3])
 
-    max_col = image.shape[1]
     max_row = image.shape[0]
+    max_col = image.shape[1]
+    depth_row = min(depth, max_row)
+    depth_col = min(depth, max_col)
+
+    def first_not_black(maxima):
+        # maxima: per row/col channel maxima ordered from the edge inwards
+        not_black = np.any(maxima[:, :3] > black, axis=1)
+        index = np.flatnonzero(not_black)
+        return int(index[0]) if index.size else len(not_black)
+
+    def scan(strip_maxima, depth):
+        # the outermost row/col settles the common "no black bar" case cheaply
+        if first_not_black(strip_maxima(1)) == 0:
+            return 0
+        return first_not_black(strip_maxima(depth))
+
+    def row_maxima(strip):
+        # reducing the middle axis of (rows, cols, channels) is slow in numpy - reduce each channel plane instead
+        return np.stack([strip[:, :, c].max(axis=1) for c in range(min(3, strip.shape[2]))], axis=1)
+
+    # one reduction per border strip: per col maxima for left/right, per row maxima for top/bottom
+    # (the last row/col is left out of the reductions like the original scan did)
+    top_row = scan(lambda d: row_maxima(image[:d, :-1]), depth_row)
+    bottom_row = scan(lambda d: row_maxima(image[max_row - d:, :-1])[::-1], depth_row)
+    left_col = scan(lambda d: image[:-1, :d].max(axis=0), depth_col)
+    right_col = scan(lambda d: image[:-1, max_col - d:].max(axis=0)[::-1], depth_col)
 
+    return top_row, bottom_row, left_col, right_col
 
-    # look for left and right shifts
-    srow =  0
-    erow =  -1
-
-    # left side
-    left_col = 0 # no shift
-    for scol in range (300):
-        ecol = scol + 1
-        if compare(srow,erow,scol,ecol,black):
-            break
-        left_col += 1
-
-    # right side
-    right_col = 0 # no shift
-    for ecol in range (max_col, max_col-300, -1):
-        scol = ecol - 1
-        if compare(srow,erow,scol,ecol, black):
-            break
-        right_col += 1
-
-    # top down shifts
-    scol = 0
-    ecol = -1
-
-    #top row
-    top_row = 0
-    for srow in range(300):
-        erow = srow+1
-        if compare(srow,erow,scol,ecol, black):
-            break
-        top_row += 1
-
-    # bottom row
-    bottom_row = 0  # no shift
-    for erow in range(max_row, max_row - 300, -1):
-        srow = erow - 1
-        if compare(srow, erow, scol, ecol, black):
-            break
-        bottom_row += 1
 
-    return top_row, bottom_row, left_col, right_col
+def has_black_bars(image, black=(20,20,20)):
+    """
+    Fast pre-check: True if any edge row/col of the image is black i.e. detect_shift would find a shift.
+    Only the outermost row/col on each side is looked at.
+    """
+    return any(detect_shift(image, black=black, depth=1))
+
 
-def align_images(golden_img, captured_img, black_threshold):
+def align_images(golden_img, captured_img, black_threshold, depth=300):
     """
     Utility function that given 2 images that are relatively shifted returns images that are now aligned. if the images
     do not require alignment the images are returned as is.
@@ -133,12 +250,13 @@ def align_images(golden_img, captured_img, black_threshold):
     Both images must have the same dimension as well
     :param golden_img: golden image
     :param captured_img: capture
+    :param depth: largest shift that can be detected
     :return: golden_image, capture_image that are aligned - this are "views" into the passed in images
     """
 
     # detect how much image2 the captured image is shifted
 
-    top_row, bottom_row, left_col, right_col = detect_shift(captured_img, black=black_threshold)
+    top_row, bottom_row, left_col, right_col = detect_shift(captured_img, black=black_threshold, depth=depth)
 
     if top_row == 0 and bottom_row == 0 and left_col == 0 and right_col == 0:
         logger.info("No shift detected")
@@ -161,7 +279,102 @@ def capture_remove_shift(captured, top_row, bottom_row, left_col, right_col):
 def golden_remove_shift(golden, top_row, bottom_row, left_col, right_col):
     return  golden[bottom_row:golden.shape[0]-top_row, right_col:golden.shape[1]-left_col]
 
-def compute_SSIM(image1, image2):
+def compute_SSIM(image1, image2, gray1=None, gray2=None, tile_size=None, rois=None):
+    """
+    :param gray1: grayscale of image1 if it is already known
+    :param gray2: grayscale of image2 if it is already known
+    :param tile_size: compute the SSIM in float32 tiles of this size (see compute_SSIM_tiled) - bounded memory for
+                      very large images
+    :param rois: only compare these regions, list of (x, y, w, h) - implies the tiled computation
+    :return: ssim score, ssim image
+    """
+    if gray1 is None:
+        gray1 = cv2.cvtColor(image1, cv2.COLOR_BGR2GRAY)
+    if gray2 is None:
+        gray2 = cv2.cvtColor(image2, cv2.COLOR_BGR2GRAY)
+
+    if tile_size or rois:
+        return compute_SSIM_tiled(gray1, gray2, tile_size=tile_size or SSIM_TILE_SIZE, rois=rois)
+
+    score, diff = compare_ssim(gray1, gray2, full=True)
+    return score, diff
+
 
-    score, diff = compare_ssim(cv2.cvtColor(image1, cv2.COLOR_BGR2GRAY), cv2.cvtColor(image2, cv2.COLOR_BGR2GRAY), full=True)
+SSIM_WIN_SIZE = 7
+SSIM_TILE_SIZE = 1024
+
+
+def _ssim_map(x, y, data_range=255.0, win_size=SSIM_WIN_SIZE):
+    """
+    SSIM map of two float32 grayscale arrays - the formula, uniform window and reflected borders of compare_ssim with
+    its default parameters
+    """
+    def mean_filter(a):
+        return cv2.boxFilter(a, -1, (win_size, win_size), borderType=cv2.BORDER_REFLECT)
+
+    # sample covariance like compare_ssim
+    cov_norm = win_size ** 2 / (win_size ** 2 - 1.0)
+
+    ux = mean_filter(x)
+    uy = mean_filter(y)
+    vx = cov_norm * (mean_filter(x * x) - ux * ux)
+    vy = cov_norm * (mean_filter(y * y) - uy * uy)
+    vxy = cov_norm * (mean_filter(x * y) - ux * uy)
+
+    c1 = (0.01 * data_range) ** 2
+    c2 = (0.03 * data_range) ** 2
+
+    return ((2 * ux * uy + c1) * (2 * vxy + c2)) / ((ux * ux + uy * uy + c1) * (vx + vy + c2))
+
+
+def compute_SSIM_tiled(gray1, gray2, tile_size=SSIM_TILE_SIZE, rois=None):
+    """
+    SSIM of two uint8 grayscale images computed tile by tile in float32, so the temporaries are bounded by the tile
+    size instead of the image size.
+    Each tile is extended by half the window on every side so the SSIM of its pixels is exactly what a whole image
+    computation gives; like compare_ssim the score is the mean over the image minus a half window border.
+    :param rois: only compare these regions, list of (x, y, w, h). The score is the mean over all their pixels and
+                 the ssim image is 1 (identical) outside of them
+    :return: ssim score, float32 ssim image
+    """
+    rows, cols = gray1.shape[:2]
+    pad = (SSIM_WIN_SIZE - 1) // 2
+
+    if rois:
+        diff = np.ones((rows, cols), dtype=np.float32)
+        regions = []
+        for x, y, w, h in rois:
+            x0, y0 = max(0, int(x)), max(0, int(y))
+            x1, y1 = min(cols, int(x + w)), min(rows, int(y + h))
+            if x1 > x0 and y1 > y0:
+                regions.append((x0, y0, x1, y1))
+        if not regions:
+            raise ValueError("None of the regions of interest are inside the image")
+    else:
+        diff = np.empty((rows, cols), dtype=np.float32)
+        regions = [(0, 0, cols, rows)]
+
+    total = 0.0
+    count = 0
+    for x0, y0, x1, y1 in regions:
+        for ty in range(y0, y1, tile_size):
+            for tx in range(x0, x1, tile_size):
+                cy0, cy1 = ty, min(ty + tile_size, y1)
+                cx0, cx1 = tx, min(tx + tile_size, x1)
+
+                # tile plus a half window halo (clipped at the image border where reflection takes over)
+                hy0, hy1 = max(0, cy0 - pad), min(rows, cy1 + pad)
+                hx0, hx1 = max(0, cx0 - pad), min(cols, cx1 + pad)
+
+                s = _ssim_map(gray1[hy0:hy1, hx0:hx1].astype(np.float32), gray2[hy0:hy1, hx0:hx1].astype(np.float32))
+                diff[cy0:cy1, cx0:cx1] = s[cy0 - hy0:cy1 - hy0, cx0 - hx0:cx1 - hx0]
+
+                # the score leaves out the half window border of the image
+                sy0, sy1 = max(cy0, pad), min(cy1, rows - pad)
+                sx0, sx1 = max(cx0, pad), min(cx1, cols - pad)
+                if sy1 > sy0 and sx1 > sx0:
+                    total += s[sy0 - hy0:sy1 - hy0, sx0 - hx0:sx1 - hx0].sum(dtype=np.float64)
+                    count += (sy1 - sy0) * (sx1 - sx0)
+
+    score = total / count if count else 1.0
     return score, diff
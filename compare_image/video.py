@@ -0,0 +1,296 @@
+"""
+Compare a captured video with a golden video, or with a golden image, frame by frame.
+
+The videos are decoded as a stream (cv2.VideoCapture, one frame at a time) in the calling process and the frame
+comparisons are handed to worker processes with a bounded number in flight, so only a few frames are ever held in
+memory however long the clip is. A golden image is prepared once (image_ops.prepare_golden) and memory mapped by
+the workers; golden video frames go to the workers with their capture frame.
+
+A frame that is identical to the last compared frame - the capture frame and the golden frame - is not compared
+again, it gets that frame's result. Checking it is one cv2.norm pass, much cheaper than a comparison, and a KVM
+capture of a still screen is mostly repeated frames.
+
+The result is a timeline, the SSIM of every frame, and the frame ranges where the capture differs from the golden
+(SSIM below a threshold):
+    {"frames", "compared", "skipped", "fps",
+     "timeline": [{"frame", "time", "ssim_score", "regions", "shift", "same_as" (skipped frames) or "error"}, ...],
+     "ranges": [{"start", "end", "start_time", "end_time", "min_ssim", "worst_frame"}, ...],
+     "golden_frames", "capture_frames", "length_mismatch"}
+The timeline ends with the shorter video; the frames of the longer one are counted (not decoded) and a capture that
+is shorter or longer than its golden video is a length_mismatch.
+"""
+import asyncio
+import concurrent.futures
+import itertools
+import logging
+import os
+import threading
+
+import cv2
+
+import image_ops
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+
+# frames whose SSIM is below this are differences
+DEFAULT_SSIM_THRESHOLD = 0.99
+
+
+def is_image(path):
+    return os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS
+
+
+def open_video(path):
+    """
+    :return: the opened cv2.VideoCapture, frames per second (None when the container does not say)
+    :raise ValueError: when opencv can not open the video
+    """
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        capture.release()
+        raise ValueError("Video {} could not be opened by opencv".format(os.path.basename(path)))
+    return capture, capture.get(cv2.CAP_PROP_FPS) or None
+
+
+def same_frame(a, b, tolerance=0):
+    """
+    True if no pixel of a and b differs by more than tolerance - one vectorized pass, no temporaries
+    """
+    return a is b or (a.shape == b.shape and cv2.norm(a, b, cv2.NORM_INF) <= tolerance)
+
+
+def compare_frame(prepared_dir, golden_frame, capture_frame, params):
+    """
+    Runs in a worker: compare a capture frame with the prepared golden image or with a golden frame
+    :param params: compare_to_golden / compare_frames keyword arguments
+    """
+    if prepared_dir is not None:
+        return image_ops.compare_to_golden(prepared_dir, capture_frame, **params)
+    return image_ops.compare_frames(golden_frame, capture_frame, **params)
+
+
+class VideoComparison:
+    """
+    The state of one comparison: the frame streams, which frames repeat a compared one and the results. The drivers
+    (run and run_async) take the jobs from jobs() to their workers and hand the results to add().
+    """
+
+    def __init__(self, golden, capture, prepared_dir=None, params=None, skip_tolerance=0,
+                 ssim_threshold=DEFAULT_SSIM_THRESHOLD):
+        """
+        :param golden: path of the golden video or image
+        :param capture: path of the captured video
+        :param prepared_dir: where a golden image is prepared for the workers (image_ops.prepare_golden)
+        :param params: compare_to_golden keyword arguments (shift_method, ssim_tile_size, regions parameters)
+        :param skip_tolerance: a frame none of whose pixels differs from the last compared frame by more than this
+                               is not compared again
+        :param ssim_threshold: frames with a lower SSIM are differences
+        :raise ValueError: when a video can not be opened or the golden image can not be prepared
+        """
+        self.params = params or {}
+        self.skip_tolerance = skip_tolerance
+        self.ssim_threshold = ssim_threshold
+
+        # jobs() may read in a thread of its own, close waits for the read
+        self._lock = threading.Lock()
+
+        self.prepared_dir = None
+        # the cv2.VideoCapture's, released by close
+        self._golden = None
+        self._capture = None
+        if is_image(golden):
+            code, result = image_ops.prepare_golden(golden, prepared_dir)
+            if code != 0:
+                raise ValueError(result)
+            self.prepared_dir = prepared_dir
+        else:
+            self._golden, _ = open_video(golden)
+
+        try:
+            self._capture, self.fps = open_video(capture)
+        except ValueError:
+            self.close()
+            raise
+
+        self.frames = 0
+        # frames of each video, known once jobs() is done - golden_frames is None for a golden image
+        self.golden_frames = None
+        self.capture_frames = None
+        self.results = {}
+        self.same_as = {}
+
+    def _read(self, capture):
+        # the next frame, None at the end (or once closed)
+        with self._lock:
+            ok, frame = capture.read()
+        return frame if ok else None
+
+    def _count_rest(self, capture):
+        # the frames left, without decoding them
+        count = 0
+        with self._lock:
+            while capture.grab():
+                count += 1
+        return count
+
+    def close(self):
+        """
+        Release the videos. A job iterator still running stops at its next frame.
+        """
+        with self._lock:
+            for capture in (self._golden, self._capture):
+                if capture is not None:
+                    capture.release()
+
+    def jobs(self):
+        """
+        The frames to compare, decoded one at a time until a video ends
+        :return: iterator of (frame index, compare_frame arguments)
+        """
+        last = None
+        for index in itertools.count():
+            golden_frame = None
+            if self._golden is not None:
+                golden_frame = self._read(self._golden)
+                if golden_frame is None:
+                    self.golden_frames = index
+                    self.capture_frames = index + self._count_rest(self._capture)
+                    return
+
+            capture_frame = self._read(self._capture)
+            if capture_frame is None:
+                self.capture_frames = index
+                if self._golden is not None:
+                    # the golden frame just read is past the end of the capture
+                    self.golden_frames = index + 1 + self._count_rest(self._golden)
+                return
+
+            self.frames = index + 1
+            if last is not None and same_frame(capture_frame, last[2], self.skip_tolerance) \
+                    and (golden_frame is None or same_frame(golden_frame, last[1], self.skip_tolerance)):
+                self.same_as[index] = last[0]
+                continue
+
+            last = (index, golden_frame, capture_frame)
+            yield index, (self.prepared_dir, golden_frame, capture_frame, self.params)
+
+    def add(self, index, result):
+        self.results[index] = result
+
+    def summary(self):
+        timeline = []
+        for index in range(self.frames):
+            source = self.same_as.get(index, index)
+            code, result = self.results[source]
+            frame = {"frame": index, "time": index / self.fps if self.fps else None}
+            if source != index:
+                frame["same_as"] = source
+            if code == 0:
+                frame["ssim_score"] = result["ssim_score"]
+                frame["regions"] = len(result["regions"])
+                frame["shift"] = result["shift"]
+            else:
+                frame["error"] = result
+            timeline.append(frame)
+
+        return {
+            "frames": self.frames,
+            "compared": len(self.results),
+            "skipped": len(self.same_as),
+            "fps": self.fps,
+            "timeline": timeline,
+            "ranges": difference_ranges(timeline, self.ssim_threshold),
+            "golden_frames": self.golden_frames,
+            "capture_frames": self.capture_frames,
+            "length_mismatch": self.golden_frames is not None and self.golden_frames != self.capture_frames,
+        }
+
+
+def difference_ranges(timeline, ssim_threshold):
+    """
+    Runs of consecutive frames that differ from the golden: SSIM below ssim_threshold or not comparable (error)
+    :return: [{"start", "end" (inclusive), "start_time", "end_time", "min_ssim", "worst_frame"}]
+    """
+    ranges = []
+    current = None
+    for frame in timeline:
+        score = frame.get("ssim_score")
+        if score is not None and score >= ssim_threshold:
+            current = None
+            continue
+
+        score = score if score is not None else 0.0
+        if current is None:
+            current = {"start": frame["frame"], "start_time": frame["time"], "min_ssim": score,
+                       "worst_frame": frame["frame"]}
+            ranges.append(current)
+        current["end"] = frame["frame"]
+        current["end_time"] = frame["time"]
+        if score < current["min_ssim"]:
+            current["min_ssim"] = score
+            current["worst_frame"] = frame["frame"]
+    return ranges
+
+
+def run(comparison, executor, in_flight):
+    """
+    Compare all frames with a concurrent.futures executor, at most in_flight frames at a time
+    :return: VideoComparison.summary()
+    """
+    pending = {}
+    jobs = comparison.jobs()
+    try:
+        while True:
+            for index, args in jobs:
+                pending[executor.submit(compare_frame, *args)] = index
+                if len(pending) >= in_flight:
+                    break
+
+            if not pending:
+                break
+
+            finished, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                comparison.add(pending.pop(future), future.result())
+    finally:
+        comparison.close()
+
+    return comparison.summary()
+
+
+async def run_async(comparison, pool, loop, in_flight):
+    """
+    Compare all frames in a worker_pool.AffinityPool, at most in_flight frames at a time. The frames are decoded in
+    the default thread executor so the event loop never waits for the decoder.
+    :return: VideoComparison.summary()
+    """
+    jobs = comparison.jobs()
+    pending = set()
+    done = False
+    try:
+        while not done or pending:
+            while not done and len(pending) < in_flight:
+                job = await loop.run_in_executor(None, next, jobs, None)
+                if job is None:
+                    done = True
+                    break
+                index, args = job
+                pending.add(asyncio.ensure_future(_indexed(index, pool.run(None, compare_frame, *args))))
+
+            if pending:
+                finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in finished:
+                    comparison.add(*future.result())
+    finally:
+        for future in pending:
+            future.cancel()
+        # in a thread: it waits for a frame still being read when the comparison was cancelled
+        await loop.run_in_executor(None, comparison.close)
+
+    return comparison.summary()
+
+
+async def _indexed(index, coroutine):
+    return index, await coroutine
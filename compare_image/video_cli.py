@@ -0,0 +1,76 @@
+"""
+Headless comparison of a captured video with a golden video or a golden image - no web server, no bokeh.
+
+    python video_cli.py --golden golden.mp4 --capture capture.mp4 --out timeline.json
+    python video_cli.py --golden golden.png --capture capture.mp4 --out timeline.json --skip-tolerance 2
+
+The output is the video.VideoComparison summary as JSON: the SSIM timeline of every frame and the frame ranges where
+the capture differs. Exits 1 when there are differences or the capture and the golden video differ in length.
+"""
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import video
+
+logger = logging.getLogger(__name__)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="KVM Test Station - video compare")
+
+    parser.add_argument('--golden',       action='store', dest="golden", required=True, help="golden video or image", type=str)
+    parser.add_argument('--capture',      action='store', dest="capture", required=True, help="captured video", type=str)
+    parser.add_argument('--out', '-o',    action='store', dest="out", required=True, help="timeline and difference ranges, JSON", type=str)
+    parser.add_argument('--workers',      action='store', dest="workers", default=os.cpu_count(), help="Number of worker processes", type=int)
+    parser.add_argument('--ssim-threshold', action='store', dest="ssim_threshold", default=video.DEFAULT_SSIM_THRESHOLD, help="Frames with a lower SSIM are differences", type=float)
+    parser.add_argument('--skip-tolerance', action='store', dest="skip_tolerance", default=0, help="Frames no pixel of which differs from the last compared frame by more than this are not compared again", type=int)
+    parser.add_argument('--shift-method', action='store', dest="shift_method", default="full", choices=["full", "pyramid"], help="Shift detection method", type=str)
+    parser.add_argument('--ssim-tile',    action='store', dest="ssim_tile_size", default=0, help="Compute the SSIM in tiles of this size to bound memory, 0 for one pass", type=int)
+    parser.add_argument('--region-min-area', action='store', dest="region_min_area", default=0, help="Ignore changed regions whose box is smaller than this many pixels", type=int)
+    parser.add_argument('--region-merge', action='store', dest="region_merge_distance", default=0, help="Merge changed regions at most this many pixels apart into one box", type=int)
+    parser.add_argument('--no-shift-precheck', action='store_false', dest="shift_precheck", help="Always run shift detection even if the frames have no black bars")
+
+    pargs = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    params = {"shift_method": pargs.shift_method, "shift_precheck": pargs.shift_precheck,
+              "ssim_tile_size": pargs.ssim_tile_size or None, "region_min_area": pargs.region_min_area,
+              "region_merge_distance": pargs.region_merge_distance}
+
+    prepared_dir = tempfile.mkdtemp(prefix="video-golden-")
+    try:
+        try:
+            comparison = video.VideoComparison(pargs.golden, pargs.capture, prepared_dir, params,
+                                               skip_tolerance=pargs.skip_tolerance, ssim_threshold=pargs.ssim_threshold)
+        except ValueError as x:
+            parser.error(str(x))
+
+        t0 = time.time()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=pargs.workers) as executor:
+            # a couple of frames per worker keeps the workers busy while the next frames are decoded
+            summary = video.run(comparison, executor, pargs.workers * 2)
+        elapsed = time.time() - t0
+    finally:
+        shutil.rmtree(prepared_dir, ignore_errors=True)
+
+    with open(pargs.out, 'w') as f:
+        json.dump(summary, f)
+
+    logger.info("{} frames ({} compared, {} skipped) in {:.1f}s: {:.2f} frames/s".format(
+        summary["frames"], summary["compared"], summary["skipped"], elapsed,
+        summary["frames"] / elapsed if elapsed > 0 else 0.0))
+    for r in summary["ranges"]:
+        logger.info("Frames {start}-{end} differ, worst SSIM {min_ssim:.4f} at frame {worst_frame}".format(**r))
+    if summary["length_mismatch"]:
+        logger.info("The capture has {capture_frames} frames, the golden video {golden_frames}".format(**summary))
+
+    sys.exit(1 if summary["ranges"] or summary["length_mismatch"] else 0)
@@ -1,19 +1,35 @@
+import functools
+import json
 import logging
 import os
+import shutil
 import sys
 import time
+import urllib.parse
 import uuid
 
 import asyncio
 
+import numpy as np
 from aiohttp import web
 from aiohttp_session import get_session
 
 from bokeh.layouts import gridplot
 from bokeh.plotting import figure
 from bokeh.embed import components
+from bokeh.models.tiles import TMSTileSource
 
+import artifacts
+import golden_library
 import image_ops
+import jobs
+import metrics
+import prechecks
+import result_cache
+import telemetry
+import tiles
+import uploads
+import video
 
 logger = logging.getLogger(__name__)
 
@@ -32,7 +48,79 @@ async def index(request):
     return web.Response(text="This is AIO-HTTP\n")
 
 
+def _route(request):
+    # the route template, not the path - one series per route whatever the uid or the file name
+    resource = getattr(request.match_info.route, "resource", None)
+    if resource is None:
+        return "unmatched"
+    info = resource.get_info()
+    return info.get("path") or info.get("formatter") or info.get("prefix") or "unmatched"
+
+
+async def telemetry_middleware(app, handler):
+    """
+    Counts every request by method, route and status and records its latency (see telemetry)
+    """
+    async def middleware(request):
+        t0 = time.perf_counter()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as x:
+            status = x.status
+            raise
+        finally:
+            route = _route(request)
+            registry = app["telemetry"]
+            registry.counter("image_diff_requests_total", "HTTP requests",
+                             ("method", "route", "status")).inc(request.method, route, status)
+            registry.summary("image_diff_request_seconds", "HTTP request latency in seconds",
+                             ("route",)).observe(time.perf_counter() - t0, route)
+
+    return middleware
+
+
+def _stage_seconds(app):
+    return app["telemetry"].histogram("image_diff_stage_seconds", "Seconds spent in each stage of a diff", ("stage",))
+
+
+def _observe_timings(app, result):
+    # the stage timings a worker measured, see image_ops.workon_images
+    stage_seconds = _stage_seconds(app)
+    for stage, seconds in result.get("timings", {}).items():
+        stage_seconds.observe(seconds, stage)
+
+
+async def _prerender(app, upload_dir_path, path, info):
+    """
+    Render the preview tiles of an uploaded image in the session's worker (see tiles.prerender) and take its decoded
+    size into info. The previews only speed up the first paint: when they fail the viewers render every tile on
+    request, the upload stands.
+    """
+    filename = os.path.basename(path)
+    t0 = time.time()
+    try:
+        preview = await app["worker_pool"].run(upload_dir_path, tiles.prerender, path)
+    except asyncio.CancelledError:
+        raise
+    except ValueError as x:
+        logger.warning(F"{filename}: no preview - {x}")
+        return
+    except Exception:
+        logger.exception(F"{filename}: no preview")
+        return
+    info["width"], info["height"] = preview["width"], preview["height"]
+    logger.debug(F"{filename}: {preview['tiles']} preview tiles in {time.time() - t0:.3f}s")
+
+
 async def upload_image_handler(request):
+    """
+    Accepts a left_image and/or a right_image part in one multipart request.
+    Each part is streamed to the session upload directory off the event loop while its content hash and image
+    header (dimensions, channels) are computed.
+    """
 
     session = await get_session(request)
     session['last_access'] = time.time()
@@ -43,24 +131,6 @@ async def upload_image_handler(request):
 
     reader = await request.multipart()
 
-    # /!\ Don't forget to validate your inputs /!\
-
-    part = await reader.next()
-
-    if part.name == "left_image":
-        session['session_data']["left_image"] = None
-    elif part.name =="right_image":
-        session['session_data']["right_image"] = None
-    else:
-        return web.Response(status=500, text=F"Internal error. part.name {part.name} expect right_image or left_image")
-
-
-    filename = part.filename
-
-    # check that filename is not empty
-    if filename is None or len(filename) == 0:
-        return web.Response(status=400, text="Missing Filename.")
-
     # users upload directory
     upload_dir_path = os.path.join(request.app["upload_dir"],session['uid'])
 
@@ -68,91 +138,224 @@ async def upload_image_handler(request):
     if not os.path.exists(upload_dir_path):
         os.makedirs(upload_dir_path)
 
-    # You cannot rely on Content-Length if transfer is chunked.
-    size = 0
-
-    with open(os.path.join(upload_dir_path, filename), 'wb') as f:
-        while True:
-            chunk = await part.read_chunk()  # 8192 bytes by default.
-            if not chunk:
-                break
-            size += len(chunk)
-            f.write(chunk)
+    loop = request.app.loop
+    uploaded = 0
+
+    while True:
+        part = await reader.next()
+        if part is None:
+            break
+
+        if part.name not in ("left_image", "right_image"):
+            return web.Response(status=500, text=F"Internal error. part.name {part.name} expect right_image or left_image")
+
+        # a form with both inputs sends an empty part for a file that was not picked
+        filename = os.path.basename(part.filename or "")
+        if len(filename) == 0:
+            await part.release()
+            continue
+
+        session['session_data'][part.name] = None
+
+        # You cannot rely on Content-Length if transfer is chunked.
+        try:
+            info = await uploads.save_part(part, os.path.join(upload_dir_path, filename), loop,
+                                           request.app["upload_executor"], request.app["max_upload_size"])
+        except uploads.UploadTooLarge as x:
+            return web.Response(status=413, text=F"{filename}: {x}")
+
+        # the worker of the session decodes the image (the diff will find it in its decoded image cache) and renders
+        # the preview tiles the viewers start with - the decoded size is authoritative
+        await _prerender(request.app, upload_dir_path, os.path.join(upload_dir_path, filename), info)
+
+        # a capture: the golden images of the library it most likely shows
+        library = request.app["golden_library"]
+        if part.name == "right_image" and library is not None and len(library) > 0:
+            try:
+                hashes = await request.app["worker_pool"].run(upload_dir_path, golden_library.file_hashes,
+                                                              os.path.join(upload_dir_path, filename), True)
+                info["candidates"] = [{"id": c["id"], "name": c["name"], "distance": c["distance"]}
+                                      for c in library.match(hashes, request.app["golden_candidates"])]
+            except asyncio.CancelledError:
+                raise
+            except ValueError as x:
+                logger.warning(F"{filename}: no golden candidates - {x}")
+            except Exception:
+                # the candidates are a hint, the upload stands without them
+                logger.exception(F"{filename}: no golden candidates")
+
+        logger.debug(F"{part.name} {filename} {info}")
+
+        info["filename"] = filename
+        session['session_data'][part.name] = info
+        uploaded += 1
+
+        request.app["janitor"].record_upload(session['uid'], info["size"])
 
-    if part.name == "left_image":
-        session['session_data']["left_image"] = {"filename":filename}
-    elif part.name =="right_image":
-        session['session_data']["right_image"] = {"filename": filename}
+    # check that filename is not empty
+    if uploaded == 0:
+        return web.Response(status=400, text="Missing Filename.")
 
     session.changed()
 
     return web.HTTPFound('/diff')
 
 
-def render_sideby_side2(left_image_name,right_image_name, upload_resource, uid):
-    left_url = None
-    right_url = None
-    if left_image_name:
-        left_url = str(upload_resource.url_for(filename=uid + "/" + left_image_name))
-    if right_image_name:
-        right_url = str(upload_resource.url_for(filename=uid+"/"+right_image_name))
+async def render_artifact(app, upload_dir_path, path):
+    """
+    Render the pending artifact at path in the session's worker (see artifacts.render_pending). Concurrent requests
+    for the same artifact wait for one rendering.
+    :raise OSError, ValueError: when it can not be rendered
+    """
+    renders = app["artifact_renders"]
+    if path not in renders:
+        renders[path] = asyncio.ensure_future(app["worker_pool"].run(upload_dir_path, artifacts.render_pending, path))
+        renders[path].add_done_callback(lambda _: renders.pop(path, None))
+    await asyncio.shield(renders[path])
 
 
-    # compute the max width and height
+async def upload_file(request):
+    """
+    A file of a session's upload directory. Diff artifacts that are still pending (lazy artifacts) are rendered in
+    the session's worker on their first request; every later request gets the file from disk.
+    """
+    uid = request.match_info["uid"]
+    filename = request.match_info["filename"]
+    if uid.startswith(".") or filename.startswith("."):
+        raise web.HTTPNotFound()
 
-    # crete two plots linked to each other
-    p1 = figure(x_range=(0, 4727), y_range=(0, 2950), title=left_image_name,responsive=True)
-    p2 = figure(plot_width=p1.plot_width, plot_height=p1.plot_height, x_range=p1.x_range, y_range=p1.y_range, title=right_image_name, responsive=True)
+    upload_dir_path = os.path.join(request.app["upload_dir"], uid)
+    path = os.path.join(upload_dir_path, filename)
 
-    p1.image_url([left_url],
-                 x=[0], y=[2950], w=[4727], h=[2950])
-    p2.image_url([right_url],
-                 x=[0], y=[2950], w=[4727], h=[2950])
+    if not os.path.isfile(path):
+        if not artifacts.is_pending(path):
+            raise web.HTTPNotFound()
 
+        try:
+            await render_artifact(request.app, upload_dir_path, path)
+        except (OSError, ValueError) as x:
+            logger.warning(F"Could not render {path}: {x}")
+            raise web.HTTPGone(text=str(x))
 
-    p = gridplot([[p1, p2]])
+    return web.FileResponse(path)
 
-    scripts, div = components(p)
-    return 0, {"script":scripts, "div":div}  # return script, div
 
+async def image_tile(request):
+    """
+    Tile z/x/y of a file of a session's upload directory, see tiles. Rendered in the session's worker on the first
+    request, from disk after that.
+    """
+    uid = request.match_info["uid"]
+    filename = request.match_info["filename"]
+    if uid.startswith(".") or filename.startswith("."):
+        raise web.HTTPNotFound()
+    z, x, y = int(request.match_info["z"]), int(request.match_info["x"]), int(request.match_info["y"])
 
+    upload_dir_path = os.path.join(request.app["upload_dir"], uid)
+    path = os.path.join(upload_dir_path, filename)
 
-def render_sideby_side(uid, upload_resource, session_data):
+    try:
+        if not os.path.isfile(path):
+            if not artifacts.is_pending(path):
+                raise web.HTTPNotFound()
+            await render_artifact(request.app, upload_dir_path, path)
 
-    left_image_name = None
-    if "left_image" in session_data and "filename" in session_data["left_image"]:
-        left_image_name = session_data["left_image"]["filename"]
-    right_image_name = None
-    if "right_image" in session_data and "filename" in session_data["right_image"]:
-        right_image_name = session_data["right_image"]["filename"]
+        tile = tiles.tile_path(path, z, x, y)
+        if not os.path.isfile(tile):
+            await request.app["worker_pool"].run(upload_dir_path, tiles.render_tile, path, z, x, y)
+    except (OSError, ValueError):
+        raise web.HTTPNotFound()
 
-    # todo need to get the dimensions of the image
-    left_url = None
-    right_url = None
-    if left_image_name:
-        left_url = str(upload_resource.url_for(filename=uid + "/" + left_image_name))
-    if right_image_name:
-        right_url = str(upload_resource.url_for(filename=uid+"/"+right_image_name))
+    return web.FileResponse(tile)
 
 
-    # compute the max width and height
+def tile_url(uid, filename):
+    # url template of the tiles of an upload dir file, bokeh fills in {Z}, {X} and {Y}
+    return "/tiles/{}/{}/{{Z}}/{{X}}/{{Y}}.png".format(uid, urllib.parse.quote(filename))
 
-    # crete two plots linked to each other
-    p1 = figure(x_range=(0, 4727), y_range=(0, 2950), title=left_image_name,responsive=True)
-    p2 = figure(plot_width=p1.plot_width, plot_height=p1.plot_height, x_range=p1.x_range, y_range=p1.y_range, title=right_image_name, responsive=True)
 
-    p1.image_url([left_url],
-                 x=[0], y=[2950], w=[4727], h=[2950])
-    p2.image_url([right_url],
-                 x=[0], y=[2950], w=[4727], h=[2950])
+def image_size(upload_dir_path, info):
+    """
+    (width, height) of an uploaded image from its session info, or from its file header if the upload did not know
+    :return: None if the size is not known
+    """
+    if info.get("width") and info.get("height"):
+        return info["width"], info["height"]
+    header = uploads.file_header(os.path.join(upload_dir_path, info["filename"]))
+    if header is None:
+        return None
+    return header["width"], header["height"]
+
 
+def make_tiled_plot(title, url, width, height, **kwargs):
+    """
+    A plot in image pixels (y up from the bottom row) showing the image through its tile pyramid - the browser only
+    fetches the tiles in view at the current zoom
+    """
+    zoom = tiles.max_zoom(width, height)
+    tile_source = TMSTileSource(url=url, tile_size=tiles.TILE_SIZE, min_zoom=0, max_zoom=zoom,
+                                initial_resolution=2 ** zoom, x_origin_offset=0, y_origin_offset=0, wrap_around=False)
 
-    p = gridplot([[p1, p2]])
+    plot = figure(title=title, responsive=True, **kwargs)
+    plot.add_tile(tile_source)
+    return plot
+
+
+def render_tiled_side_by_side(uid, left, right):
+    """
+    Two linked tiled viewers
+    :param left: (filename, (width, height)) or None, same for right
+    :return: code, {"script", "div"}
+    """
+    width = max(size[0] for _, size in filter(None, (left, right)))
+    height = max(size[1] for _, size in filter(None, (left, right)))
+
+    p1 = None
+    plots = []
+    for image in (left, right):
+        if image is None:
+            continue
+        filename, (w, h) = image
+        if p1 is None:
+            p1 = make_tiled_plot(filename, tile_url(uid, filename), w, h, x_range=(0, width), y_range=(0, height))
+            plots.append(p1)
+        else:
+            plots.append(make_tiled_plot(filename, tile_url(uid, filename), w, h, plot_width=p1.plot_width,
+                                         plot_height=p1.plot_height, x_range=p1.x_range, y_range=p1.y_range))
+
+    p = gridplot([plots])
 
     scripts, div = components(p)
     return 0, {"script":scripts, "div":div}  # return script, div
 
 
+def render_sideby_side2(left_image_name, right_image_name, size, uid):
+    """
+    The marked left and right images - both are size (width, height)
+    """
+    return render_tiled_side_by_side(uid, (left_image_name, size), (right_image_name, size))
+
+
+def render_sideby_side(uid, upload_dir_path, session_data):
+
+    images = []
+    for side in ("left_image", "right_image"):
+        info = session_data.get(side)
+        if not info or "filename" not in info:
+            images.append(None)
+            continue
+        size = image_size(upload_dir_path, info)
+        if size is None:
+            # not an image we can read the dimensions of
+            return 1, None
+        images.append((info["filename"], size))
+
+    if images == [None, None]:
+        return 1, None
+
+    return render_tiled_side_by_side(uid, images[0], images[1])
+
+
 async def image_diff(request):
 
     session = await get_session(request)
@@ -204,18 +407,135 @@ async def image_diff(request):
 
     template_context = {}
     uid = session['uid']
+    request.app["janitor"].touch(uid)
 
-    upload_resource = request.app.router['uploads']
-
-    code, script_and_div = render_sideby_side(uid, upload_resource, session["session_data"])
+    t0 = time.perf_counter()
+    code, script_and_div = render_sideby_side(uid, upload_dir_path, session["session_data"])
+    _stage_seconds(request.app).observe(time.perf_counter() - t0, "render")
     if code == 0:
         template_context["image_display"] = script_and_div
 
 
     template_context["data"] = session["session_data"]
+    template_context["uid"] = uid
     response = aiohttp_jinja2.render_template('base_html.jinja2',request,template_context)
     return response
 
+async def compute_diff(app, upload_dir_path, session_data, params=None):
+    """
+    Diff the left and right image of a session: served from the result cache when possible, otherwise computed by
+    image_ops.workon_images in the worker pool - on the worker of the session (upload_dir_path names it).
+    :param params: workon_images parameters of this request (e.g. rois), on top of the app wide diff_params
+    :return: code, result - see image_ops.workon_images
+    """
+    diff_params = dict(app["diff_params"])
+    diff_params.update(params or {})
+
+    left_image = os.path.join(upload_dir_path, session_data["left_image"]["filename"])
+    right_image = os.path.join(upload_dir_path, session_data["right_image"]["filename"])
+
+    # hashed while the files were uploaded
+    left_digest = session_data["left_image"].get("sha256")
+    right_digest = session_data["right_image"].get("sha256")
+
+    loop = app.loop
+    t0 = time.perf_counter()
+    diff_seconds = app["telemetry"].summary("image_diff_diff_seconds", "Seconds to diff a pair, from the result cache or computed",
+                                            ("source",))
+
+    # a pair we have seen before (same content, same parameters) is served from the result cache
+    cache = app["result_cache"]
+    cache_key = None
+    if cache is not None:
+        if left_digest and right_digest:
+            cache_key = result_cache.make_key(left_digest, right_digest, diff_params)
+        else:
+            cache_key = await loop.run_in_executor(None, result_cache.make_key_for_files, left_image, right_image, diff_params)
+        result = await loop.run_in_executor(None, cache.lookup, cache_key, left_image, right_image, upload_dir_path)
+        if result is not None:
+            app["settled_by"]["cache"] += 1
+            diff_seconds.observe(time.perf_counter() - t0, "cache")
+            return 0, result
+
+    code, result = await run_workon_images(app, left_image, right_image, upload_dir_path, diff_params,
+                                           digests=(left_digest, right_digest))
+    if code == 0 and "settled_by" in result:
+        app["settled_by"][result["settled_by"]] += 1
+    diff_seconds.observe(time.perf_counter() - t0, "computed")
+
+    if code == 0:
+        _observe_timings(app, result)
+        pixels = app["telemetry"].histogram("image_diff_image_pixels", "Pixels of the compared images",
+                                            buckets=telemetry.PIXEL_BUCKETS)
+        for side in ("left_image", "right_image"):
+            if session_data[side].get("width") and session_data[side].get("height"):
+                pixels.observe(session_data[side]["width"] * session_data[side]["height"])
+
+    if code == 0 and cache is not None:
+        await loop.run_in_executor(None, cache.store, cache_key, result, upload_dir_path)
+
+    return code, result
+
+
+def _release_decoded(segments, decoded):
+    if not decoded.cancelled() and decoded.exception() is None and decoded.result() is not None:
+        segments.release(decoded.result())
+
+
+async def run_workon_images(app, left_image, right_image, upload_dir_path, diff_params, digests=None):
+    """
+    Run image_ops.workon_images on the worker of the session (the upload directory is the affinity key) so its
+    decoded image cache is reused.
+    Without a decoded image cache in the workers but with a segment store the images are decoded here once and the
+    worker maps them (image_ops.workon_shared_images). The segments are released however the job ends - done,
+    failed, timed out or cancelled.
+    With a job queue (job_queue) the diff is computed by whichever queue_worker process of the box takes it.
+    No bokeh plots are built: the result has the histogram counts ("histograms") the page draws its charts from.
+    :param digests: (left sha256, right sha256) of the files if known - for the hash precheck
+    """
+    loop = app.loop
+    pool = app["worker_pool"]
+    queue = app["job_queue"]
+    # main only sets up a segment store for workers without a decoded image cache and without a job queue
+    segments = app["segments"]
+
+    handles = []
+    try:
+        if segments is not None:
+            try:
+                for image in (left_image, right_image):
+                    decoded = loop.run_in_executor(None, segments.decode, image)
+                    try:
+                        handles.append(await asyncio.shield(decoded))
+                    except asyncio.CancelledError:
+                        # the decode thread carries on - release its segment once it is written
+                        decoded.add_done_callback(functools.partial(_release_decoded, segments))
+                        raise
+            except OSError as x:
+                logger.warning(F"Could not share the decoded images, the worker decodes them: {x}")
+                segments = None
+
+        if queue is not None:
+            return await queue.run(loop, "workon_images", left_image, right_image, upload_dir_path, plots=False,
+                                   histograms=True, digests=digests, **diff_params)
+
+        if segments is None:
+            workon_images = functools.partial(image_ops.workon_images, plots=False, histograms=True, digests=digests,
+                                              **diff_params)
+            return await pool.run(upload_dir_path, workon_images, left_image, right_image, upload_dir_path)
+
+        if None in handles:
+            return 1, "Images could not be loaded into opencv"
+
+        workon_images = functools.partial(image_ops.workon_shared_images, digests=digests, **diff_params)
+        return await pool.run(upload_dir_path, workon_images, handles[0], handles[1], left_image, right_image,
+                              upload_dir_path)
+    finally:
+        for handle in handles:
+            if handle is not None:
+                app["segments"].release(handle)
+
+
 async def do_diff_computation(request):
     """
     Given a left and a right image
@@ -230,15 +550,18 @@ async def do_diff_computation(request):
 
     # users upload directory
     upload_dir_path = os.path.join(request.app["upload_dir"], session['uid'])
+    request.app["janitor"].touch(session['uid'])
 
     template_context = {}
     template_context["data"] = session["session_data"]
-    upload_resource = request.app.router['uploads']
+    template_context["uid"] = session['uid']
 
     # get both files - and if both dont exists then we are done
     try:
         # take care of the left and right images
-        code, script_and_div = render_sideby_side(session['uid'], upload_resource, session["session_data"])
+        t0 = time.perf_counter()
+        code, script_and_div = render_sideby_side(session['uid'], upload_dir_path, session["session_data"])
+        _stage_seconds(request.app).observe(time.perf_counter() - t0, "render")
         if code !=  0:
             # cant render plots for side by side image
             return web.HTTPFound('/diff') # go back to diff
@@ -249,21 +572,26 @@ async def do_diff_computation(request):
         # ####################################################
         # now let compute the differences between those images
 
-        left_image = os.path.join(upload_dir_path,session['session_data']["left_image"]["filename"] )
-        right_image = os.path.join(upload_dir_path, session['session_data']["right_image"]["filename"])
+        # both files must have been uploaded
+        if not session['session_data'].get("left_image") or not session['session_data'].get("right_image"):
+            return web.HTTPFound('/diff')
 
         # ########################################################################################################
-        # Computing the diff takes a long time - pass it to the a process pool executor
+        # Computing the diff takes a long time - it is queued as a job that runs in the process pool executor
         # ########################################################################################################
 
-        process_pool_executor = request.app["process_pool_executor"]
+        job_manager = request.app["job_manager"]
+        try:
+            job = job_manager.submit(functools.partial(compute_diff, request.app, upload_dir_path, dict(session['session_data'])))
+        except jobs.QueueFull:
+            return web.Response(status=503, text="Too many diff computations in progress, try again later", headers={"Retry-After": "5"})
 
-        # get the event loop -- get it from app or asyncio
-        loop = request.app.loop
-        # do i need a partial?
-        future1 = loop.run_in_executor(process_pool_executor, image_ops.workon_images, left_image, right_image, upload_dir_path)
+        await job_manager.wait(job)
 
-        code, result = await future1
+        if job.state == jobs.DONE:
+            code, result = job.result
+        else:
+            code, result = 1, job.error
 
         # code, result = image_ops.workon_images(left_image, right_image, upload_dir_path)
         if code == 0:
@@ -283,17 +611,24 @@ async def do_diff_computation(request):
             diff_result = {}
             template_context["diff_result"] = diff_result
 
-            # populate it
-            if "histogram" in result:
-                diff_result["histogram"] = result["histogram"]
-            if "diff_histogram" in result:
-                diff_result["diff_histogram"] = result["diff_histogram"]
+            # populate it - the page draws the histogram charts from the counts of the job
+            if "histograms" in result:
+                diff_result["histograms_url"] = "/jobs/{}/histograms".format(job.id)
+
+            # settled by a precheck - there are no diff images to show
+            if result.get("settled_by", prechecks.FULL) != prechecks.FULL:
+                diff_result["settled_by"] = result["settled_by"]
 
 
             if "marked_l" in result and "marked_r" in result:
-                code, script_and_div = render_sideby_side2(result["marked_l"],result["marked_r"], upload_resource, session['uid'])
-                if code == 0:
-                    diff_result["diff_image_display"] = script_and_div
+                # the marked images are the compared part of the images - the shift is cropped away
+                sr, er, sc, ec = result["shift"]
+                size = image_size(upload_dir_path, session['session_data']["left_image"])
+                if size is not None:
+                    code, script_and_div = render_sideby_side2(result["marked_l"],result["marked_r"],
+                                                               (size[0] - sc - ec, size[1] - sr - er), session['uid'])
+                    if code == 0:
+                        diff_result["diff_image_display"] = script_and_div
 
 
             response = aiohttp_jinja2.render_template('base_html.jinja2', request, template_context)
@@ -310,3 +645,547 @@ async def do_diff_computation(request):
     return web.HTTPFound('/diff')
 
 
+async def cache_stats(request):
+    cache = request.app["result_cache"]
+    if cache is None:
+        return web.json_response({"enabled": False})
+
+    stats = cache.stats()
+    stats["enabled"] = True
+    return web.json_response(stats)
+
+
+async def submit_job(request):
+    """
+    Queue a diff computation of the session's left and right images.
+    An optional JSON body {"rois": [[x, y, w, h], ...]} restricts the comparison to those regions and
+    {"metrics": ["mse", "psnr", ...]} adds those metrics (see metrics.REGISTRY) to the result.
+    Returns 202 with the job id right away, or 429 when the job queue is full.
+    """
+    params = {}
+    if request.has_body:
+        try:
+            body = await request.json()
+            if body.get("rois"):
+                params["rois"] = [[int(v) for v in roi] for roi in body["rois"]]
+                if any(len(roi) != 4 for roi in params["rois"]):
+                    raise ValueError("a roi is [x, y, w, h]")
+            if body.get("metrics"):
+                params["metrics"] = [str(name) for name in body["metrics"]]
+                metrics.check_metrics(params["metrics"])
+        except (ValueError, TypeError, AttributeError) as x:
+            return web.json_response({"error": "invalid body: {}".format(x)}, status=400)
+
+    session = await get_session(request)
+    session_data = session.get("session_data", {})
+
+    if "uid" not in session or not session_data.get("left_image") or not session_data.get("right_image"):
+        return web.json_response({"error": "a left_image and a right_image must be uploaded first"}, status=400)
+
+    upload_dir_path = os.path.join(request.app["upload_dir"], session['uid'])
+
+    job_manager = request.app["job_manager"]
+    try:
+        job = job_manager.submit(functools.partial(compute_diff, request.app, upload_dir_path, dict(session_data), params))
+    except jobs.QueueFull as x:
+        return web.json_response({"error": str(x)}, status=429, headers={"Retry-After": "5"})
+
+    return web.json_response({"job_id": job.id, "status_url": "/jobs/{}".format(job.id)}, status=202)
+
+
+async def job_status(request):
+    """
+    Status of a job. ?wait=<seconds> long-polls until the job finishes (at most 60 seconds).
+    The workon_images result is included once the job is done.
+    """
+    job_manager = request.app["job_manager"]
+    job = job_manager.get(request.match_info["job_id"])
+    if job is None:
+        return web.json_response({"error": "unknown job"}, status=404)
+
+    try:
+        wait = min(float(request.query.get("wait", 0)), 60.0)
+    except ValueError:
+        return web.json_response({"error": "wait must be a number of seconds"}, status=400)
+
+    if wait > 0:
+        await job_manager.wait(job, wait)
+
+    status = job.to_dict()
+    if job.state == jobs.DONE:
+        code, result = job.result
+        if code == 0:
+            # the histogram counts have their own url
+            status["result"] = {k: v for k, v in result.items() if k != "histograms"}
+            if "histograms" in result:
+                status["histograms_url"] = "/jobs/{}/histograms".format(job.id)
+        else:
+            status["state"] = jobs.FAILED
+            status["error"] = result
+
+    return web.json_response(status)
+
+
+async def job_histograms(request):
+    """
+    Histogram counts of a finished job (see image_ops.histogram_counts) as JSON.
+    ?format=binary returns them as little endian uint32 arrays of 256 counts, one after the other in the order of
+    the X-Histogram-Series header (e.g. "left.h,left.b,left.g,left.r,right.h,right.b,right.g,right.r").
+    """
+    job = request.app["job_manager"].get(request.match_info["job_id"])
+    if job is None:
+        return web.json_response({"error": "unknown job"}, status=404)
+    if job.state != jobs.DONE or job.result[0] != 0 or "histograms" not in job.result[1]:
+        return web.json_response({"error": "no histograms, the job is {}".format(job.state)}, status=409)
+
+    histograms = job.result[1]["histograms"]
+    if request.query.get("format") != "binary":
+        return web.json_response(histograms)
+
+    series = [(side, name) for side in ("left", "right") for name in ("h", "b", "g", "r") if name in histograms[side]]
+    body = np.array([histograms[side][name] for side, name in series], dtype='<u4').tobytes()
+    return web.Response(body=body, content_type="application/octet-stream",
+                        headers={"X-Histogram-Series": ",".join("{}.{}".format(side, name) for side, name in series)})
+
+
+async def cancel_job(request):
+    job_manager = request.app["job_manager"]
+    job_id = request.match_info["job_id"]
+    if job_manager.get(job_id) is None:
+        return web.json_response({"error": "unknown job"}, status=404)
+
+    if not job_manager.cancel(job_id):
+        return web.json_response({"error": "job already finished"}, status=409)
+
+    return web.json_response(job_manager.get(job_id).to_dict())
+
+
+async def job_stats(request):
+    stats = request.app["job_manager"].stats()
+    # how the diffs were settled: served from the result cache or by a prechecks tier
+    stats["settled_by"] = dict(request.app["settled_by"])
+    return web.json_response(stats)
+
+
+async def batch_diff(request):
+    """
+    Compare one golden image against many captures.
+    multipart/form-data: a "golden" part first, then any number of "capture" parts.
+    The golden image is decoded once; each capture is handed to the process pool as soon as it is uploaded and the
+    results are streamed back as NDJSON, one line per capture in completion order:
+        {"capture": <filename>, "code": 0, "ssim_score", "shift", "regions", "histogram_distance"}
+        {"capture": <filename>, "code": 1, "error"}
+    The uploads go to a directory of their own, not to a session: aiohttp_session can not set its cookie on a streamed
+    response. The directory is removed once the response is done, or evicted by the janitor like an idle session
+    directory if the server stops first.
+    """
+    batch_id = "batch-{}".format(uuid.uuid4().hex)
+    batch_dir = os.path.join(request.app["upload_dir"], batch_id)
+    os.makedirs(batch_dir)
+    request.app["janitor"].touch(batch_id)
+    try:
+        return await _stream_batch(request, batch_dir)
+    finally:
+        await request.app.loop.run_in_executor(None, shutil.rmtree, batch_dir, True)
+
+
+async def _stream_batch(request, batch_dir):
+    # the captures handed to the worker pool: filename, concurrent future
+    futures = []
+    try:
+        return await _stream_batch_results(request, batch_dir, futures)
+    finally:
+        # an error response or a client that went away: the captures no worker has started are dropped, the ones in
+        # progress are waited for - batch_dir is removed once this returns
+        for _, future in futures:
+            future.cancel()
+        running = [asyncio.wrap_future(future) for _, future in futures if not future.done()]
+        if running:
+            await asyncio.wait(running)
+
+
+async def _stream_batch_results(request, batch_dir, futures):
+    loop = request.app.loop
+    pool = request.app["worker_pool"]
+    diff_params = request.app["diff_params"]
+    compare_to_golden = functools.partial(image_ops.compare_to_golden,
+                                          shift_method=diff_params.get("shift_method", "full"),
+                                          shift_precheck=diff_params.get("shift_precheck", True),
+                                          ssim_tile_size=diff_params.get("ssim_tile_size"),
+                                          region_min_area=diff_params.get("region_min_area", 0),
+                                          region_merge_distance=diff_params.get("region_merge_distance", 0))
+
+    reader = await request.multipart()
+
+    prepared_dir = None
+    while True:
+        part = await reader.next()
+        if part is None:
+            break
+
+        filename = os.path.basename(part.filename or "")
+        if part.name not in ("golden", "capture") or len(filename) == 0:
+            return web.json_response({"error": "expected a golden part followed by capture parts"}, status=400)
+
+        try:
+            await uploads.save_part(part, os.path.join(batch_dir, filename), loop,
+                                    request.app["upload_executor"], request.app["max_upload_size"])
+        except uploads.UploadTooLarge as x:
+            return web.json_response({"error": F"{filename}: {x}"}, status=413)
+
+        if part.name == "golden":
+            if prepared_dir is not None:
+                return web.json_response({"error": "only one golden image per batch"}, status=400)
+            prepared_dir = os.path.join(batch_dir, "golden")
+            code, result = await loop.run_in_executor(None, image_ops.prepare_golden, os.path.join(batch_dir, filename), prepared_dir)
+            if code != 0:
+                return web.json_response({"error": result}, status=400)
+        else:
+            if prepared_dir is None:
+                return web.json_response({"error": "the golden part must come before the captures"}, status=400)
+
+            futures.append((filename, pool.submit(None, compare_to_golden, prepared_dir, os.path.join(batch_dir, filename))))
+
+    if prepared_dir is None:
+        return web.json_response({"error": "missing golden image"}, status=400)
+
+    async def named(filename, future):
+        try:
+            return filename, await pool.result(future)
+        except asyncio.CancelledError:
+            raise
+        except Exception as x:
+            logger.exception(F"batch capture {filename} failed")
+            return filename, (1, str(x))
+
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+
+    tasks = [asyncio.ensure_future(named(filename, future)) for filename, future in futures]
+    try:
+        for completed in asyncio.as_completed(tasks):
+            filename, (code, result) = await completed
+            line = {"capture": filename, "code": code}
+            if code == 0:
+                _observe_timings(request.app, result)
+                line.update(result)
+            else:
+                line["error"] = result
+            # waits while the client is slower than the captures come in
+            await response.write((json.dumps(line) + "\n").encode('utf-8'))
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    await response.write_eof()
+    return response
+
+
+async def compute_video_diff(app, golden, capture, video_dir, params, skip_tolerance, ssim_threshold):
+    """
+    Compare a captured video with a golden video or image, the frames in the worker pool (see video)
+    :return: code, result - the video.VideoComparison summary
+    """
+    loop = app.loop
+    try:
+        # opens the videos, or prepares the golden image for the workers
+        comparison = await loop.run_in_executor(None, functools.partial(
+            video.VideoComparison, golden, capture, os.path.join(video_dir, "golden"), params,
+            skip_tolerance=skip_tolerance, ssim_threshold=ssim_threshold))
+    except ValueError as x:
+        return 1, str(x)
+
+    # a couple of frames per worker keeps the workers busy while the next frames are decoded
+    summary = await video.run_async(comparison, app["worker_pool"], loop, app["job_manager"].workers * 2)
+    logger.info("Video {}: {} frames, {} compared, {} differences{}".format(
+        os.path.basename(capture), summary["frames"], summary["compared"], len(summary["ranges"]),
+        ", length mismatch" if summary["length_mismatch"] else ""))
+    return 0, summary
+
+
+async def video_diff(request):
+    """
+    Compare a captured video with a golden video or a golden image, frame by frame.
+    multipart/form-data: a "golden" part (video or image) and a "capture" part (video).
+    Query: ?ssim_threshold=<frames with a lower SSIM are differences>&skip_tolerance=<max pixel difference of a
+    frame that is not compared again>
+    The comparison is queued as a job: returns 202 {"job_id", "status_url"}, the job result is the SSIM timeline
+    and the frame ranges that differ (see video).
+    """
+    try:
+        ssim_threshold = float(request.query.get("ssim_threshold", video.DEFAULT_SSIM_THRESHOLD))
+        skip_tolerance = int(request.query.get("skip_tolerance", 0))
+    except ValueError:
+        return web.json_response({"error": "ssim_threshold and skip_tolerance must be numbers"}, status=400)
+
+    session = await get_session(request)
+    if "uid" not in session:
+        session["uid"] = str(uuid.uuid4())
+    session['last_access'] = time.time()
+
+    video_dir = os.path.join(request.app["upload_dir"], session['uid'], "video-{}".format(uuid.uuid4().hex))
+    os.makedirs(video_dir)
+    request.app["janitor"].touch(session['uid'])
+
+    response = None
+    try:
+        response = await _submit_video(request, video_dir, skip_tolerance, ssim_threshold)
+        return response
+    finally:
+        if response is None or response.status != 202:
+            # no job refers to the uploads, partial ones included
+            await request.app.loop.run_in_executor(None, shutil.rmtree, video_dir, True)
+
+
+async def _submit_video(request, video_dir, skip_tolerance, ssim_threshold):
+    reader = await request.multipart()
+
+    paths = {}
+    while True:
+        part = await reader.next()
+        if part is None:
+            break
+
+        filename = os.path.basename(part.filename or "")
+        if part.name not in ("golden", "capture") or len(filename) == 0:
+            return web.json_response({"error": "expected a golden and a capture part"}, status=400)
+
+        # named after the part, the extension tells a golden image from a golden video
+        path = os.path.join(video_dir, part.name + os.path.splitext(filename)[1].lower())
+        try:
+            await uploads.save_part(part, path, request.app.loop,
+                                    request.app["upload_executor"], request.app["max_upload_size"])
+        except uploads.UploadTooLarge as x:
+            return web.json_response({"error": F"{filename}: {x}"}, status=413)
+        paths[part.name] = path
+
+    if "golden" not in paths or "capture" not in paths:
+        return web.json_response({"error": "a golden and a capture part are required"}, status=400)
+    if video.is_image(paths["capture"]):
+        return web.json_response({"error": "the capture must be a video"}, status=400)
+
+    diff_params = request.app["diff_params"]
+    params = {"shift_method": diff_params.get("shift_method", "full"),
+              "shift_precheck": diff_params.get("shift_precheck", True),
+              "ssim_tile_size": diff_params.get("ssim_tile_size"),
+              "region_min_area": diff_params.get("region_min_area", 0),
+              "region_merge_distance": diff_params.get("region_merge_distance", 0)}
+
+    job_manager = request.app["job_manager"]
+    try:
+        job = job_manager.submit(functools.partial(compute_video_diff, request.app, paths["golden"], paths["capture"],
+                                                   video_dir, params, skip_tolerance, ssim_threshold),
+                                 timeout=request.app["video_timeout"])
+    except jobs.QueueFull as x:
+        return web.json_response({"error": str(x)}, status=429, headers={"Retry-After": "5"})
+
+    return web.json_response({"job_id": job.id, "status_url": "/jobs/{}".format(job.id)}, status=202)
+
+
+async def _hash_golden(app, path, filename, info):
+    # hash an uploaded golden image in a worker, then move it into the library
+    library = app["golden_library"]
+    try:
+        hashes = await app["worker_pool"].run(None, golden_library.file_hashes, path)
+    except ValueError as x:
+        os.remove(path)
+        return {"name": filename, "error": str(x)}
+
+    record = await app.loop.run_in_executor(None, library.add, path, filename, info, hashes)
+    return {"id": record["id"], "name": record["name"], "hashes": record["hashes"]}
+
+
+async def add_goldens(request):
+    """
+    Add golden images to the library.
+    multipart/form-data: any number of "golden" parts, each is hashed in a worker as soon as it is uploaded.
+    An image that is already in the library keeps its id.
+        {"added": [{"id", "name", "hashes"} or {"name", "error"}, ...]}
+    """
+    library = request.app["golden_library"]
+    if library is None:
+        return web.json_response({"error": "no golden library configured"}, status=404)
+
+    reader = await request.multipart()
+
+    futures = []
+    while True:
+        part = await reader.next()
+        if part is None:
+            break
+
+        filename = os.path.basename(part.filename or "")
+        if part.name != "golden" or len(filename) == 0:
+            return web.json_response({"error": "expected golden parts"}, status=400)
+
+        path = os.path.join(library.images_dir, ".incoming-{}".format(uuid.uuid4().hex))
+        try:
+            info = await uploads.save_part(part, path, request.app.loop,
+                                           request.app["upload_executor"], request.app["max_upload_size"])
+        except uploads.UploadTooLarge as x:
+            return web.json_response({"error": F"{filename}: {x}"}, status=413)
+
+        futures.append(asyncio.ensure_future(_hash_golden(request.app, path, filename, info)))
+
+    return web.json_response({"added": await asyncio.gather(*futures)})
+
+
+async def match_golden(request):
+    """
+    The golden images of the library a capture most likely shows.
+    multipart/form-data: one "capture" part, ?k=<number of candidates> (default 5)
+        {"candidates": [{"id", "name", "distance", "distances"}, ...] nearest first, "hashes"}
+    """
+    library = request.app["golden_library"]
+    if library is None:
+        return web.json_response({"error": "no golden library configured"}, status=404)
+
+    try:
+        k = int(request.query.get("k", request.app["golden_candidates"]))
+    except ValueError:
+        return web.json_response({"error": "k must be a number"}, status=400)
+
+    reader = await request.multipart()
+    part = await reader.next()
+    if part is None or part.name != "capture":
+        return web.json_response({"error": "expected a capture part"}, status=400)
+
+    path = os.path.join(library.images_dir, ".incoming-{}".format(uuid.uuid4().hex))
+    try:
+        await uploads.save_part(part, path, request.app.loop,
+                                request.app["upload_executor"], request.app["max_upload_size"])
+        hashes = await request.app["worker_pool"].run(None, golden_library.file_hashes, path)
+    except uploads.UploadTooLarge as x:
+        return web.json_response({"error": str(x)}, status=413)
+    except ValueError as x:
+        return web.json_response({"error": str(x)}, status=400)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+    return web.json_response({"candidates": library.match(hashes, k), "hashes": hashes})
+
+
+def _copy_golden(source, path):
+    # a hard link when the library and the uploads are on the same file system
+    if os.path.exists(path):
+        os.remove(path)
+    try:
+        os.link(source, path)
+    except OSError:
+        shutil.copyfile(source, path)
+
+
+async def use_golden(request):
+    """
+    Make a golden image of the library the session's left image - e.g. one of the candidates of the right image
+    """
+    library = request.app["golden_library"]
+    record = library.get(request.match_info["golden_id"]) if library is not None else None
+    if record is None:
+        return web.Response(status=404, text="Unknown golden image")
+
+    session = await get_session(request)
+    if "uid" not in session:
+        session["uid"] = str(uuid.uuid4())
+    session['last_access'] = time.time()
+    if "session_data" not in session:
+        session["session_data"] = {}
+
+    upload_dir_path = os.path.join(request.app["upload_dir"], session['uid'])
+    if not os.path.exists(upload_dir_path):
+        os.makedirs(upload_dir_path)
+
+    # the right image keeps its name
+    filename = record["name"]
+    right = session["session_data"].get("right_image")
+    if right and right.get("filename") == filename:
+        filename = "golden-" + filename
+
+    path = os.path.join(upload_dir_path, filename)
+    await request.app.loop.run_in_executor(None, _copy_golden, library.image_path(record), path)
+
+    info = dict(record["info"])
+    await _prerender(request.app, upload_dir_path, path, info)
+
+    info["filename"] = filename
+    info["golden_id"] = record["id"]
+    session["session_data"]["left_image"] = info
+    session.changed()
+    request.app["janitor"].record_upload(session['uid'], info["size"])
+
+    return web.HTTPFound('/diff')
+
+
+async def golden_stats(request):
+    library = request.app["golden_library"]
+    if library is None:
+        return web.json_response({"enabled": False})
+
+    stats = library.stats()
+    stats["enabled"] = True
+    return web.json_response(stats)
+
+
+async def janitor_stats(request):
+    return web.json_response(request.app["janitor"].stats())
+
+
+async def queue_stats(request):
+    queue = request.app["job_queue"]
+    if queue is None:
+        return web.json_response({"enabled": False})
+
+    stats = await request.app.loop.run_in_executor(None, queue.stats)
+    stats["enabled"] = True
+    return web.json_response(stats)
+
+
+async def session_stats(request):
+    return web.json_response(request.app["sessions"].stats())
+
+
+async def worker_stats(request):
+    return web.json_response(await request.app["worker_pool"].stats())
+
+
+async def prometheus_metrics(request):
+    """
+    Prometheus text format: the request, diff and stage families of the telemetry registry and the state of the job
+    queue and the worker pool at the time of the scrape
+    """
+    app = request.app
+    jobs_stats = app["job_manager"].stats()
+    workers = app["worker_pool"].utilisation()
+
+    samples = [
+        ("image_diff_jobs_queued", "gauge", "Diff jobs waiting in the queue", [({}, jobs_stats["queue_depth"])]),
+        ("image_diff_jobs_running", "gauge", "Diff jobs running", [({}, jobs_stats["running"])]),
+        ("image_diff_jobs_rejected_total", "counter", "Diff jobs rejected because the queue was full",
+         [({}, jobs_stats["rejected"])]),
+        ("image_diff_jobs_finished_total", "counter", "Finished diff jobs by final state",
+         [({"state": state}, count) for state, count in jobs_stats["finished"].items()]),
+        ("image_diff_job_wait_seconds_avg", "gauge", "Average seconds a diff job waited in the queue",
+         [({}, jobs_stats["wait_time_avg"])]),
+        ("image_diff_diffs_total", "counter", "Diffs by what settled them: result cache, a prechecks tier or the full comparison",
+         [({"settled_by": settled_by}, count) for settled_by, count in app["settled_by"].items()]),
+        ("image_diff_worker_busy_seconds_total", "counter", "Seconds each worker process was busy",
+         [({"worker": w["worker"]}, w["busy_seconds"]) for w in workers]),
+        ("image_diff_worker_utilisation", "gauge", "Fraction of the time each worker process was busy",
+         [({"worker": w["worker"]}, w["utilisation"]) for w in workers]),
+        ("image_diff_worker_in_flight", "gauge", "Jobs in flight on each worker process",
+         [({"worker": w["worker"]}, w["in_flight"]) for w in workers]),
+    ]
+
+    return web.Response(text=app["telemetry"].exposition(samples),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+async def segment_stats(request):
+    segments = request.app["segments"]
+    if segments is None:
+        return web.json_response({"enabled": False})
+
+    stats = segments.stats()
+    stats["enabled"] = True
+    return web.json_response(stats)
@@ -0,0 +1,158 @@
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import time
+import zlib
+
+import decoded_cache
+
+logger = logging.getLogger(__name__)
+
+
+def _timed(fn, *args):
+    # runs in the worker: when the job left the executor queue, and its result or exception
+    started = time.time()
+    try:
+        return started, fn(*args), None
+    except Exception as x:
+        return started, None, x
+
+
+def job_name(fn):
+    while isinstance(fn, functools.partial):
+        fn = fn.func
+    return getattr(fn, "__name__", "job")
+
+
+class AffinityPool:
+    """
+    Diff worker processes with job affinity.
+
+    Each worker is a single process executor holding its own decoded_cache. run() with a key (the session uid) sends
+    the job to the worker the key hashes to, so the same session keeps hitting the worker that has its images
+    decoded. When that worker is busy and another one is idle the job goes to the idle one instead - a cache miss
+    is cheaper than waiting for a whole diff computation. run() without a key picks the least busy worker.
+
+    With a telemetry.Registry the time every job waited for its worker goes to the image_diff_pool_wait_seconds
+    histogram; the seconds each worker was busy are counted either way (utilisation in stats).
+    """
+
+    def __init__(self, workers, decode_cache_bytes, registry=None):
+        self.decode_cache_bytes = decode_cache_bytes
+        self._executors = [concurrent.futures.ProcessPoolExecutor(max_workers=1) for _ in range(workers)]
+        self._in_flight = [0] * workers
+        self._busy = [0.0] * workers
+        self._created = time.time()
+
+        self._wait = None
+        if registry is not None:
+            self._wait = registry.histogram("image_diff_pool_wait_seconds",
+                                            "Seconds a job waited for its worker process", ("job",))
+
+        self.affine = 0
+        self.spilled = 0
+
+        # every worker starts its decoded image cache
+        for executor in self._executors:
+            executor.submit(decoded_cache.configure, decode_cache_bytes)
+
+    def _pick(self, key):
+        least_busy = min(range(len(self._executors)), key=lambda i: self._in_flight[i])
+        if key is None:
+            return least_busy
+
+        index = zlib.crc32(key.encode('utf-8')) % len(self._executors)
+        if self._in_flight[index] > 0 and self._in_flight[least_busy] == 0:
+            self.spilled += 1
+            return least_busy
+        self.affine += 1
+        return index
+
+    async def run(self, key, fn, *args):
+        """
+        Run fn(*args) in a worker process
+        :param key: affinity key, None for any worker
+
+        Cancelling the caller (a job timeout) only stops the wait: a computation that has started runs to its end and
+        its worker counts as in flight until then.
+        """
+        return await self.result(self.submit(key, fn, *args))
+
+    def submit(self, key, fn, *args):
+        """
+        Hand fn(*args) to a worker process without waiting for it, for a caller that must know when the computation
+        really ended (e.g. before it removes its input files). Cancelling the future only stops a computation that
+        has not started yet.
+        :return: concurrent.futures.Future, its result comes from result()
+        """
+        index = self._pick(key)
+        self._in_flight[index] += 1
+        submitted = time.time()
+        loop = asyncio.get_event_loop()
+        future = self._executors[index].submit(_timed, fn, *args)
+        future.add_done_callback(functools.partial(self._done_callback, loop, index, submitted, job_name(fn)))
+        return future
+
+    @staticmethod
+    async def result(future):
+        """
+        Wait for a future of submit()
+        :return: the result of fn, or raises its exception
+        """
+        started, result, error = await asyncio.wrap_future(future)
+        if error is not None:
+            raise error
+        return result
+
+    def _done_callback(self, loop, index, submitted, name, future):
+        # in the thread of the executor, the bookkeeping is done on the event loop
+        try:
+            loop.call_soon_threadsafe(self._done, index, submitted, name, future)
+        except RuntimeError:
+            # the loop is closed, the server is shutting down
+            pass
+
+    def _done(self, index, submitted, name, future):
+        # the worker is done with a job, whether or not anybody still waits for it
+        self._in_flight[index] -= 1
+        if future.cancelled() or future.exception() is not None:
+            # never started, or the worker process died
+            return
+        started = future.result()[0]
+        self._busy[index] += time.time() - started
+        if self._wait is not None:
+            self._wait.observe(max(0.0, started - submitted), name)
+
+    def utilisation(self):
+        """
+        Fraction of the time since the pool started each worker was busy, and how many jobs it has in flight
+        :return: [{"worker", "busy_seconds", "utilisation", "in_flight"}]
+        """
+        uptime = max(time.time() - self._created, 1e-9)
+        return [{"worker": i, "busy_seconds": busy, "utilisation": min(1.0, busy / uptime), "in_flight": in_flight}
+                for i, (busy, in_flight) in enumerate(zip(self._busy, self._in_flight))]
+
+    async def stats(self):
+        """
+        Decoded image cache statistics of every worker, asked in the worker processes - a busy worker answers once
+        its current job is done
+        """
+        loop = asyncio.get_event_loop()
+        workers = await asyncio.gather(*[loop.run_in_executor(executor, decoded_cache.stats) for executor in self._executors])
+        for worker, utilisation in zip(workers, self.utilisation()):
+            worker.update(utilisation)
+
+        hits = sum(worker.get("hits", 0) for worker in workers)
+        lookups = hits + sum(worker.get("misses", 0) for worker in workers)
+        return {
+            "workers": workers,
+            "bytes": sum(worker.get("bytes", 0) for worker in workers),
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "affine": self.affine,
+            "spilled": self.spilled,
+        }
+
+    def shutdown(self, wait=True):
+        for executor in self._executors:
+            executor.shutdown(wait=wait)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules import each other by their plain names, like when main.py runs from compare_image
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "compare_image"))
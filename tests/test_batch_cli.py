@@ -0,0 +1,71 @@
+import csv
+import json
+import os
+
+import cv2
+import numpy as np
+
+import batch_cli
+
+
+def _golden():
+    rng = np.random.RandomState(0)
+    return cv2.GaussianBlur((rng.rand(240, 320, 3) * 255).astype(np.uint8), (9, 9), 3)
+
+
+def _dirs(tmp_path):
+    # two pairs and a capture without a golden image
+    golden_dir, capture_dir = tmp_path / "goldens", tmp_path / "captures"
+    golden_dir.mkdir()
+    capture_dir.mkdir()
+    golden = _golden()
+    changed = golden.copy()
+    cv2.rectangle(changed, (40, 50), (99, 89), (0, 0, 255), -1)
+    for name in ("same.png", "changed.png"):
+        cv2.imwrite(str(golden_dir / name), golden)
+    cv2.imwrite(str(capture_dir / "same.png"), golden)
+    cv2.imwrite(str(capture_dir / "changed.png"), changed)
+    cv2.imwrite(str(capture_dir / "orphan.png"), changed)
+    (capture_dir / "notes.txt").write_text("not an image")
+    return str(golden_dir), str(capture_dir)
+
+
+def _run(pairs, out, artifact_dir=None):
+    return batch_cli.run(pairs, out, artifact_dir, 1, "full", True)
+
+
+def test_batch_of_a_directory(tmp_path):
+    golden_dir, capture_dir = _dirs(tmp_path)
+    pairs = batch_cli.pairs_by_name(golden_dir, capture_dir)
+    out = str(tmp_path / "results.jsonl")
+
+    assert [os.path.basename(capture) for _, capture in pairs] == ["changed.png", "same.png"]
+    assert _run(pairs, out, str(tmp_path / "artifacts")) == (2, 0)
+
+    with open(out) as f:
+        records = {os.path.basename(r["capture"]): r for r in map(json.loads, f)}
+    assert sorted(records) == ["changed.png", "same.png"]
+    assert all(r["code"] == 0 and r["golden"].startswith(golden_dir) for r in records.values())
+    assert records["same.png"]["ssim_score"] == 1.0
+    assert records["changed.png"]["ssim_score"] < 1.0
+    assert os.listdir(str(tmp_path / "artifacts"))
+
+    # a restarted run skips the pairs already done
+    assert _run(pairs, out) == (0, 0)
+
+
+def test_batch_of_a_manifest_to_csv(tmp_path):
+    golden_dir, capture_dir = _dirs(tmp_path)
+    manifest = tmp_path / "pairs.csv"
+    manifest.write_text("golden,capture\ngoldens/changed.png,captures/changed.png\ngoldens/same.png,missing.png\n")
+    out = str(tmp_path / "results.csv")
+
+    assert _run(batch_cli.pairs_from_manifest(str(manifest)), out) == (2, 1)
+
+    with open(out, newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert [os.path.basename(row["capture"]) for row in sorted(rows, key=lambda row: row["capture"])] == \
+        ["changed.png", "missing.png"]
+    assert {row["code"] for row in rows} == {"0", "1"}
+    # only the failed pair is compared again
+    assert _run(batch_cli.pairs_from_manifest(str(manifest)), out) == (1, 1)
@@ -0,0 +1,49 @@
+import json
+
+import numpy as np
+
+import bench
+
+
+def test_synthetic_case_ground_truth():
+    case = bench.synthetic_case(240, 320, shift_row=-5, shift_col=9, defects=2, color_changes=1, seed=3)
+
+    assert case.truth["shift"] == [0, 5, 9, 0]
+    # the black bars are where the shift says
+    assert not case.capture[-5:].any() and not case.capture[:, :9].any()
+    golden, capture = bench.cropped(case)
+    assert golden.shape == capture.shape == (235, 311, 3)
+    assert case.truth["kinds"] == ["defect", "defect", "color"]
+    for x, y, w, h in case.truth["defects"]:
+        assert (golden[y:y + h, x:x + w] != capture[y:y + h, x:x + w]).any()
+    # deterministic
+    assert np.array_equal(bench.synthetic_case(240, 320, -5, 9, defects=2, color_changes=1, seed=3).capture,
+                          case.capture)
+
+
+def test_every_benchmark_on_a_small_pair(tmp_path, monkeypatch, capsys):
+    monkeypatch.setitem(bench.SIZES, "small", (360, 480))
+    monkeypatch.setattr(bench, "RESULTS", [])
+
+    for name in sorted(bench.BENCHMARKS):
+        bench.BENCHMARKS[name](["small"])
+    out = str(tmp_path / "run.json")
+    bench.write_results(out, sorted(bench.BENCHMARKS), ["small"])
+
+    names = {result["name"] for result in bench.RESULTS}
+    assert {"detect_shift_using_correlation pyramid", "detect_shift", "histogram_data", "compute_SSIM tiled",
+            "compare", "workon_images lazy"} <= names
+    assert [result["name"] for result in bench.RESULTS if result["ok"] is False] == []
+    with open(out) as f:
+        assert len(json.load(f)["results"]) == len(bench.RESULTS)
+
+    # against itself nothing is slower, against a run twice as fast everything is
+    assert bench.compare_with_baseline(out, 0.1) == 0
+    with open(out) as f:
+        run = json.load(f)
+    for result in run["results"]:
+        result["seconds"] /= 2
+    with open(out, 'w') as f:
+        json.dump(run, f)
+    assert bench.compare_with_baseline(out, 0.1) == len(bench.RESULTS)
+    assert "SLOWER" in capsys.readouterr().out
@@ -0,0 +1,47 @@
+import cv2
+import numpy as np
+
+import decoded_cache
+import tiles
+
+
+def _image(width, height):
+    return np.random.RandomState(0).randint(0, 256, (height, width, 3), dtype=np.uint8)
+
+
+def test_nbytes_counts_the_pyramid():
+    decoded = decoded_cache.DecodedImage(_image(1500, 1000))
+    levels = decoded.get("pyramid", tiles.pyramid)
+
+    assert len(levels) > 2
+    # level 0 is the image itself, counted once
+    assert levels[0] is decoded.image
+    assert decoded.nbytes == decoded.image.nbytes + sum(level.nbytes for level in levels[1:])
+
+
+def test_nbytes_counts_views_once():
+    decoded = decoded_cache.DecodedImage(_image(400, 300))
+    decoded.get("crop", lambda image: image[10:-10, 10:-10])
+    gray = decoded.gray
+
+    assert decoded.nbytes == decoded.image.nbytes + gray.nbytes
+
+
+def test_trim_evicts_for_derived_data(tmp_path):
+    paths = []
+    for i in range(2):
+        path = str(tmp_path / "{}.png".format(i))
+        cv2.imwrite(path, _image(1500, 1000))
+        paths.append(path)
+
+    image_bytes = 1500 * 1000 * 3
+    cache = decoded_cache.DecodedImageCache(int(image_bytes * 2.2))
+    first = cache.get(paths[0])
+    cache.get(paths[1])
+    assert cache.stats()["entries"] == 2
+
+    # the pyramid (a third of an image more) pushes the cache over its limit, the least recently used entry goes
+    first.get("pyramid", tiles.pyramid)
+    cache.trim()
+    assert cache.stats()["entries"] == 1
+    assert cache.evictions == 1
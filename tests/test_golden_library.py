@@ -0,0 +1,115 @@
+import json
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+import golden_library
+
+
+def _gray(seed, shape=(120, 160)):
+    rng = np.random.RandomState(seed)
+    return cv2.GaussianBlur((rng.rand(*shape) * 255).astype(np.uint8), (0, 0), 6)
+
+
+def _distance(a, b):
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+
+def test_popcount():
+    rng = np.random.RandomState(0)
+    values = np.concatenate([rng.randint(0, 2 ** 63, 1000, dtype=np.uint64) * np.uint64(2) + np.uint64(1),
+                             np.array([0, 1, 2 ** 64 - 1, 2 ** 63], dtype=np.uint64)])
+    expected = [bin(int(v)).count("1") for v in values]
+
+    assert golden_library.popcount(values.copy()).tolist() == expected
+
+
+def test_hashes_of_known_patterns():
+    left_bright = np.zeros((64, 64), np.uint8)
+    left_bright[:, :32] = 255
+    gradient = np.tile(np.arange(0, 180, 2, dtype=np.uint8), (80, 1))
+
+    assert golden_library.ahash(left_bright) == "f0" * 8
+    assert golden_library.dhash(gradient) == "ff" * 8
+    assert golden_library.dhash(gradient[:, ::-1]) == "00" * 8
+
+
+def test_hashes_tell_pictures_apart():
+    gray = _gray(0)
+    noisy = np.clip(gray + np.random.RandomState(1).normal(0, 2, gray.shape), 0, 255).astype(np.uint8)
+
+    hashes = golden_library.image_hashes(gray)
+
+    assert sorted(hashes) == sorted(golden_library.HASHES)
+    assert all(len(value) == 16 for value in hashes.values())
+    for name, value in golden_library.image_hashes(noisy).items():
+        assert _distance(value, hashes[name]) <= 6
+    other = golden_library.image_hashes(_gray(2))
+    assert sum(_distance(other[name], hashes[name]) for name in hashes) > 40
+
+
+def _add(library, tmp_path, name, gray, sha256):
+    path = str(tmp_path / "upload.png")
+    cv2.imwrite(path, gray)
+    return library.add(path, name, {"sha256": sha256, "size": os.path.getsize(path)},
+                       golden_library.image_hashes(gray))
+
+
+def test_add_keeps_one_copy_of_an_image(tmp_path):
+    library = golden_library.GoldenLibrary(str(tmp_path / "library"))
+
+    first = _add(library, tmp_path, "Login.PNG", _gray(0), "sha-a")
+    again = _add(library, tmp_path, "login-copy.png", _gray(0), "sha-a")
+
+    assert again == first
+    assert len(library) == 1
+    assert first["filename"] == first["id"] + ".png"
+    assert os.path.isfile(library.image_path(first))
+    assert not os.path.exists(str(tmp_path / "upload.png"))
+    assert library.get(first["id"]) == first
+
+
+def test_index_reload_skips_broken_lines(tmp_path):
+    library_dir = str(tmp_path / "library")
+    library = golden_library.GoldenLibrary(library_dir)
+    kept = _add(library, tmp_path, "kept.png", _gray(0), "sha-a")
+    gone = _add(library, tmp_path, "gone.png", _gray(1), "sha-b")
+    os.remove(library.image_path(gone))
+    # an add interrupted halfway through its line
+    with open(os.path.join(library_dir, golden_library.INDEX_FILE), 'a') as f:
+        f.write(json.dumps(kept)[:20])
+
+    reloaded = golden_library.GoldenLibrary(library_dir)
+
+    assert len(reloaded) == 1
+    assert reloaded.get(kept["id"]) == kept
+    assert reloaded.get(gone["id"]) is None
+    # still deduplicated by content after the reload
+    assert _add(reloaded, tmp_path, "again.png", _gray(0), "sha-a")["id"] == kept["id"]
+
+
+def test_match_orders_by_distance(tmp_path):
+    library = golden_library.GoldenLibrary(str(tmp_path / "library"))
+    records = [_add(library, tmp_path, "{}.png".format(seed), _gray(seed), "sha-{}".format(seed)) for seed in range(6)]
+    capture = np.clip(_gray(3) + np.random.RandomState(9).normal(0, 2, (120, 160)), 0, 255).astype(np.uint8)
+
+    matches = library.match(golden_library.image_hashes(capture), k=4)
+
+    assert len(matches) == 4
+    assert matches[0]["id"] == records[3]["id"]
+    assert [m["distance"] for m in matches] == sorted(m["distance"] for m in matches)
+    assert all(m["distance"] == sum(m["distances"].values()) for m in matches)
+    assert len(library.match(golden_library.image_hashes(capture), k=10)) == 6
+    assert library.match(golden_library.image_hashes(capture), k=0) == []
+    assert library.stats()["goldens"] == 6 and library.stats()["lookups"] == 2
+
+
+def test_file_hashes(tmp_path):
+    path = str(tmp_path / "image.png")
+    cv2.imwrite(path, cv2.cvtColor(_gray(0), cv2.COLOR_GRAY2BGR))
+
+    assert golden_library.file_hashes(path) == golden_library.image_hashes(_gray(0))
+    with pytest.raises(ValueError):
+        golden_library.file_hashes(str(tmp_path / "missing.png"))
@@ -0,0 +1,74 @@
+import cv2
+import numpy as np
+
+import image_ops
+
+
+def _pair():
+    rng = np.random.RandomState(0)
+    golden = cv2.GaussianBlur((rng.rand(240, 320, 3) * 255).astype(np.uint8), (9, 9), 3)
+    capture = golden.copy()
+    cv2.rectangle(capture, (40, 50), (99, 89), (0, 0, 255), -1)
+    return golden, capture
+
+
+def _covers(regions, x0, y0, x1, y1):
+    return any(x <= x0 and y <= y0 and x + w >= x1 and y + h >= y1 for x, y, w, h in regions)
+
+
+def test_changed_regions_finds_the_defect():
+    golden, capture = _pair()
+
+    ssim, diff, thresh, regions = image_ops.changed_regions(golden, capture)
+
+    assert 0 < ssim < 1
+    assert diff.dtype == np.uint8 and thresh.dtype == np.uint8
+    assert _covers(regions, 40, 50, 100, 90)
+
+
+def test_every_entry_point_finds_the_same_regions(tmp_path):
+    golden, capture = _pair()
+    _, _, _, regions = image_ops.changed_regions(golden, capture)
+
+    code, frames = image_ops.compare_frames(golden, capture)
+    assert code == 0
+    assert frames["regions"] == [list(box) for box in regions]
+
+    golden_path = str(tmp_path / "golden.png")
+    cv2.imwrite(golden_path, golden)
+    code, result = image_ops.prepare_golden(golden_path, str(tmp_path / "prepared"))
+    assert code == 0
+    code, result = image_ops.compare_to_golden(str(tmp_path / "prepared"), capture)
+    assert code == 0
+    assert result["regions"] == frames["regions"]
+    assert abs(result["ssim_score"] - frames["ssim_score"]) < 1e-6
+
+    ssim, marked_l, marked_r, _, _, compared = image_ops.compare(golden.copy(), capture.copy())
+    assert [list(box) for box in compared] == frames["regions"]
+
+
+def _calc_hist(image, channel):
+    return cv2.calcHist([image], [channel], None, [256], [0, 256]).ravel().astype(np.int64)
+
+
+def test_histogram_data_matches_calc_hist():
+    golden, _ = _pair()
+    # a cropped view is not contiguous, it goes through the row block copies
+    for image in (golden, golden[13:200, 7:301]):
+        data = image_ops.histogram_data(image)
+
+        for name, channel in (("h_b", 0), ("h_g", 1), ("h_r", 2)):
+            assert np.array_equal(data[name], _calc_hist(image, channel))
+        assert np.array_equal(data["h"], data["h_b"] + data["h_g"] + data["h_r"])
+        assert np.array_equal(data["bins"], np.arange(256))
+
+
+def test_histogram_data_of_a_gray_image(monkeypatch):
+    gray = cv2.cvtColor(_pair()[0], cv2.COLOR_BGR2GRAY)
+    # several blocks of rows
+    monkeypatch.setattr(image_ops, "HISTOGRAM_BLOCK_SIZE", 1000)
+
+    data = image_ops.histogram_data(gray)
+
+    assert np.array_equal(data["h"], _calc_hist(gray, 0))
+    assert data["h_b"] is None and data["h_g"] is None and data["h_r"] is None
@@ -0,0 +1,224 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import job_queue
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def run(fn):
+    # fn(loop) is the coroutine to run
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(fn(loop))
+    finally:
+        loop.close()
+
+
+def _empty(queue):
+    # run does not await its delete
+    for _ in range(100):
+        stats = queue.stats()
+        if not any(stats[state] for state in ("queued", "running", "done", "failed")):
+            return True
+        time.sleep(0.01)
+    return False
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(job_queue, "time", clock)
+    return clock
+
+
+def _queue(tmp_path, **kwargs):
+    return job_queue.SqliteQueue(str(tmp_path / "jobs.db"), visibility_timeout=30, **kwargs)
+
+
+def test_claim_leases_the_oldest_job(tmp_path, clock):
+    queue = _queue(tmp_path)
+    first = queue.put("fn", 1, key="a")
+    clock.now += 1
+    second = queue.put("fn", 2)
+
+    assert queue.claim("w1") == (first, "fn", [1], {"key": "a"}, 1)
+    assert queue.claim("w2") == (second, "fn", [2], {}, 1)
+    assert queue.claim("w3") is None
+
+
+def test_concurrent_claims_take_different_jobs(tmp_path):
+    queue = _queue(tmp_path)
+    jobs = {queue.put("fn", i) for i in range(40)}
+    claimed = []
+
+    def worker(name):
+        while True:
+            job = queue.claim(name)
+            if job is None:
+                return
+            claimed.append(job[0])
+
+    threads = [threading.Thread(target=worker, args=("w{}".format(i),)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(claimed) == sorted(jobs)
+
+
+def test_expired_lease_is_claimed_again(tmp_path, clock):
+    queue = _queue(tmp_path)
+    job_id = queue.put("fn")
+    queue.claim("w1")
+
+    clock.now += 20
+    assert queue.extend(job_id, "w1")
+    clock.now += 20
+    # extended, still leased
+    assert queue.claim("w2") is None
+
+    clock.now += 11
+    assert queue.claim("w2")[4] == 2
+    # the lease moved, the first worker can not extend or complete it
+    assert not queue.extend(job_id, "w1")
+    assert not queue.complete(job_id, "w1", "late")
+    assert queue.complete(job_id, "w2", "result")
+    assert queue.status(job_id) == (job_queue.DONE, "result", None)
+    assert queue.stats()["dropped"] == 1
+
+
+def test_job_of_a_lost_worker_fails_after_its_last_attempt(tmp_path, clock):
+    queue = _queue(tmp_path, max_attempts=2)
+    job_id = queue.put("fn")
+    queue.claim("w1")
+    clock.now += 31
+    queue.claim("w2")
+    clock.now += 31
+
+    assert queue.claim("w3") is None
+    assert queue.status(job_id) == (job_queue.FAILED, None, "worker lost")
+
+
+def test_failed_job_is_retried_later(tmp_path, clock):
+    queue = _queue(tmp_path, max_attempts=2)
+    job_id = queue.put("fn")
+    queue.claim("w1")
+
+    queue.fail(job_id, "w1", "boom")
+    assert queue.status(job_id) == (job_queue.QUEUED, None, "boom")
+    assert queue.claim("w2") is None
+    clock.now += job_queue.RETRY_DELAY
+    assert queue.claim("w2")[4] == 2
+
+    queue.fail(job_id, "w2", "boom again")
+    assert queue.status(job_id) == (job_queue.FAILED, None, "boom again")
+
+
+def test_fail_without_retry(tmp_path):
+    queue = _queue(tmp_path)
+    job_id = queue.put("fn")
+    queue.claim("w1")
+
+    queue.fail(job_id, "w1", "bad arguments", retry=False)
+
+    assert queue.status(job_id)[0] == job_queue.FAILED
+
+
+def test_deleted_job_is_skipped(tmp_path):
+    queue = _queue(tmp_path)
+    job_id = queue.put("fn")
+    queue.claim("w1")
+    queue.delete(job_id)
+
+    assert not queue.start(job_id, "w1")
+    assert queue.status(job_id) is None
+    assert queue.stats()["skipped"] == 1
+
+
+def test_purge_deletes_old_finished_jobs(tmp_path, clock):
+    queue = _queue(tmp_path)
+    done = queue.put("fn")
+    running = queue.put("fn")
+    queue.claim("w")
+    queue.claim("w")
+    queue.complete(done, "w", 1)
+
+    clock.now += 100
+    assert queue.purge(200) == 0
+    assert queue.purge(50) == 1
+    assert queue.status(done) is None
+    assert queue.status(running)[0] == job_queue.RUNNING
+
+
+def _serve(queue, outcome, stop):
+    # a worker thread: complete each job with outcome(args), or fail it if outcome raises
+    while not stop.is_set():
+        job = queue.claim("w")
+        if job is None:
+            stop.wait(0.01)
+            continue
+        try:
+            queue.complete(job[0], "w", outcome(*job[2]))
+        except Exception as x:
+            queue.fail(job[0], "w", str(x), retry=False)
+
+
+@pytest.fixture
+def served(tmp_path):
+    threads = []
+    stop = threading.Event()
+
+    def serve(outcome):
+        queue = _queue(tmp_path)
+        thread = threading.Thread(target=_serve, args=(queue, outcome, stop))
+        thread.start()
+        threads.append(thread)
+        return queue
+
+    yield serve
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+
+def test_run_returns_the_result_and_deletes_the_job(served):
+    queue = served(lambda x: x * 2)
+
+    assert run(lambda loop: queue.run(loop, "double", 21)) == 42
+    assert _empty(queue)
+
+
+def test_run_raises_when_the_job_failed(served):
+    def fail(x):
+        raise RuntimeError("no")
+    queue = served(fail)
+
+    with pytest.raises(job_queue.JobFailed, match="no"):
+        run(lambda loop: queue.run(loop, "fail", 1))
+    assert _empty(queue)
+
+
+def test_cancelled_run_deletes_the_job(tmp_path):
+    queue = _queue(tmp_path)
+
+    async def cancelled(loop):
+        task = loop.create_task(queue.run(loop, "fn"))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    run(cancelled)
+
+    assert _empty(queue)
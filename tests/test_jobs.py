@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+import jobs
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+
+async def _blocked(event):
+    await event.wait()
+    return "done"
+
+
+def test_full_queue_rejects_jobs():
+    async def test():
+        manager = jobs.JobManager(workers=0, max_queue=2, timeout=10)
+        manager.start()
+        manager.submit(lambda: _blocked(asyncio.Event()))
+        manager.submit(lambda: _blocked(asyncio.Event()))
+        with pytest.raises(jobs.QueueFull):
+            manager.submit(lambda: _blocked(asyncio.Event()))
+        return manager.stats()
+
+    stats = run(test())
+
+    assert stats["queue_depth"] == 2 and stats["submitted"] == 2 and stats["rejected"] == 1
+
+
+def test_cancelling_a_queued_job_frees_its_place():
+    async def test():
+        manager = jobs.JobManager(workers=1, max_queue=1, timeout=10)
+        manager.start()
+        release = asyncio.Event()
+        running = manager.submit(lambda: _blocked(release))
+        await asyncio.sleep(0.01)
+        queued = manager.submit(lambda: _blocked(release))
+        with pytest.raises(jobs.QueueFull):
+            manager.submit(lambda: _blocked(release))
+
+        assert manager.cancel(queued.id)
+        assert queued.state == jobs.CANCELLED
+        assert manager.stats()["queue_depth"] == 0
+        last = manager.submit(lambda: _blocked(release))
+
+        release.set()
+        assert await manager.wait(last, 1)
+        await manager.stop()
+        return running, queued, last
+
+    running, queued, last = run(test())
+
+    assert running.state == jobs.DONE and last.state == jobs.DONE
+    assert queued.state == jobs.CANCELLED and queued.started is None
+
+
+def test_wait_leaves_nothing_behind_on_timeout():
+    async def test():
+        manager = jobs.JobManager(workers=1, max_queue=1, timeout=10)
+        manager.start()
+        release = asyncio.Event()
+        job = manager.submit(lambda: _blocked(release))
+
+        for _ in range(3):
+            assert not await manager.wait(job, 0.01)
+        # no waiter left on the job from the timed out calls, once their cancellation ran
+        await asyncio.sleep(0)
+        waiters = len(job.done._waiters)
+
+        release.set()
+        assert await manager.wait(job, 1)
+        await manager.stop()
+        return waiters
+
+    assert run(test()) == 0
+
+
+def test_timed_out_job():
+    async def test():
+        manager = jobs.JobManager(workers=1, max_queue=1, timeout=0.01)
+        manager.start()
+        job = manager.submit(lambda: _blocked(asyncio.Event()))
+        await manager.wait(job, 1)
+        await manager.stop()
+        return job
+
+    job = run(test())
+
+    assert job.state == jobs.TIMEOUT and "timed out" in job.error
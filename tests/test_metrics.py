@@ -0,0 +1,90 @@
+import math
+
+import cv2
+import numpy as np
+import pytest
+from skimage.measure import compare_ssim
+
+import metrics
+
+
+def _pair(shape=(120, 160, 3), seed=0):
+    rng = np.random.RandomState(seed)
+    a = cv2.GaussianBlur((rng.rand(*shape) * 255).astype(np.uint8), (5, 5), 1)
+    b = np.clip(a + rng.normal(0, 12, shape), 0, 255).astype(np.uint8)
+    return a, b
+
+
+def _ssim(x, y):
+    # the SSIM of the paper, see metrics
+    return compare_ssim(x, y, gaussian_weights=True, sigma=1.5, use_sample_covariance=False, data_range=255)
+
+
+def test_mse_and_psnr():
+    a, b = _pair()
+    mse = np.mean((a.astype(np.float64) - b) ** 2)
+
+    values = metrics.compute_metrics(["mse", "psnr"], a, b)
+
+    assert values["mse"] == pytest.approx(mse)
+    assert values["psnr"] == pytest.approx(10 * math.log10(255 ** 2 / mse))
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_ssim_matches_skimage(seed):
+    a, b = _pair(seed=seed)
+
+    values = metrics.compute_metrics(["ssim", "ssim_channels"], a, b)
+
+    gray_a, gray_b = cv2.cvtColor(a, cv2.COLOR_BGR2GRAY), cv2.cvtColor(b, cv2.COLOR_BGR2GRAY)
+    assert values["ssim"] == pytest.approx(_ssim(gray_a, gray_b), abs=1e-4)
+    assert sorted(values["ssim_channels"]) == ["b", "g", "r"]
+    for i, name in enumerate("bgr"):
+        assert values["ssim_channels"][name] == pytest.approx(_ssim(a[:, :, i], b[:, :, i]), abs=1e-4)
+
+
+def test_ssim_of_a_grayscale_pair():
+    a, b = _pair((100, 90))
+
+    values = metrics.compute_metrics(["ssim", "ssim_channels"], a, b)
+
+    assert values["ssim"] == pytest.approx(_ssim(a, b), abs=1e-4)
+    assert values["ssim_channels"] == {"gray": values["ssim"]}
+
+
+def test_ms_ssim():
+    a, b = _pair((256, 256, 3))
+    worse = np.clip(a + np.random.RandomState(1).normal(0, 40, a.shape), 0, 255).astype(np.uint8)
+
+    value = metrics.compute_metrics(["ms_ssim"], a, b)["ms_ssim"]
+
+    assert metrics.compute_metrics(["ms_ssim"], a, a.copy())["ms_ssim"] == pytest.approx(1.0)
+    assert 0 < metrics.compute_metrics(["ms_ssim"], a, worse)["ms_ssim"] < value < 1
+    # a pair smaller than the window falls back to the single scale
+    small_a, small_b = a[:8, :8], b[:8, :8]
+    assert metrics.compute_metrics(["ms_ssim"], small_a, small_b)["ms_ssim"] == \
+        metrics.compute_metrics(["ssim"], small_a, small_b)["ssim"]
+
+
+def test_identical_metrics_match_the_computed_ones():
+    a, _ = _pair()
+    names = list(metrics.REGISTRY)
+
+    identical = metrics.identical_metrics(names, a)
+    computed = metrics.compute_metrics(names, a, a.copy())
+
+    assert identical["psnr"] is None and computed["psnr"] is None
+    assert identical["mse"] == computed["mse"] == 0
+    for name in ("ssim", "ms_ssim"):
+        assert computed[name] == pytest.approx(identical[name])
+    assert computed["ssim_channels"] == pytest.approx(identical["ssim_channels"])
+
+
+def test_unknown_metric():
+    a, b = _pair()
+
+    with pytest.raises(ValueError):
+        metrics.check_metrics(["ssim", "nope"])
+    with pytest.raises(ValueError):
+        metrics.compute_metrics(["nope"], a, b)
+    metrics.check_metrics(None)
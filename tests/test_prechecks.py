@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+import prechecks
+from decoded_cache import DecodedImage
+
+
+def _image(seed, shape=(600, 900, 3)):
+    return np.random.RandomState(seed).randint(0, 256, shape, dtype=np.uint8)
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("shape", [(600, 900, 3), (333, 517, 3), (1000, 257)])
+def test_small_bounds_the_mean_abs_diff(seed, shape):
+    # what lets compare_pixels send a pair on after the downscaled comparison: it is at most one above the full one
+    rng = np.random.RandomState(seed)
+    left = _image(seed, shape)
+    right = np.clip(left.astype(np.int16) + rng.randint(-40, 41, shape) * (rng.rand(*shape) < 0.3), 0, 255)
+    right = right.astype(np.uint8)
+
+    full = prechecks.mean_abs_diff(left, right)
+    downscaled = prechecks.mean_abs_diff(prechecks.small(left), prechecks.small(right))
+
+    assert max(prechecks.small(left).shape[:2]) <= prechecks.SMALL_SIZE
+    assert downscaled <= full + 1
+
+
+def test_compare_pixels_identical():
+    image = _image(0)
+
+    assert prechecks.compare_pixels(DecodedImage(image), DecodedImage(image.copy())) == (prechecks.PIXELS, 0.0)
+
+
+def test_compare_pixels_near_identical():
+    left = _image(0)
+    right = left.copy()
+    right[::7, ::5] ^= 1
+
+    tier, mad = prechecks.compare_pixels(DecodedImage(left), DecodedImage(right), near_identical=0.5)
+
+    assert tier == prechecks.NEAR_IDENTICAL
+    assert 0 < mad <= 0.5
+    assert prechecks.compare_pixels(DecodedImage(left), DecodedImage(right))[0] is None
+
+
+def test_compare_pixels_keeps_a_strong_local_change():
+    # a small defect hardly moves the mean but exceeds the noise level
+    left = _image(0)
+    right = left.copy()
+    right[100:104, 100:104] = 255 - right[100:104, 100:104]
+
+    tier, mad = prechecks.compare_pixels(DecodedImage(left), DecodedImage(right), near_identical=1.0)
+
+    assert tier is None
+    assert mad < 1.0
+
+
+def test_compare_pixels_stops_at_the_downscaled_images():
+    left = DecodedImage(_image(0))
+    right = DecodedImage(_image(1))
+
+    tier, _ = prechecks.compare_pixels(left, right, near_identical=2.0)
+
+    assert tier is None
+    # the full resolution images were not compared, only the small ones derived
+    assert set(left._derived) == {"small"}
+
+
+def test_same_file(tmp_path):
+    a, b, c = tmp_path / "a", tmp_path / "b", tmp_path / "c"
+    a.write_bytes(b"x" * 10000)
+    b.write_bytes(b"x" * 10000)
+    c.write_bytes(b"x" * 9999 + b"y")
+
+    assert prechecks.same_file(str(a), str(b))
+    assert not prechecks.same_file(str(a), str(c))
+    # known digests are trusted, the files are not read
+    assert not prechecks.same_file(str(a), str(b), digests=("1", "2"))
+    assert prechecks.same_file(str(a), str(c), digests=("1", "1"))
+    assert prechecks.same_file(str(a), str(b), digests=("1", None))
+
+
+def test_near_identical_max_diff():
+    # a small change far above the noise: the mean barely moves
+    left = _image(0)
+    right = left.copy()
+    right[::7, ::5] ^= 1
+    right[100:102, 100:102] = 255 - right[100:102, 100:102]
+
+    tier, mad = prechecks.compare_pixels(DecodedImage(left), DecodedImage(right), near_identical=0.5)
+    assert tier is None and mad < 0.5
+
+    tier, _ = prechecks.compare_pixels(DecodedImage(left), DecodedImage(right), near_identical=0.5, max_diff=255)
+    assert tier == prechecks.NEAR_IDENTICAL
@@ -0,0 +1,82 @@
+import sqlite3
+
+import job_queue
+import queue_worker
+
+
+def _queue(tmp_path):
+    return job_queue.SqliteQueue(str(tmp_path / "jobs.db"), visibility_timeout=30)
+
+
+def test_unserializable_result_fails_the_job(tmp_path, monkeypatch):
+    queue = _queue(tmp_path)
+    monkeypatch.setitem(queue_worker.TASKS, "unserializable", lambda: {"value": object()})
+    job_id = queue.put("unserializable")
+
+    queue_worker.run_job(queue, queue.claim("w"), "w")
+
+    state, _, error = queue.status(job_id)
+    assert state == job_queue.FAILED
+    assert "result can not be stored" in error
+
+
+def test_queue_errors_do_not_end_the_worker(tmp_path, monkeypatch):
+    queue = _queue(tmp_path)
+    monkeypatch.setitem(queue_worker.TASKS, "answer", lambda: 42)
+    job_id = queue.put("answer")
+    job = queue.claim("w")
+
+    def locked(*args, **kwargs):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(queue, "complete", locked)
+    queue_worker.run_job(queue, job, "w")
+
+    # still leased to the worker, retried once the lease expires
+    assert queue.status(job_id)[0] == job_queue.RUNNING
+
+
+def test_failing_job_is_queued_again(tmp_path, monkeypatch):
+    queue = _queue(tmp_path)
+
+    def broken():
+        raise RuntimeError("broken")
+
+    monkeypatch.setitem(queue_worker.TASKS, "broken", broken)
+    job_id = queue.put("broken")
+
+    queue_worker.run_job(queue, queue.claim("w"), "w")
+
+    state, _, error = queue.status(job_id)
+    assert state == job_queue.QUEUED
+    assert error == "RuntimeError: broken"
+
+
+def test_job_deleted_after_the_claim_is_skipped(tmp_path, monkeypatch):
+    queue = _queue(tmp_path)
+    calls = []
+    monkeypatch.setitem(queue_worker.TASKS, "answer", lambda: calls.append(1) or 42)
+    job_id = queue.put("answer")
+    job = queue.claim("w")
+
+    queue.delete(job_id)
+    queue_worker.run_job(queue, job, "w")
+
+    assert calls == []
+    assert queue.stats()["skipped"] == 1
+
+
+def test_result_of_job_deleted_while_running_is_dropped(tmp_path, monkeypatch):
+    queue = _queue(tmp_path)
+    job_id = queue.put("answer")
+
+    def answer():
+        # the front end gives up while the worker computes
+        queue.delete(job_id)
+        return 42
+
+    monkeypatch.setitem(queue_worker.TASKS, "answer", answer)
+    queue_worker.run_job(queue, queue.claim("w"), "w")
+
+    assert queue.status(job_id) is None
+    assert queue.stats()["dropped"] == 1
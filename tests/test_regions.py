@@ -0,0 +1,106 @@
+import cv2
+import numpy as np
+import pytest
+
+import regions
+
+
+def _merge_reference(boxes, distance):
+    # one pair at a time until no two boxes are at most distance pixels apart
+    boxes = [[x, y, x + w, y + h] for x, y, w, h in boxes]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if a[0] <= b[2] + distance and b[0] <= a[2] + distance and \
+                        a[1] <= b[3] + distance and b[1] <= a[3] + distance:
+                    boxes[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return sorted([x0, y0, x1 - x0, y1 - y0] for x0, y0, x1, y1 in boxes)
+
+
+def _noise(seed, shape=(120, 160), density=0.02):
+    rng = np.random.RandomState(seed)
+    return np.where(rng.rand(*shape) < density, 255, 0).astype(np.uint8)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_find_regions_are_the_connected_components(seed):
+    thresh = _noise(seed)
+    _, _, stats, _ = cv2.connectedComponentsWithStats(thresh, connectivity=8)
+
+    assert sorted(regions.find_regions(thresh)) == _merge_reference(stats[1:, :4].tolist(), 0)
+
+
+@pytest.mark.parametrize("min_area", [1, 2, 4])
+def test_find_regions_drops_small_boxes(min_area):
+    thresh = _noise(1)
+    _, _, stats, _ = cv2.connectedComponentsWithStats(thresh, connectivity=8)
+    boxes = [box for box in stats[1:, :4].tolist() if box[2] * box[3] >= min_area]
+
+    assert sorted(regions.find_regions(thresh, min_area=min_area)) == _merge_reference(boxes, 0)
+
+
+@pytest.mark.parametrize("distance", [0, 1, 3, 8])
+def test_merge_boxes_matches_pairwise_merging(distance):
+    rng = np.random.RandomState(distance)
+    boxes = np.stack([rng.randint(0, 150, 60), rng.randint(0, 110, 60),
+                      rng.randint(1, 10, 60), rng.randint(1, 10, 60)], axis=1)
+
+    merged = regions.merge_boxes(boxes, (120, 160), distance)
+
+    assert sorted(merged.tolist()) == _merge_reference(boxes.tolist(), distance)
+
+
+def test_merge_boxes_keeps_distant_boxes():
+    boxes = [[0, 0, 5, 5], [10, 0, 5, 5]]
+
+    assert sorted(regions.merge_boxes(boxes, (20, 20), 4).tolist()) == boxes
+    assert regions.merge_boxes(boxes, (20, 20), 5).tolist() == [[0, 0, 15, 5]]
+
+
+def test_threshold_marks_the_low_ssim_pixels():
+    diff = np.full((50, 50), 250, np.uint8)
+    diff[10:20, 30:45] = 20
+
+    thresh = regions.threshold(diff)
+
+    assert thresh.dtype == np.uint8
+    assert regions.find_regions(thresh) == [[30, 10, 15, 10]]
+
+
+def _rectangles(boxes, thickness):
+    image = np.zeros((60, 60, 3), np.uint8)
+    for x, y, w, h in boxes:
+        cv2.rectangle(image, (x, y), (x + w, y + h), (0, 0, 255), thickness)
+    return image
+
+
+BOXES = [[5, 5, 20, 10], [30, 12, 8, 25], [0, 0, 3, 3]]
+
+
+def test_draw_regions_matches_cv2_rectangle():
+    image, = regions.draw_regions([np.zeros((60, 60, 3), np.uint8)], BOXES, thickness=1)
+
+    assert np.array_equal(image, _rectangles(BOXES, 1))
+
+
+@pytest.mark.parametrize("thickness", [2, 3])
+def test_draw_regions_thick_frames(thickness):
+    image, = regions.draw_regions([np.zeros((60, 60, 3), np.uint8)], BOXES, thickness=thickness)
+    drawn = image[:, :, 2] > 0
+
+    # within the frame cv2 draws - one pixel wider, with rounded corners - thickness pixels across
+    corners = np.zeros_like(drawn)
+    for x, y, w, h in BOXES:
+        for cx, cy in ((x, y), (x + w, y), (x, y + h), (x + w, y + h)):
+            corners[max(0, cy - thickness):cy + thickness + 1, max(0, cx - thickness):cx + thickness + 1] = True
+    assert not (drawn & ~corners & (_rectangles(BOXES, thickness)[:, :, 2] == 0)).any()
+    assert drawn[20, :].sum() == 2 * thickness
+    assert drawn[:, 10].sum() == 2 * thickness
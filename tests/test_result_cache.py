@@ -0,0 +1,95 @@
+import os
+
+import cv2
+import numpy as np
+
+import image_ops
+import result_cache
+
+
+def _diff(tmp_path, name="run"):
+    # a workon_images result with its artifacts in upload_dir
+    upload_dir = tmp_path / name
+    upload_dir.mkdir()
+    rng = np.random.RandomState(0)
+    golden = cv2.GaussianBlur((rng.rand(120, 160, 3) * 255).astype(np.uint8), (9, 9), 3)
+    capture = golden.copy()
+    cv2.rectangle(capture, (20, 30), (59, 69), (0, 0, 255), -1)
+    left, right = str(upload_dir / "golden.png"), str(upload_dir / "capture.png")
+    cv2.imwrite(left, golden)
+    cv2.imwrite(right, capture)
+    code, result = image_ops.workon_images(left, right, str(upload_dir), plots=False)
+    assert code == 0
+    return left, right, str(upload_dir), result
+
+
+def test_key_depends_on_order_and_parameters():
+    key = result_cache.make_key("a", "b", {"shift_method": "full"})
+
+    assert key == result_cache.make_key("a", "b", {"shift_method": "full"})
+    assert key != result_cache.make_key("b", "a", {"shift_method": "full"})
+    assert key != result_cache.make_key("a", "b", {"shift_method": "none"})
+    assert result_cache.make_key("a", "b") == result_cache.make_key("a", "b", {})
+
+
+def test_hit_copies_the_artifacts_under_the_new_names(tmp_path):
+    left, right, upload_dir, result = _diff(tmp_path)
+    cache = result_cache.ResultCache(str(tmp_path / "cache"), 1 << 30)
+    key = result_cache.make_key_for_files(left, right)
+    cache.store(key, result, upload_dir)
+
+    other_dir = tmp_path / "other"
+    other_dir.mkdir()
+    other_left, other_right = str(other_dir / "a.png"), str(other_dir / "b.png")
+    cached = cache.lookup(key, other_left, other_right, str(other_dir))
+
+    names = image_ops.artifact_names(other_left, other_right, str(other_dir))
+    assert cached["ssim_score"] == result["ssim_score"]
+    assert cached["minus"] == names["minus"]
+    for k in ("diff", "thresh", "marked_l", "marked_r"):
+        assert cached[k] == os.path.basename(names[k])
+        with open(os.path.join(upload_dir, result[k]), 'rb') as a, open(names[k], 'rb') as b:
+            assert a.read() == b.read()
+    assert cache.stats()["hits"] == 1
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    _, _, upload_dir, result = _diff(tmp_path)
+    cache = result_cache.ResultCache(str(tmp_path / "cache"), 1 << 30)
+    cache.store("first", result, upload_dir)
+    size = cache.stats()["bytes"]
+    cache.max_bytes = int(size * 2.5)
+    cache.store("second", result, upload_dir)
+    assert cache.lookup("first", "a.png", "b.png", upload_dir) is not None
+
+    cache.store("third", result, upload_dir)
+
+    assert cache.stats()["entries"] == 2 and cache.stats()["evictions"] == 1
+    assert cache.lookup("second", "a.png", "b.png", upload_dir) is None
+    assert not os.path.exists(str(tmp_path / "cache" / "second"))
+
+
+def test_index_survives_a_restart(tmp_path):
+    _, _, upload_dir, result = _diff(tmp_path)
+    cache = result_cache.ResultCache(str(tmp_path / "cache"), 1 << 30)
+    cache.store("kept", result, upload_dir)
+    # an interrupted store, without entry.json
+    os.mkdir(str(tmp_path / "cache" / "partial"))
+
+    restarted = result_cache.ResultCache(str(tmp_path / "cache"), 1 << 30)
+
+    assert restarted.stats()["entries"] == 1
+    assert restarted.stats()["bytes"] == cache.stats()["bytes"]
+    assert not os.path.exists(str(tmp_path / "cache" / "partial"))
+    assert restarted.lookup("kept", "a.png", "b.png", upload_dir)["ssim_score"] == result["ssim_score"]
+
+
+def test_unusable_entry_is_a_miss(tmp_path):
+    _, _, upload_dir, result = _diff(tmp_path)
+    cache = result_cache.ResultCache(str(tmp_path / "cache"), 1 << 30)
+    cache.store("key", result, upload_dir)
+    with open(str(tmp_path / "cache" / "key" / result_cache.ENTRY_FILE), 'w') as f:
+        f.write("{")
+
+    assert cache.lookup("key", "a.png", "b.png", upload_dir) is None
+    assert cache.stats()["entries"] == 0 and cache.stats()["misses"] == 1
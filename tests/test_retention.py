@@ -0,0 +1,55 @@
+import os
+import time
+
+from retention import Janitor
+
+
+def _session_dir(upload_dir, uid, size, age):
+    path = upload_dir / uid
+    path.mkdir()
+    (path / "left.png").write_bytes(b"\0" * size)
+    then = time.time() - age
+    os.utime(str(path), (then, then))
+
+
+def test_idle_sessions_expire(tmp_path):
+    _session_dir(tmp_path, "old", 100, 7200)
+    _session_dir(tmp_path, "new", 100, 60)
+    janitor = Janitor(str(tmp_path), ttl=3600, max_bytes=1 << 30)
+
+    result = janitor.run_once()
+
+    assert result["scanned"] == 2 and result["evicted"] == 1 and result["bytes_reclaimed"] == 100
+    assert os.listdir(str(tmp_path)) == ["new"]
+    assert janitor.stats()["sessions"] == 1 and janitor.total_bytes() == 100
+
+
+def test_quota_evicts_the_least_recently_used(tmp_path):
+    for uid, age in (("a", 300), ("b", 200), ("c", 100), ("d", 0)):
+        _session_dir(tmp_path, uid, 1000, age)
+    janitor = Janitor(str(tmp_path), ttl=3600, max_bytes=4000)
+    assert janitor.run_once()["evicted"] == 0
+    janitor.max_bytes = 2500
+    # a is in use again
+    janitor.touch("a")
+    janitor.record_upload("d", 500)
+    (tmp_path / "d" / "right.png").write_bytes(b"\0" * 500)
+
+    janitor.run_once()
+
+    # 4500 bytes: b and c were idle the longest
+    assert sorted(os.listdir(str(tmp_path))) == ["a", "d"]
+    assert janitor.total_bytes() == 2500
+    assert janitor.evicted == 2 and janitor.bytes_reclaimed == 2000
+
+
+def test_unchanged_dirs_are_not_rescanned(tmp_path):
+    _session_dir(tmp_path, "a", 10, 0)
+    _session_dir(tmp_path, "b", 10, 0)
+    janitor = Janitor(str(tmp_path), ttl=3600, max_bytes=1 << 30)
+
+    assert janitor.run_once()["scanned"] == 2
+    assert janitor.run_once()["scanned"] == 0
+    (tmp_path / "b" / "right.png").write_bytes(b"\0" * 10)
+    assert janitor.run_once()["scanned"] == 1
+    assert janitor.total_bytes() == 30
@@ -0,0 +1,149 @@
+import asyncio
+import os
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+import sessions
+from retention import Janitor
+
+COOKIE = "IMAGE_DIFF_SESSION"
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def _request(key=None):
+    headers = {"Cookie": "{}={}".format(COOKIE, key)} if key else {}
+    return make_mocked_request("GET", "/", headers=headers)
+
+
+def _save(store, uid, key=None):
+    # a request of the session key (a new one if None) storing uid, like the upload view
+    session = run(store.load_session(_request(key)))
+    session["uid"] = uid
+    response = web.Response()
+    run(store.save_session(_request(key), response, session))
+    cookie = response.cookies.get(COOKIE)
+    return cookie.value if cookie is not None else None
+
+
+def _age(store, key, seconds):
+    store._sessions[key][0] -= seconds
+
+
+def test_cookie_is_only_set_for_a_new_session():
+    store = sessions.SessionStore(ttl=60)
+
+    key = _save(store, "uid-1")
+
+    assert key
+    assert _save(store, "uid-2", key) is None
+    session = run(store.load_session(_request(key)))
+    assert not session.new and session["uid"] == "uid-2"
+    assert store.stats()["created"] == 1
+
+
+def test_loaded_session_is_a_copy():
+    store = sessions.SessionStore(ttl=60)
+    key = _save(store, "uid-1")
+
+    session = run(store.load_session(_request(key)))
+    session["uid"] = "changed"
+
+    assert run(store.load_session(_request(key)))["uid"] == "uid-1"
+
+
+def test_idle_sessions_expire():
+    store = sessions.SessionStore(ttl=60)
+    old = _save(store, "uid-old")
+    recent = _save(store, "uid-recent")
+    _age(store, old, 61)
+
+    assert store.expire() == ["uid-old"]
+    assert store.owner("uid-old") is None
+    assert store.owner("uid-recent") == recent
+    assert run(store.load_session(_request(old))).new
+    assert store.stats()["sessions"] == 1 and store.stats()["expired"] == 1
+
+
+def test_an_expired_session_is_not_loaded():
+    store = sessions.SessionStore(ttl=60)
+    key = _save(store, "uid-1")
+    _age(store, key, 61)
+
+    assert run(store.load_session(_request(key))).new
+    assert store.owner("uid-1") is None
+
+
+def test_owner_index_follows_the_session():
+    store = sessions.SessionStore(ttl=60)
+    key = _save(store, "uid-1")
+    assert store.owner("uid-1") == key
+
+    _save(store, "uid-2", key)
+    assert store.owner("uid-1") is None
+    assert store.owner("uid-2") == key
+
+    store.forget_uploads("uid-2")
+    assert store.owner("uid-2") is None
+    assert run(store.load_session(_request(key))).new
+
+
+def test_sessions_survive_a_restart(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    store = sessions.SessionStore(ttl=60, path=path)
+    kept = _save(store, "uid-kept")
+    gone = _save(store, "uid-gone")
+    store.flush()
+    store.forget_uploads("uid-gone")
+    store.flush()
+
+    restarted = sessions.SessionStore(ttl=60, path=path)
+
+    assert restarted.owner("uid-kept") == kept
+    assert restarted.owner("uid-gone") is None
+    assert run(restarted.load_session(_request(kept)))["uid"] == "uid-kept"
+    assert run(restarted.load_session(_request(gone))).new
+    assert store.stats()["dirty"] == 0 and store.stats()["flushes"] == 2
+
+
+def test_janitor_evicts_the_uploads_of_expired_sessions(tmp_path):
+    store = sessions.SessionStore(ttl=60)
+    janitor = Janitor(str(tmp_path), ttl=3600, max_bytes=1 << 30, sessions=store)
+    for uid in ("uid-old", "uid-recent"):
+        os.mkdir(str(tmp_path / uid))
+        (tmp_path / uid / "image.png").write_bytes(b"x" * 100)
+    old = _save(store, "uid-old")
+    _save(store, "uid-recent")
+    _age(store, old, 61)
+
+    result = janitor.run_once()
+
+    assert result["evicted"] == 1 and result["bytes_reclaimed"] == 100
+    assert sorted(os.listdir(str(tmp_path))) == ["uid-recent"]
+
+
+def test_evicted_uploads_end_their_session(tmp_path):
+    store = sessions.SessionStore(ttl=3600)
+    janitor = Janitor(str(tmp_path), ttl=3600, max_bytes=150, sessions=store)
+    key = _save(store, "uid-1")
+    _save(store, "uid-2")
+    now = time.time()
+    for uid, idle in (("uid-1", 20), ("uid-2", 10)):
+        os.mkdir(str(tmp_path / uid))
+        (tmp_path / uid / "image.png").write_bytes(b"x" * 100)
+        os.utime(str(tmp_path / uid), (now - idle, now - idle))
+
+    janitor.run_once()
+
+    # over the quota, the oldest uploads go and their session with them
+    assert os.listdir(str(tmp_path)) == ["uid-2"]
+    assert store.owner("uid-1") is None
+    assert run(store.load_session(_request(key))).new
@@ -0,0 +1,76 @@
+import concurrent.futures
+import os
+import subprocess
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+import shared_images
+
+
+def _checksum(handle):
+    # in a worker process
+    image = shared_images.attach(handle)
+    return int(image.sum(dtype=np.int64)), image.flags.writeable
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = shared_images.SegmentStore(str(tmp_path))
+    store.open()
+    yield store
+    store.close()
+
+
+def _image_file(tmp_path):
+    image = np.random.RandomState(0).randint(0, 256, (120, 200, 3)).astype(np.uint8)
+    path = str(tmp_path / "left.png")
+    cv2.imwrite(path, image)
+    return path, image
+
+
+def test_decode_attach_release(tmp_path, store):
+    path, image = _image_file(tmp_path)
+
+    handle = store.decode(path)
+
+    assert handle["shape"] == image.shape and handle["dtype"] == "uint8"
+    assert os.path.dirname(handle["path"]) == store.dir
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+        assert executor.submit(_checksum, handle).result() == (int(image.sum(dtype=np.int64)), False)
+    assert np.array_equal(shared_images.attach(handle), image)
+    assert store.stats()["segments"] == 1 and store.stats()["bytes"] == image.nbytes
+
+    store.release(handle)
+    store.release(handle)
+
+    assert not os.path.exists(handle["path"])
+    stats = store.stats()
+    assert stats["segments"] == 0 and stats["bytes"] == 0
+    assert stats["created"] == 1 and stats["released"] == 1 and stats["peak_bytes"] == image.nbytes
+
+
+def test_decode_of_a_file_opencv_can_not_load(tmp_path, store):
+    path = str(tmp_path / "notes.png")
+    with open(path, 'w') as f:
+        f.write("not an image")
+
+    assert store.decode(path) is None
+    assert os.listdir(store.dir) == []
+
+
+def test_open_removes_the_segments_of_dead_servers(tmp_path):
+    # a pid that is gone: a child that has been waited for
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    for name in ("image_diff-{}".format(dead.pid), "image_diff-{}".format(os.getppid()), "image_diff-x", "other"):
+        os.makedirs(str(tmp_path / name))
+        (tmp_path / name / "segment.npy").write_bytes(b"\0")
+
+    store = shared_images.SegmentStore(str(tmp_path))
+    store.open()
+    store.close()
+
+    assert sorted(os.listdir(str(tmp_path))) == ["image_diff-{}".format(os.getppid()), "image_diff-x", "other"]
@@ -0,0 +1,106 @@
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+import image_ops
+import telemetry
+
+
+def test_exposition_format():
+    registry = telemetry.Registry()
+    requests = registry.counter("requests_total", "Requests", ("route", "status"))
+    requests.inc("/diff", 200)
+    requests.inc("/diff", 200, amount=2)
+    requests.inc('/a"b', 500)
+    seconds = registry.histogram("stage_seconds", "Stage seconds", ("stage",), buckets=(0.1, 1.0))
+    seconds.observe(0.05, "ssim")
+    seconds.observe(0.5, "ssim")
+    seconds.observe(5.0, "ssim")
+    latency = registry.summary("latency_seconds", "Latency")
+    for value in range(1, 11):
+        latency.observe(value / 10)
+
+    text = registry.exposition([("queue_depth", "gauge", "Waiting jobs", [({}, 3)]),
+                                ("busy", "gauge", "Busy", [({"worker": 0}, 0.5)])])
+
+    assert text == "\n".join([
+        "# HELP requests_total Requests",
+        "# TYPE requests_total counter",
+        'requests_total{route="/diff",status="200"} 3.0',
+        'requests_total{route="/a\\"b",status="500"} 1.0',
+        "# HELP stage_seconds Stage seconds",
+        "# TYPE stage_seconds histogram",
+        'stage_seconds_bucket{stage="ssim",le="0.1"} 1',
+        'stage_seconds_bucket{stage="ssim",le="1.0"} 2',
+        'stage_seconds_bucket{stage="ssim",le="+Inf"} 3',
+        'stage_seconds_sum{stage="ssim"} 5.55',
+        'stage_seconds_count{stage="ssim"} 3',
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds summary",
+        'latency_seconds{quantile="0.5"} 0.6',
+        'latency_seconds{quantile="0.9"} 1.0',
+        'latency_seconds{quantile="0.99"} 1.0',
+        "latency_seconds_sum 5.5",
+        "latency_seconds_count 10",
+        "# HELP queue_depth Waiting jobs",
+        "# TYPE queue_depth gauge",
+        "queue_depth 3.0",
+        "# HELP busy Busy",
+        "# TYPE busy gauge",
+        'busy{worker="0"} 0.5',
+    ]) + "\n"
+
+
+def test_families_are_created_once():
+    registry = telemetry.Registry()
+    counter = registry.counter("jobs_total", "Jobs", ("state",))
+
+    assert registry.counter("jobs_total", "Jobs", ("state",)) is counter
+    with pytest.raises(ValueError):
+        registry.histogram("jobs_total", "Jobs")
+    with pytest.raises(ValueError):
+        counter.inc()
+
+
+def test_summary_keeps_a_window():
+    summary = telemetry.Summary("seconds", "Seconds", window=4)
+    for value in (100, 1, 2, 3, 4):
+        summary.observe(value)
+
+    lines = list(summary.exposition())
+
+    # the quantiles of the last 4, the sum and count of all
+    assert 'seconds{quantile="0.99"} 4.0' in lines
+    assert lines[-2:] == ["seconds_sum 110.0", "seconds_count 5"]
+
+
+def test_stages_add_up():
+    stages = telemetry.Stages()
+    with stages("decode"):
+        time.sleep(0.01)
+    with pytest.raises(RuntimeError):
+        with stages("ssim"):
+            raise RuntimeError()
+    with stages("decode"):
+        time.sleep(0.01)
+
+    assert list(stages.seconds) == ["decode", "ssim"]
+    assert stages.seconds["decode"] >= 0.02
+
+
+def test_workon_images_returns_its_stage_timings(tmp_path):
+    rng = np.random.RandomState(0)
+    golden = cv2.GaussianBlur((rng.rand(240, 320, 3) * 255).astype(np.uint8), (9, 9), 3)
+    capture = golden.copy()
+    cv2.rectangle(capture, (40, 50), (99, 89), (0, 0, 255), -1)
+    cv2.imwrite(str(tmp_path / "left.png"), golden)
+    cv2.imwrite(str(tmp_path / "right.png"), capture)
+
+    code, result = image_ops.workon_images(str(tmp_path / "left.png"), str(tmp_path / "right.png"), str(tmp_path),
+                                           plots=False)
+
+    assert code == 0
+    assert {"decode", "gray", "shift", "ssim", "regions", "draw", "artifacts"} <= set(result["timings"])
+    assert all(seconds >= 0 for seconds in result["timings"].values())
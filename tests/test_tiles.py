@@ -0,0 +1,74 @@
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+import tiles
+
+
+def _image_file(tmp_path, width, height, name="image.png", seed=0):
+    image = np.random.RandomState(seed).randint(0, 256, (height, width, 3), dtype=np.uint8)
+    path = str(tmp_path / name)
+    cv2.imwrite(path, image)
+    return path, image
+
+
+@pytest.mark.parametrize("width, height, zoom", [(100, 80, 0), (256, 256, 0), (257, 10, 1), (1000, 600, 2),
+                                                 (1500, 1025, 3)])
+def test_pyramid_has_a_level_per_zoom(width, height, zoom):
+    levels = tiles.pyramid(np.zeros((height, width, 3), np.uint8))
+
+    assert tiles.max_zoom(width, height) == zoom
+    assert len(levels) == zoom + 1
+    assert max(levels[-1].shape[:2]) <= tiles.TILE_SIZE
+
+
+def test_full_resolution_tiles_make_up_the_image(tmp_path):
+    path, image = _image_file(tmp_path, 600, 300)
+    zoom = tiles.max_zoom(600, 300)
+    # rows of tiles counted up from the bottom edge of the image
+    rows = 2
+    canvas = np.zeros((rows * tiles.TILE_SIZE, 3 * tiles.TILE_SIZE, 4), np.uint8)
+    for x in range(3):
+        for y in range(rows):
+            tile = cv2.imread(tiles.render_tile(path, zoom, x, y), cv2.IMREAD_UNCHANGED)
+            r0 = (rows - 1 - y) * tiles.TILE_SIZE
+            canvas[r0:r0 + tiles.TILE_SIZE, x * tiles.TILE_SIZE:(x + 1) * tiles.TILE_SIZE] = tile
+
+    # the image sits in the bottom left corner, the overhang is transparent
+    top = canvas.shape[0] - 300
+    assert np.array_equal(canvas[top:, :600, :3], image)
+    assert (canvas[top:, :600, 3] == 255).all()
+    assert not canvas[:top].any() and not canvas[:, 600:].any()
+
+
+def test_tiles_outside_the_pyramid(tmp_path):
+    path, _ = _image_file(tmp_path, 600, 300)
+
+    for z, x, y in ((3, 0, 0), (-1, 0, 0), (2, 3, 0), (2, 0, 2), (0, 1, 0), (2, -1, 0)):
+        with pytest.raises(ValueError):
+            tiles.render_tile(path, z, x, y)
+
+
+def test_prerender_renders_the_first_levels(tmp_path):
+    path, _ = _image_file(tmp_path, 1500, 1025)
+
+    info = tiles.prerender(path, levels=2)
+
+    # zoom 0 is 188 x 129 pixels: 1 tile, zoom 1 375 x 257: 2 x 2, zoom 2 750 x 513: 3 x 3
+    assert info == {"width": 1500, "height": 1025, "max_zoom": 3, "tiles": 1 + 4 + 9}
+    assert not os.path.exists(os.path.dirname(tiles.tile_path(path, 3, 0, 0)))
+    assert tiles.prerender(path, levels=2)["tiles"] == 0
+
+
+def test_tiles_of_a_replaced_image_are_removed(tmp_path):
+    path, _ = _image_file(tmp_path, 300, 300)
+    old = tiles.render_tile(path, 0, 0, 0)
+    _image_file(tmp_path, 300, 300, seed=1)
+    os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 10 ** 9))
+
+    new = tiles.render_tile(path, 0, 0, 0)
+
+    assert new != old
+    assert os.path.isfile(new) and not os.path.exists(os.path.dirname(os.path.dirname(old)))
@@ -0,0 +1,88 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+import uploads
+
+
+class Part:
+    # the read_chunk of an aiohttp multipart body part
+    def __init__(self, data, chunk_size=1000):
+        self.data = data
+        self.chunk_size = chunk_size
+
+    async def read_chunk(self, size):
+        chunk, self.data = self.data[:min(size, self.chunk_size)], self.data[min(size, self.chunk_size):]
+        return chunk
+
+
+def save(part, path, max_size=1 << 30):
+    loop = asyncio.new_event_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    try:
+        return loop.run_until_complete(uploads.save_part(part, path, loop, executor, max_size))
+    finally:
+        executor.shutdown()
+        loop.close()
+
+
+def _image(rows=120, cols=200, channels=3):
+    rng = np.random.RandomState(0)
+    return rng.randint(0, 256, (rows, cols, channels) if channels > 1 else (rows, cols)).astype(np.uint8)
+
+
+@pytest.mark.parametrize("ext, channels", [(".png", 3), (".png", 1), (".png", 4), (".jpg", 3), (".jpg", 1),
+                                           (".bmp", 3), (".tiff", 3)])
+def test_save_part_hashes_and_sniffs_the_image(tmp_path, monkeypatch, ext, channels):
+    # several writes, each overlapped with reading
+    monkeypatch.setattr(uploads, "WRITE_CHUNK_SIZE", 4096)
+    data = cv2.imencode(ext, _image(channels=channels))[1].tobytes()
+    path = str(tmp_path / ("image" + ext))
+
+    info = save(Part(data), path)
+
+    assert info["size"] == len(data)
+    assert info["sha256"] == hashlib.sha256(data).hexdigest()
+    assert (info["width"], info["height"], info["channels"]) == (200, 120, channels)
+    assert info["format"] == {".jpg": "jpeg", ".tiff": "tiff"}.get(ext, ext[1:])
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    assert os.listdir(str(tmp_path)) == ["image" + ext]
+
+
+def test_save_part_too_large(tmp_path):
+    data = cv2.imencode(".png", _image())[1].tobytes()
+    path = str(tmp_path / "image.png")
+
+    with pytest.raises(uploads.UploadTooLarge):
+        save(Part(data), path, max_size=len(data) - 1)
+
+    # no partial image left behind
+    assert os.listdir(str(tmp_path)) == []
+    assert save(Part(data), path, max_size=len(data))["size"] == len(data)
+
+
+@pytest.mark.parametrize("data", [b"GIF89a" + b"\0" * 100, b"not an image at all", b"\x89PNG\r\n\x1a\n\0\0",
+                                  b"\xff\xd8\xff\xe0\0\x10JFIF", b"", b"II*\x00\xff\xff\xff\xff"])
+def test_save_part_of_an_unknown_format(tmp_path, data):
+    path = str(tmp_path / "video.avi")
+
+    info = save(Part(data, chunk_size=3), path)
+
+    # saved, without the image fields
+    assert info == {"size": len(data), "sha256": hashlib.sha256(data).hexdigest(), "format": None, "width": None,
+                    "height": None, "channels": None}
+    assert os.path.getsize(path) == len(data)
+
+
+def test_file_header(tmp_path):
+    path = str(tmp_path / "image.jpg")
+    cv2.imwrite(path, _image(300, 50))
+
+    assert uploads.file_header(path) == {"format": "jpeg", "width": 50, "height": 300, "channels": 3}
+    assert uploads.file_header(str(tmp_path / "missing.jpg")) is None
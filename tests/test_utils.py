@@ -0,0 +1,147 @@
+import cv2
+import numpy as np
+import pytest
+
+import utils
+
+
+def _scene(rows=1400, cols=1800):
+    rng = np.random.RandomState(0)
+    return cv2.GaussianBlur((rng.rand(rows, cols, 3) * 255).astype(np.uint8), (9, 9), 3)
+
+
+@pytest.mark.parametrize("shift_row, shift_col", [(0, 0), (7, -12), (-25, 40), (3, 3), (-1, 0)])
+def test_pyramid_finds_the_shift_of_the_full_correlation(shift_row, shift_col):
+    scene = _scene()
+    golden = scene[100:1300, 100:1700]
+    # the capture content moved down/right by shift_row/shift_col
+    capture = scene[100 - shift_row:1300 - shift_row, 100 - shift_col:1700 - shift_col]
+    expected = (max(shift_row, 0), max(-shift_row, 0), max(shift_col, 0), max(-shift_col, 0))
+
+    assert utils.detect_shift_using_pyramid(golden, capture) == (shift_row, shift_col)
+    assert utils.detect_shift_using_correlation(golden, capture, method="pyramid") == expected
+    assert utils.detect_shift_using_correlation(golden, capture) == expected
+
+
+@pytest.mark.parametrize("levels", [0, 1, 3])
+def test_pyramid_levels(levels):
+    scene = _scene(700, 900)
+    golden = scene[50:650, 50:850]
+    capture = scene[45:645, 59:859]
+
+    assert utils.detect_shift_using_pyramid(golden, capture, levels=levels) == (5, -9)
+
+
+def test_unknown_shift_method():
+    with pytest.raises(ValueError):
+        utils.detect_shift_using_correlation(_scene(64, 64), _scene(64, 64), method="fast")
+
+
+def _detect_shift_loop(image, black=(20, 20, 20)):
+    # the row by row scan detect_shift replaced
+    def compare(srow, erow, scol, ecol):
+        return any(np.max(image[srow:erow, scol:ecol, c]) > black[c] for c in range(3))
+
+    max_row, max_col = image.shape[:2]
+    left_col = 0
+    for scol in range(300):
+        if compare(0, -1, scol, scol + 1):
+            break
+        left_col += 1
+    right_col = 0
+    for ecol in range(max_col, max_col - 300, -1):
+        if compare(0, -1, ecol - 1, ecol):
+            break
+        right_col += 1
+    top_row = 0
+    for srow in range(300):
+        if compare(srow, srow + 1, 0, -1):
+            break
+        top_row += 1
+    bottom_row = 0
+    for erow in range(max_row, max_row - 300, -1):
+        if compare(erow - 1, erow, 0, -1):
+            break
+        bottom_row += 1
+    return top_row, bottom_row, left_col, right_col
+
+
+def _with_bars(top, bottom, left, right, seed=0, shape=(480, 640, 3)):
+    # bars a bit below the black level, a sparse content so some rows/cols only pass on one channel
+    rng = np.random.RandomState(seed)
+    image = rng.randint(0, 21, shape).astype(np.uint8)
+    image[rng.rand(*shape) < 0.02] = 200
+    image[:top] = 10
+    image[image.shape[0] - bottom:] = 20
+    image[:, :left] = 0
+    image[:, image.shape[1] - right:] = 5
+    return image
+
+
+@pytest.mark.parametrize("bars", [(0, 0, 0, 0), (5, 0, 3, 17), (0, 12, 0, 1), (40, 40, 299, 0), (1, 1, 1, 1)])
+def test_detect_shift_finds_the_bars(bars):
+    image = _with_bars(*bars)
+
+    assert utils.detect_shift(image) == bars
+    assert utils.detect_shift(image) == _detect_shift_loop(image)
+    assert utils.has_black_bars(image) == any(bars)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_detect_shift_matches_the_loop(seed):
+    rng = np.random.RandomState(seed)
+    image = _with_bars(*rng.randint(0, 60, 4), seed=seed)
+    image[:, :, rng.randint(3)] //= 2
+    black = tuple(int(b) for b in rng.randint(10, 30, 3))
+
+    assert utils.detect_shift(image, black=black) == _detect_shift_loop(image, black=black)
+
+
+def test_detect_shift_depth():
+    image = _with_bars(0, 0, 350, 0)
+
+    assert utils.detect_shift(image) == _detect_shift_loop(image) == (0, 0, 300, 0)
+    assert utils.detect_shift(image, depth=400) == (0, 0, 350, 0)
+
+
+def _ssim_pair():
+    rng = np.random.RandomState(0)
+    golden = _scene(700, 900)
+    capture = golden.copy()
+    cv2.rectangle(capture, (100, 100), (200, 160), (0, 0, 255), -1)
+    return golden, cv2.add(capture, rng.randint(0, 8, capture.shape, dtype=np.uint8))
+
+
+@pytest.mark.parametrize("tile_size", [256, 333, 4096])
+def test_tiled_ssim_matches_one_pass(tile_size):
+    golden, capture = _ssim_pair()
+
+    score, diff = utils.compute_SSIM(golden, capture)
+    tiled_score, tiled_diff = utils.compute_SSIM(golden, capture, tile_size=tile_size)
+
+    assert tiled_diff.dtype == np.float32 and tiled_diff.shape == diff.shape
+    assert abs(tiled_score - score) < 1e-5
+    assert np.abs(tiled_diff - diff).max() < 1e-3
+
+
+def test_ssim_regions_of_interest():
+    golden, capture = _ssim_pair()
+    _, diff = utils.compute_SSIM(golden, capture)
+
+    score, roi_diff = utils.compute_SSIM(golden, capture, rois=[(50, 60, 300, 200), (850, 650, 100, 100)])
+
+    inside = np.zeros(diff.shape, dtype=bool)
+    inside[60:260, 50:350] = True
+    inside[650:, 850:] = True
+    assert (roi_diff[~inside] == 1).all()
+    assert np.abs(roi_diff[inside] - diff[inside]).max() < 1e-3
+    # the score leaves out the half window border of the image, like compare_ssim
+    inside[-3:] = inside[:, -3:] = False
+    assert abs(score - diff[inside].mean()) < 1e-5
+
+
+def test_ssim_regions_outside_the_image():
+    golden, capture = _ssim_pair()
+
+    with pytest.raises(ValueError):
+        utils.compute_SSIM(golden, capture, rois=[(900, 0, 50, 50)])
@@ -0,0 +1,79 @@
+import concurrent.futures
+
+import cv2
+import numpy as np
+import pytest
+
+import video
+
+
+def _frame(shade):
+    frame = np.zeros((120, 160, 3), np.uint8)
+    frame[:] = (40, 80, 120)
+    cv2.rectangle(frame, (20, 20), (60, 60), (shade, shade, shade), -1)
+    return frame
+
+
+def _write(path, frames):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 10, (160, 120))
+    if not writer.isOpened():
+        pytest.skip("no MJPG writer in this opencv build")
+    for frame in frames:
+        writer.write(frame)
+    writer.release()
+    return path
+
+
+def _compare(golden, capture, tmp_path):
+    comparison = video.VideoComparison(golden, capture, str(tmp_path / "golden"))
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        return comparison, video.run(comparison, executor, 4)
+
+
+@pytest.mark.parametrize("golden_length, capture_length", [(10, 7), (7, 10), (8, 8)])
+def test_length_mismatch(tmp_path, golden_length, capture_length):
+    golden = _write(str(tmp_path / "golden.avi"), [_frame(200)] * golden_length)
+    capture = _write(str(tmp_path / "capture.avi"), [_frame(200)] * capture_length)
+
+    comparison, summary = _compare(golden, capture, tmp_path)
+
+    assert summary["frames"] == min(golden_length, capture_length)
+    assert summary["golden_frames"] == golden_length
+    assert summary["capture_frames"] == capture_length
+    assert summary["length_mismatch"] == (golden_length != capture_length)
+    assert summary["ranges"] == []
+
+
+def test_ranges_and_skipped_frames(tmp_path):
+    frames = [_frame(200)] * 4 + [_frame(20)] * 3 + [_frame(200)] * 3
+    golden = _write(str(tmp_path / "golden.avi"), [_frame(200)] * 10)
+    capture = _write(str(tmp_path / "capture.avi"), frames)
+
+    comparison, summary = _compare(golden, capture, tmp_path)
+
+    assert [(r["start"], r["end"]) for r in summary["ranges"]] == [(4, 6)]
+    # repeated frames are not compared again
+    assert summary["compared"] < summary["frames"]
+    assert summary["compared"] + summary["skipped"] == summary["frames"]
+
+
+def test_videos_are_released(tmp_path):
+    golden = _write(str(tmp_path / "golden.avi"), [_frame(200)] * 5)
+    capture = _write(str(tmp_path / "capture.avi"), [_frame(200)] * 5)
+
+    comparison, _ = _compare(golden, capture, tmp_path)
+
+    assert not comparison._golden.isOpened()
+    assert not comparison._capture.isOpened()
+
+
+def test_golden_image_has_no_length(tmp_path):
+    golden = str(tmp_path / "golden.png")
+    cv2.imwrite(golden, _frame(200))
+    capture = _write(str(tmp_path / "capture.avi"), [_frame(200)] * 5)
+
+    _, summary = _compare(golden, capture, tmp_path)
+
+    assert summary["golden_frames"] is None
+    assert summary["capture_frames"] == 5
+    assert summary["length_mismatch"] is False
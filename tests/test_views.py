@@ -0,0 +1,311 @@
+import asyncio
+import concurrent.futures
+import concurrent.futures.process
+import json
+import os
+import time
+
+import aiohttp
+import aiohttp_session
+import cv2
+import numpy as np
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import golden_library
+import image_ops
+import jobs
+import tiles
+import views
+from retention import Janitor
+from sessions import SessionStore
+from telemetry import Registry
+from worker_pool import AffinityPool
+
+
+def serve(app, test):
+    # test(client) against app, on a loop of its own
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    async def go():
+        client = TestClient(TestServer(app))
+        await client.start_server()
+        try:
+            return await test(client)
+        finally:
+            await client.close()
+
+    try:
+        return loop.run_until_complete(go())
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+
+@pytest.fixture
+def pool():
+    pool = AffinityPool(1, 0)
+    yield pool
+    pool.shutdown()
+
+
+@pytest.fixture
+def app(tmp_path, pool):
+    upload_dir = str(tmp_path / "uploads")
+    os.makedirs(upload_dir)
+    app = web.Application()
+    app["telemetry"] = Registry()
+    app["upload_dir"] = upload_dir
+    app["janitor"] = Janitor(upload_dir, 3600, 1 << 30)
+    app["upload_executor"] = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    app["max_upload_size"] = 20 * 1024 * 1024
+    app["worker_pool"] = pool
+    app["diff_params"] = {}
+    app.router.add_post('/batch', views.batch_diff)
+    yield app
+    app["upload_executor"].shutdown()
+
+
+def _png(image):
+    return cv2.imencode(".png", image)[1].tobytes()
+
+
+def _golden(width=320, height=240):
+    rng = np.random.RandomState(0)
+    return cv2.GaussianBlur((rng.rand(height, width, 3) * 255).astype(np.uint8), (9, 9), 3)
+
+
+def _capture(golden, x, y):
+    capture = golden.copy()
+    cv2.rectangle(capture, (x, y), (x + 29, y + 19), (0, 0, 255), -1)
+    return capture
+
+
+def _form(parts):
+    form = aiohttp.FormData()
+    for name, filename, data in parts:
+        form.add_field(name, data, filename=filename, content_type="image/png")
+    return form
+
+
+def _histogram_job(app, result):
+    async def start(app):
+        app["job_manager"].start()
+
+    async def stop(app):
+        await app["job_manager"].stop()
+
+    async def run():
+        return result
+
+    app["job_manager"] = jobs.JobManager(workers=1, max_queue=1, timeout=10)
+    app.on_startup.append(start)
+    app.on_cleanup.append(stop)
+    app.router.add_get('/jobs/{job_id}/histograms', views.job_histograms)
+    return run
+
+
+def test_job_histograms_as_json_and_binary(app):
+    golden = _golden()
+    gray = cv2.cvtColor(golden, cv2.COLOR_BGR2GRAY)
+    histograms = image_ops.histogram_counts(image_ops.histogram_data(golden), image_ops.histogram_data(gray))
+    run = _histogram_job(app, (0, {"histograms": histograms}))
+
+    async def test(client):
+        job = app["job_manager"].submit(run)
+        await job.done.wait()
+        url = "/jobs/{}/histograms".format(job.id)
+        as_json = await (await client.get(url)).json()
+        binary = await client.get(url, params={"format": "binary"})
+        return as_json, binary.headers, await binary.read()
+
+    as_json, headers, body = serve(app, test)
+
+    assert as_json == histograms
+    assert headers["Content-Type"] == "application/octet-stream"
+    # no channels for a gray image
+    series = headers["X-Histogram-Series"].split(",")
+    assert series == ["left.h", "left.b", "left.g", "left.r", "right.h"]
+    counts = np.frombuffer(body, dtype='<u4').reshape(len(series), 256)
+    for (side, name), row in zip((s.split(".") for s in series), counts):
+        assert row.tolist() == histograms[side][name]
+    assert counts[0].sum() == golden.size
+
+
+def test_job_histograms_of_a_job_without_them(app):
+    run = _histogram_job(app, (1, {"error": "bad images"}))
+
+    async def test(client):
+        job = app["job_manager"].submit(run)
+        await job.done.wait()
+        failed = await client.get("/jobs/{}/histograms".format(job.id))
+        unknown = await client.get("/jobs/nope/histograms")
+        return failed.status, unknown.status
+
+    assert serve(app, test) == (409, 404)
+
+
+def test_batch_streams_a_line_per_capture(app):
+    golden = _golden()
+    parts = [("golden", "golden.png", _png(golden)),
+             ("capture", "a.png", _png(_capture(golden, 20, 30))),
+             ("capture", "b.png", _png(_capture(golden, 150, 100))),
+             ("capture", "same.png", _png(golden))]
+
+    async def test(client):
+        response = await client.post("/batch", data=_form(parts))
+        assert response.status == 200
+        assert response.headers["Content-Type"] == "application/x-ndjson"
+        lines = [json.loads(line) for line in (await response.text()).splitlines()]
+        # removed once the handler returns, after the last line was sent
+        for _ in range(100):
+            if not os.listdir(app["upload_dir"]):
+                break
+            await asyncio.sleep(0.01)
+        return lines
+
+    lines = {line["capture"]: line for line in serve(app, test)}
+
+    assert sorted(lines) == ["a.png", "b.png", "same.png"]
+    assert all(line["code"] == 0 for line in lines.values())
+    assert lines["same.png"]["regions"] == []
+    x, y, w, h = lines["a.png"]["regions"][0]
+    assert x <= 20 and y <= 30 and x + w >= 50 and y + h >= 50
+    assert lines["a.png"]["ssim_score"] < 1
+    assert os.listdir(app["upload_dir"]) == []
+
+
+@pytest.mark.parametrize("bad_part", [("capture", "", b"x"), ("golden", "second.png", None), ("other", "c.png", None)])
+def test_failed_batch_leaves_no_work_behind(app, pool, bad_part):
+    golden = _golden(1600, 1200)
+    name, filename, data = bad_part
+    parts = [("golden", "golden.png", _png(golden))]
+    parts += [("capture", "{}.png".format(i), _png(_capture(golden, 100 * i, 100))) for i in range(4)]
+    parts.append((name, filename, data if data is not None else _png(golden)))
+
+    async def test(client):
+        response = await client.post("/batch", data=_form(parts))
+        return response.status, pool.utilisation()
+
+    status, workers = serve(app, test)
+
+    assert status == 400
+    # the captures were dropped or finished before the response, their files are gone
+    assert [worker["in_flight"] for worker in workers] == [0]
+    assert os.listdir(app["upload_dir"]) == []
+
+
+def _session(app, data):
+    # a session of the client, stored on the server like after its uploads
+    store = SessionStore(ttl=3600)
+    aiohttp_session.setup(app, store)
+    store._put("key", {"created": 0, "session": data}, time.time())
+    return {store.cookie_name: "key"}
+
+
+def test_cancelled_jobs_free_the_queue(app):
+    async def start(app):
+        app["job_manager"].start()
+
+    # no worker task takes the jobs, they stay queued
+    app["job_manager"] = jobs.JobManager(workers=0, max_queue=1, timeout=10)
+    app.on_startup.append(start)
+    app.router.add_post('/jobs', views.submit_job)
+    app.router.add_delete('/jobs/{job_id}', views.cancel_job)
+    cookies = _session(app, {"uid": "uid-1", "session_data": {"left_image": "left.png", "right_image": "right.png"}})
+
+    async def test(client):
+        first = await client.post("/jobs", cookies=cookies)
+        assert first.status == 202
+        full = await client.post("/jobs", cookies=cookies)
+        assert full.status == 429 and full.headers["Retry-After"] == "5"
+
+        cancelled = await client.delete("/jobs/{}".format((await first.json())["job_id"]))
+        assert (await cancelled.json())["state"] == jobs.CANCELLED
+        return (await client.post("/jobs", cookies=cookies)).status
+
+    assert serve(app, test) == 202
+
+
+def test_a_new_client_can_use_a_golden_image(app, tmp_path):
+    library = app["golden_library"] = golden_library.GoldenLibrary(str(tmp_path / "library"))
+    path = str(tmp_path / "golden.png")
+    cv2.imwrite(path, _golden())
+    gray = cv2.cvtColor(_golden(), cv2.COLOR_BGR2GRAY)
+    record = library.add(path, "golden.png", {"sha256": "sha", "size": 1000}, golden_library.image_hashes(gray))
+    app.router.add_post('/goldens/{golden_id}/use', views.use_golden)
+    _session(app, {})
+
+    async def test(client):
+        # no session cookie yet
+        response = await client.post("/goldens/{}/use".format(record["id"]), allow_redirects=False)
+        return response.status
+
+    assert serve(app, test) == 302
+    uid, = os.listdir(app["upload_dir"])
+    assert "golden.png" in os.listdir(os.path.join(app["upload_dir"], uid))
+
+
+class FailingPreviews:
+    # a worker pool whose tiles.prerender fails like a crashed worker
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def run(self, key, fn, *args):
+        if fn is tiles.prerender:
+            raise concurrent.futures.process.BrokenProcessPool("a worker died")
+        return await self.pool.run(key, fn, *args)
+
+
+def _upload(app):
+    app["golden_library"] = None
+    app.router.add_post('/upload/image', views.upload_image_handler)
+    cookies = _session(app, {"uid": "uid-1"})
+    form = _form([("left_image", "left.png", _png(_golden(900, 600)))])
+
+    async def test(client):
+        response = await client.post("/upload/image", data=form, cookies=cookies, allow_redirects=False)
+        return response.status
+
+    return serve(app, test), os.path.join(app["upload_dir"], "uid-1", "left.png")
+
+
+def test_upload_renders_the_preview_tiles(app):
+    status, path = _upload(app)
+
+    assert status == 302
+    # zoom 0 to 2 of a 900 x 600 image: 1 + 2 x 2 + 4 x 3 tiles
+    assert sum(len(files) for _, _, files in os.walk(tiles.tile_dir(path))) == 17
+    assert os.path.isfile(tiles.tile_path(path, 0, 0, 0))
+
+
+def test_upload_survives_a_failed_preview(app, pool):
+    app["worker_pool"] = FailingPreviews(pool)
+
+    status, path = _upload(app)
+
+    assert status == 302
+    assert os.path.isfile(path)
+    assert not os.path.exists(os.path.dirname(tiles.tile_dir(path)))
+
+
+@pytest.mark.parametrize("parts, status", [
+    ([("golden", "golden.png", None), ("capture", "capture.png", None)], 400),
+    ([("golden", "golden.png", None)], 400),
+    ([("golden", "golden.png", None), ("capture", "capture.avi", b"\0" * (2 * 1024 * 1024))], 413),
+])
+def test_rejected_video_leaves_no_uploads(app, parts, status):
+    app["max_upload_size"] = 1024 * 1024
+    app["job_manager"] = jobs.JobManager(workers=0, max_queue=1, timeout=10)
+    app["video_timeout"] = 10
+    app.router.add_post('/video', views.video_diff)
+    cookies = _session(app, {"uid": "uid-1"})
+    form = _form([(name, filename, data if data is not None else _png(_golden())) for name, filename, data in parts])
+
+    async def test(client):
+        return (await client.post("/video", data=form, cookies=cookies)).status
+
+    assert serve(app, test) == status
+    assert os.listdir(os.path.join(app["upload_dir"], "uid-1")) == []
@@ -0,0 +1,58 @@
+import asyncio
+import time
+
+import telemetry
+import worker_pool
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_timed_out_job_stays_in_flight():
+    async def scenario():
+        pool = worker_pool.AffinityPool(1, 0, telemetry.Registry())
+        try:
+            # the worker is up and has configured its cache
+            await pool.run(None, time.sleep, 0)
+
+            try:
+                await asyncio.wait_for(pool.run(None, time.sleep, 0.5), 0.05)
+            except asyncio.TimeoutError:
+                pass
+            else:
+                raise AssertionError("the wait should have timed out")
+
+            # the caller gave up, the worker is still computing
+            assert pool.utilisation()[0]["in_flight"] == 1
+
+            await asyncio.sleep(0.8)
+            worker = pool.utilisation()[0]
+            assert worker["in_flight"] == 0
+            assert worker["busy_seconds"] >= 0.45
+        finally:
+            pool.shutdown()
+
+    run(scenario())
+
+
+def test_exception_is_raised_in_the_caller():
+    async def scenario():
+        pool = worker_pool.AffinityPool(1, 0)
+        try:
+            try:
+                await pool.run("session", int, "not a number")
+            except ValueError:
+                pass
+            else:
+                raise AssertionError("ValueError expected")
+            await asyncio.sleep(0.05)
+            assert pool.utilisation()[0]["in_flight"] == 0
+        finally:
+            pool.shutdown()
+
+    run(scenario())